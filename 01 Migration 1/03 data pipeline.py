@@ -1,152 +1,341 @@
+import os
+import sys
 import pandas as pd
-from pandas_gbq import read_gbq
-from pandas_gbq import to_gbq
-from google.cloud import bigquery
 
-client = bigquery.Client()
+# Shared by the Migration 1 and 2 pipelines, see pipeline_common.py in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline_common import (
+    DRY_RUN, LOAD_MODE, SAMPLE_PERCENT, SchemaManager, Span, create_backend, dedup_rows, estimate_pipeline_cost,
+    fingerprint_keys, guard_join_sql, index_dimension, load_raw_staging_passthrough, lookup_keys,
+    partition_write_sql, print_job_report, run_stages, sample_mask, sample_sql, save_watermark,
+    target_fingerprint_set, watermark_filters, watermark_sql,
+)
 
+backend = create_backend('my-dw-demos-01', ['bq_retail'])
+
+
+KEY_MODE = os.environ.get('KEY_MODE', 'uuid')
+
+
+# Facts are sampled by their customer (sample_mask), and every dimension keeps only the members that
+# sampled facts or customers reference, so each sampled fact finds its keys.
+def sampled_product_ids():
+    """ProductIDs bought by sampled customers, or None when not sampling."""
+    if SAMPLE_PERCENT >= 100:
+        return None
+    dt = backend.read_table('bq_retail.raw_stg_fact_transaction', ['CustomerID', 'ProductID'])
+    return dt.loc[sample_mask(dt['CustomerID']), 'ProductID'].unique()
+
+
+RAW_STAGING_MODE = os.environ.get('RAW_STAGING_MODE', 'dataframe')
+# Typed as timestamps in raw staging, so that watermarks and date keys compare times, not strings.
+RAW_TIMESTAMP_COLUMNS = ['Timestamp']
+RAW_STAGING_FILES = [
+    ('Customer', '01 Retail/customers_df.csv', 'bq_retail.raw_stg_dim_customer'),
+    ('Products', '01 Retail/products_df.csv', 'bq_retail.raw_stg_dim_product'),
+    ('Transactions', '01 Retail/transactions_df.csv', 'bq_retail.raw_stg_fact_transaction'),
+]
+
+
+# Raw staging. In 'passthrough' mode the CSV files are bulk loaded as they are, otherwise they are
+# parsed into DataFrames first. An incremental run stages the latest extracts over the previous ones,
+# and the loads downstream skip the rows they already hold.
 def load_raw_staging():
+    if_exists = 'replace' if LOAD_MODE == 'incremental' else 'fail'
+    if RAW_STAGING_MODE == 'passthrough':
+        load_raw_staging_passthrough(backend, RAW_STAGING_FILES, RAW_TIMESTAMP_COLUMNS, if_exists)
+        return
+
     try:
         dc = pd.read_csv('01 Retail/customers_df.csv', index_col=0)
-        to_gbq(dc, 'bq_retail.raw_stg_dim_customer', project_id='my-dw-demos-01', if_exists='fail')
+        backend.write_table(dc, 'bq_retail.raw_stg_dim_customer', if_exists=if_exists)
         print('Customer data loaded successfully.')
 
         try:
             dp = pd.read_csv('01 Retail/products_df.csv', index_col=0)
-            to_gbq(dp, 'bq_retail.raw_stg_dim_product', project_id='my-dw-demos-01', if_exists='fail')
+            backend.write_table(dp, 'bq_retail.raw_stg_dim_product', if_exists=if_exists)
             print ('Products data loaded successfully.')
 
             try:
-                dt = pd.read_csv('01 Retail/transactions_df.csv', index_col=0)
-                to_gbq(dt, 'bq_retail.raw_stg_fact_transaction', project_id='my-dw-demos-01', if_exists='fail')
+                dt = pd.read_csv('01 Retail/transactions_df.csv', index_col=0, parse_dates=RAW_TIMESTAMP_COLUMNS)
+                backend.write_table(dt, 'bq_retail.raw_stg_fact_transaction', if_exists=if_exists)
                 print('Transactions data loaded successfully.')
 
             except Exception as error:
                 print(f'Error with loading transactions data {error}')
+                raise
 
         except Exception as error:
             print(f'Error with loading products data {error}')
+            raise
 
     except Exception as error:
         print(f'Error with loading customer data {error}')
-
-
-try:
-    dim_product = '''
-    CREATE TABLE IF NOT EXISTS bq_retail.dim_product (
-    product_key STRING DEFAULT GENERATE_UUID(),
-    product_id STRING,
-    product_name STRING,
-    category STRING,
-    price FLOAT64
-    )'''
-    query_job = client.query(dim_product)
-    query_job.result()
-
-    dim_customer = '''
-    CREATE TABLE IF NOT EXISTS bq_retail.dim_customer (
-    customer_key STRING DEFAULT GENERATE_UUID(),
-    customer_id STRING,
-    first_name STRING,
-    last_name STRING,
-    email STRING,
-    phone_number STRING,
-    address STRING,
-    city STRING,
-    country STRING,
-    age INT64,
-    gender STRING
-    )'''
-    query_job = client.query(dim_customer)
-    query_job.result()
-
-    fact_transaction = '''
-    CREATE TABLE IF NOT EXISTS bq_retail.fact_transaction (
-    transaction_key STRING DEFAULT GENERATE_UUID(),
-    transaction_id STRING,
-    transaction_date DATE,
-    quantity INT64, 
-    transaction_price FLOAT64,
-    sales FLOAT64,
-    product_key STRING,
-    customer_key STRING
-    )'''
-    query_job = client.query(fact_transaction)
-    query_job.result()
-
-except Exception as error:
-    print(error)
+        raise
+
+
+TABLE_SCHEMAS = {
+    'bq_retail.dim_product': [
+        ('product_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('product_id', 'STRING'),
+        ('product_name', 'STRING'),
+        ('category', 'STRING'),
+        ('price', 'FLOAT64'),
+    ],
+    'bq_retail.dim_customer': [
+        ('customer_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('customer_id', 'STRING'),
+        ('first_name', 'STRING'),
+        ('last_name', 'STRING'),
+        ('email', 'STRING'),
+        ('phone_number', 'STRING'),
+        ('address', 'STRING'),
+        ('city', 'STRING'),
+        ('country', 'STRING'),
+        ('age', 'INT64'),
+        ('gender', 'STRING'),
+    ],
+    'bq_retail.fact_transaction': [
+        ('transaction_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('transaction_id', 'STRING'),
+        ('transaction_date', 'DATE'),
+        ('quantity', 'INT64'),
+        ('transaction_price', 'FLOAT64'),
+        ('sales', 'FLOAT64'),
+        ('product_key', 'STRING'),
+        ('customer_key', 'STRING'),
+    ],
+}
+# Physical layout of the fact table: one partition per day and clustering on the dim keys, so BI
+# queries and reloads only scan the days and keys they filter on.
+TABLE_LAYOUTS = {
+    'bq_retail.fact_transaction': {'partition_by': 'transaction_date', 'cluster_by': ['customer_key', 'product_key']},
+}
+schemas = SchemaManager(backend, TABLE_SCHEMAS, TABLE_LAYOUTS)
 
 
 def load_dim_product():
     try:
-        dp = read_gbq('bq_retail.raw_stg_dim_product', 'my-dw-demos-01')
+        schemas.ensure('bq_retail.dim_product')
+
+        dp = backend.read_table('bq_retail.raw_stg_dim_product',
+                                ['ProductID', 'ProductName', 'Category', 'Price'])
         product = dp[['ProductID', 'ProductName', 'Category', 'Price']].copy()
+        product_ids = sampled_product_ids()
+        if product_ids is not None:
+            product = product[product['ProductID'].isin(product_ids)]
         product = product.rename(columns={'ProductID': 'product_id', 'ProductName': 'product_name',
                                           'Category': 'category', 'Price': 'price'})
-        product = product.drop_duplicates(subset=['product_id', 'product_name'], keep='first')
+        seen = target_fingerprint_set(backend, 'bq_retail.dim_product', product, ['product_id', 'product_name'])
+        product = dedup_rows(product, ['product_id', 'product_name'], seen)
+        if KEY_MODE == 'fingerprint':
+            product['product_key'] = fingerprint_keys(product, ['product_id'])
 
-        to_gbq(product, 'bq_retail.dim_product', project_id='my-dw-demos-01', if_exists='fail')
+        backend.write_table(product, 'bq_retail.dim_product', if_exists='append')
+        seen.save()
+        index_dimension(backend, 'bq_retail.dim_product', product, ['product_id'], ['product_key', 'price'])
 
         print('Product data loaded successfully.')
 
     except Exception as error:
         print(f'Loading failed for dim_product table: {error}')
+        raise
 
 
 def load_dim_customer():
     try:
-        dc = read_gbq('bq_retail.raw_stg_dim_customer', 'my-dw-demos-01')
-        customer = dc[['CustomerID', 'FirstName', 'LastName', 'Email', 'Phone', 'Address', 'Age', 'Gender']].copy()
+        schemas.ensure('bq_retail.dim_customer')
+
+        dc = backend.read_table('bq_retail.raw_stg_dim_customer',
+                                ['CustomerID', 'FirstName', 'LastName', 'Email', 'Phone', 'Address', 'Age', 'Gender'])
+        customer = dc.loc[sample_mask(dc['CustomerID']),
+                          ['CustomerID', 'FirstName', 'LastName', 'Email', 'Phone', 'Address', 'Age', 'Gender']].copy()
         customer = customer.rename(
             columns={'CustomerID': 'customer_id', 'FirstName': 'first_name', 'LastName': 'last_name',
                      'Email': 'email', 'Phone': 'phone_number', 'Address': 'address', 'City': 'city',
                      'Country': 'country', 'Age': 'age', 'Gender': 'gender'})
-        customer = customer.drop_duplicates(subset=['customer_id', 'first_name', 'last_name'], keep='first')
+        seen = target_fingerprint_set(backend, 'bq_retail.dim_customer', customer,
+                                      ['customer_id', 'first_name', 'last_name'])
+        customer = dedup_rows(customer, ['customer_id', 'first_name', 'last_name'], seen)
+        if KEY_MODE == 'fingerprint':
+            customer['customer_key'] = fingerprint_keys(customer, ['customer_id'])
 
-        to_gbq(customer, 'bq_retail.dim_customer', project_id='my-dw-demos-01', if_exists='fail')
+        backend.write_table(customer, 'bq_retail.dim_customer', if_exists='append')
+        seen.save()
+        index_dimension(backend, 'bq_retail.dim_customer', customer, ['customer_id'], ['customer_key'])
 
         print('Customer data loaded successfully.')
 
     except Exception as error:
         print(f'Loading failed for dim_customer table: {error}')
+        raise
+
+
+FACT_LOAD_STRATEGY = os.environ.get('FACT_LOAD_STRATEGY', 'auto')
+FACT_DATAFRAME_MAX_ROWS = 1_000_000
+FACT_COLUMNS = ['transaction_id', 'transaction_date', 'quantity', 'transaction_price', 'sales', 'product_key',
+                'customer_key']
+
+# Python-only steps applied to the finished fact frame before it is written, for transformations with
+# no SQL equivalent. Each takes and returns a frame with FACT_COLUMNS. Any entry rules out the sql
+# strategy, since its rows never reach Python.
+FACT_PYTHON_TRANSFORMS = []
+
+
+# The three ways of loading fact_transaction described in the project notes. Every strategy reads the
+# same source rows (those of the sampled customers, see SAMPLE_PERCENT, and in incremental mode only
+# those after the watermark) and writes the same FACT_COLUMNS, one row per transaction_id, to the
+# transaction_date partitions its rows fall in. A full load rewrites those partitions; an incremental
+# batch is added to them:
+#   dataframe    - the source facts are read and joined to the dims' key indexes in pandas.
+#   keyed_source - the dims' surrogate keys are added to the source facts in the warehouse, and the
+#                  keyed rows are read, transformed and loaded without any client-side key lookup.
+#   sql          - the source facts are joined to the dims and loaded inside the warehouse.
+def _source_fact_sql(select):
+    # The dims are joined on their natural keys, once checked for repeats. QUALIFY keeps one row per
+    # transaction, as drop_duplicates does in pandas.
+    customers = guard_join_sql(backend, 'bq_retail.dim_customer', ['customer_id'], 'bq_retail.raw_stg_fact_transaction',
+                               ['CAST(l.CustomerID AS STRING)'])
+    products = guard_join_sql(backend, 'bq_retail.dim_product', ['product_id'], 'bq_retail.raw_stg_fact_transaction',
+                              ['CAST(l.ProductID AS STRING)'])
+    return f"""
+        {select}
+        FROM bq_retail.raw_stg_fact_transaction t
+        LEFT JOIN {customers} c ON c.customer_id = CAST(t.CustomerID AS STRING)
+        LEFT JOIN {products} p ON p.product_id = CAST(t.ProductID AS STRING)
+        WHERE {sample_sql('t.CustomerID')}
+          AND ({watermark_sql('bq_retail.fact_transaction', 't.Timestamp', 't.TransactionID')})
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY t.TransactionID) = 1
+    """
+
+
+def _finish_fact(fact):
+    """Turns source facts carrying customer_key, product_key and price into FACT_COLUMNS."""
+    final_fact = fact[['TransactionID', 'Timestamp', 'customer_key', 'product_key', 'Quantity', 'price']].copy()
+    final_fact['sales'] = final_fact['Quantity'] * final_fact['price']
+    final_fact['Timestamp'] = pd.to_datetime(final_fact['Timestamp']).dt.date
+
+    final_fact = final_fact.rename(columns={'TransactionID': 'transaction_id', 'Timestamp': 'transaction_date',
+                                            'Quantity': 'quantity', 'price': 'transaction_price'})
+    final_fact = final_fact.drop_duplicates(subset=['transaction_id'], keep='first')
+
+    for transform in FACT_PYTHON_TRANSFORMS:
+        final_fact = transform(final_fact)
+    return final_fact[FACT_COLUMNS]
+
+
+def load_fact_dataframe():
+    df = backend.read_table('bq_retail.raw_stg_fact_transaction',
+                            ['TransactionID', 'CustomerID', 'ProductID', 'Timestamp', 'Quantity'],
+                            filters=watermark_filters('bq_retail.fact_transaction', 'Timestamp', 'TransactionID'))
+    fact = df[['TransactionID', 'CustomerID', 'ProductID', 'Timestamp', 'Quantity']]
+    fact = fact[sample_mask(fact['CustomerID'])].copy()
+
+    fact = fact.rename(columns={'CustomerID': 'customer_id', 'ProductID': 'product_id'})
+
+    if KEY_MODE == 'fingerprint':
+        # Keys come straight from the natural keys.
+        fact['customer_key'] = fingerprint_keys(fact, ['customer_id'])
+        fact['product_key'] = fingerprint_keys(fact, ['product_id'])
+        fact = fact.join(lookup_keys(backend, 'bq_retail.dim_product', fact, ['product_id'], ['price']))
+
+    else:
+        # Keys are looked up in the dims' key indexes instead of merging the full dim frames.
+        fact = (fact
+                .join(lookup_keys(backend, 'bq_retail.dim_customer', fact, ['customer_id'], ['customer_key']))
+                .join(lookup_keys(backend, 'bq_retail.dim_product', fact, ['product_id'], ['product_key', 'price']))
+                )
+
+    backend.write_partitions(_finish_fact(fact), 'bq_retail.fact_transaction', 'transaction_date',
+                             if_exists='replace' if LOAD_MODE == 'full' else 'append')
+
+
+def load_fact_keyed_source():
+    backend.ddl('CREATE OR REPLACE TABLE bq_retail.stg_fact_transaction_keyed AS ' + _source_fact_sql(
+        'SELECT t.TransactionID, t.Timestamp, t.Quantity, c.customer_key, p.product_key, p.price'))
+    try:
+        fact = backend.read_table('bq_retail.stg_fact_transaction_keyed')
+        backend.write_partitions(_finish_fact(fact), 'bq_retail.fact_transaction', 'transaction_date',
+                                 if_exists='replace' if LOAD_MODE == 'full' else 'append')
+    finally:
+        backend.ddl('DROP TABLE IF EXISTS bq_retail.stg_fact_transaction_keyed')
+
+
+def load_fact_sql():
+    # The batch is built in the warehouse first, so that the partitions it touches are known before
+    # they are rewritten. Only the list of days comes back to Python.
+    backend.ddl('CREATE OR REPLACE TABLE bq_retail.stg_fact_transaction_keyed AS ' + _source_fact_sql("""
+        SELECT CAST(t.TransactionID AS STRING) AS transaction_id,
+               CAST(CAST(t.Timestamp AS TIMESTAMP) AS DATE) AS transaction_date, t.Quantity AS quantity,
+               p.price AS transaction_price, t.Quantity * p.price AS sales, p.product_key, c.customer_key"""))
+    try:
+        days = backend.query('SELECT DISTINCT transaction_date FROM bq_retail.stg_fact_transaction_keyed')
+        backend.ddl(partition_write_sql('bq_retail.fact_transaction', FACT_COLUMNS, 'transaction_date',
+                                        days['transaction_date'], ['bq_retail.stg_fact_transaction_keyed'],
+                                        if_exists='replace' if LOAD_MODE == 'full' else 'append'))
+    finally:
+        backend.ddl('DROP TABLE IF EXISTS bq_retail.stg_fact_transaction_keyed')
 
 
-def load_fact_transaction():
-    try:
-        df = read_gbq('bq_retail.raw_stg_fact_transaction', 'my-dw-demos-01')
-        fact = df[['TransactionID', 'CustomerID', 'ProductID', 'Timestamp', 'Quantity']].head(10000).copy()
+FACT_LOAD_STRATEGIES = {
+    'dataframe': load_fact_dataframe,
+    'keyed_source': load_fact_keyed_source,
+    'sql': load_fact_sql,
+}
 
-        dc = read_gbq('bq_retail.dim_customer', 'my-dw-demos-01')
-        dp = read_gbq('bq_retail.dim_product', 'my-dw-demos-01')
 
-        fact = fact.rename(columns={'CustomerID': 'customer_id', 'ProductID': 'product_id'})
+def plan_fact_load(rows):
+    """Picks the fact load strategy for rows source rows, unless FACT_LOAD_STRATEGY names one."""
+    if FACT_LOAD_STRATEGY != 'auto':
+        return FACT_LOAD_STRATEGY
+    if rows <= FACT_DATAFRAME_MAX_ROWS:
+        return 'dataframe'
+    # Large loads stay in the warehouse, unless a Python transform needs the rows client-side, in
+    # which case only the keyed rows are read.
+    return 'keyed_source' if FACT_PYTHON_TRANSFORMS else 'sql'
 
-        merged_fact = (fact
-                       .merge(dc, on='customer_id', how='left')
-                       .merge(dp, on='product_id', how='left')
-                       )
 
-        final_fact = merged_fact[['TransactionID', 'Timestamp', 'customer_key', 'product_key', 'Quantity', 'price']].copy()
-        final_fact['sales'] = final_fact['Quantity'] * final_fact['price']
-        final_fact['Timestamp'] = pd.to_datetime(final_fact['Timestamp']).dt.date
+def load_fact_transaction():
+    try:
+        schemas.ensure('bq_retail.fact_transaction')
 
-        final_fact = final_fact.rename(columns={'TransactionID': 'transaction_id', 'Timestamp': 'transaction_date',
-                                                'Quantity': 'quantity', 'price': 'transaction_price'})
-        final_fact = final_fact.drop_duplicates(subset=['transaction_id'], keep='first')
+        # In incremental mode only transactions after the last loaded one are read. The last of them
+        # is found up front, as the sql strategy never brings the rows to Python.
+        after_watermark = watermark_sql('bq_retail.fact_transaction', 'Timestamp', 'TransactionID')
+        rows = int(backend.query('SELECT COUNT(*) AS n FROM bq_retail.raw_stg_fact_transaction '
+                                 f"WHERE {sample_sql('CustomerID')} AND ({after_watermark})")['n'].iloc[0])
+        last = backend.query('SELECT Timestamp, TransactionID FROM bq_retail.raw_stg_fact_transaction '
+                             f'WHERE {after_watermark} ORDER BY Timestamp DESC, TransactionID DESC LIMIT 1')
+        strategy = plan_fact_load(rows)
 
-        to_gbq(final_fact, 'bq_retail.fact_transaction', project_id='my-dw-demos-01', if_exists='fail')
+        with Span(strategy, 'fact_load', rows=rows):
+            FACT_LOAD_STRATEGIES[strategy]()
+        save_watermark('bq_retail.fact_transaction', last, 'Timestamp', 'TransactionID')
 
-        print('Fact data loaded successfully.')
+        print(f'Fact data loaded successfully ({strategy} strategy, {rows} rows).')
 
     except Exception as error:
         print(f'Error with loading fact_transaction table: {error}')
-
-
-load_raw_staging()
-
-load_dim_product()
-
-load_dim_customer()
-
-load_fact_transaction()
\ No newline at end of file
+        raise
+
+
+STAGES = [
+    {'name': 'load_raw_staging', 'func': load_raw_staging, 'inputs': [],
+     'outputs': ['bq_retail.raw_stg_dim_customer', 'bq_retail.raw_stg_dim_product',
+                 'bq_retail.raw_stg_fact_transaction']},
+    {'name': 'load_dim_product', 'func': load_dim_product,
+     'inputs': ['bq_retail.raw_stg_dim_product', 'bq_retail.raw_stg_fact_transaction'],
+     'outputs': ['bq_retail.dim_product']},
+    {'name': 'load_dim_customer', 'func': load_dim_customer, 'inputs': ['bq_retail.raw_stg_dim_customer'],
+     'outputs': ['bq_retail.dim_customer']},
+    {'name': 'load_fact_transaction', 'func': load_fact_transaction,
+     'inputs': ['bq_retail.raw_stg_fact_transaction', 'bq_retail.dim_customer', 'bq_retail.dim_product'],
+     'outputs': ['bq_retail.fact_transaction', 'bq_retail.stg_fact_transaction_keyed']},
+]
+
+if __name__ == '__main__':
+    if DRY_RUN:
+        estimate_pipeline_cost(STAGES)
+    else:
+        run_stages(STAGES)
+        print_job_report()
\ No newline at end of file
@@ -1,279 +1,393 @@
+import os
+import sys
 import pandas as pd
-from pandas_gbq import read_gbq
-from pandas_gbq import to_gbq
-from google.cloud import bigquery
 
-client = bigquery.Client()
+# Shared by the Migration 1 and 2 pipelines, see pipeline_common.py in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline_common import (
+    DRY_RUN, LOAD_MODE, SAMPLE_PERCENT, SchemaManager, build_calendar, create_backend, date_keys, dedup_rows,
+    estimate_pipeline_cost, fingerprint_keys, guard_join_sql, index_dimension, load_raw_staging_passthrough,
+    lookup_keys, print_job_report, run_stages, sample_mask, save_watermark, target_fingerprint_set,
+    watermark_filters,
+)
 
+backend = create_backend('my-dw-demos-01', ['bq_retail'])
+
+
+KEY_MODE = os.environ.get('KEY_MODE', 'uuid')
+
+
+# Facts are sampled by their customer (sample_mask), and every dimension keeps only the members that
+# sampled facts or customers reference, so each sampled fact finds its keys.
+def sampled_product_ids():
+    """ProductIDs bought by sampled customers, or None when not sampling."""
+    if SAMPLE_PERCENT >= 100:
+        return None
+    dt = backend.read_table('bq_retail.raw_stg_fact_transaction', ['CustomerID', 'ProductID'])
+    return dt.loc[sample_mask(dt['CustomerID']), 'ProductID'].unique()
+
+
+RAW_STAGING_MODE = os.environ.get('RAW_STAGING_MODE', 'dataframe')
+# Typed as timestamps in raw staging, so that watermarks and date keys compare times, not strings.
+RAW_TIMESTAMP_COLUMNS = ['Timestamp']
+RAW_STAGING_FILES = [
+    ('Customer', '01 Retail/customers_df.csv', 'bq_retail.raw_stg_dim_customer'),
+    ('Products', '01 Retail/products_df.csv', 'bq_retail.raw_stg_dim_product'),
+    ('Transactions', '01 Retail/transactions_df.csv', 'bq_retail.raw_stg_fact_transaction'),
+]
+
+
+# Raw staging. In 'passthrough' mode the CSV files are bulk loaded as they are, otherwise they are
+# parsed into DataFrames first. An incremental run stages the latest extracts over the previous ones,
+# and the loads downstream skip the rows they already hold.
 def load_raw_staging():
+    if_exists = 'replace' if LOAD_MODE == 'incremental' else 'fail'
+    if RAW_STAGING_MODE == 'passthrough':
+        load_raw_staging_passthrough(backend, RAW_STAGING_FILES, RAW_TIMESTAMP_COLUMNS, if_exists)
+        return
+
     try:
         dc = pd.read_csv('01 Retail/customers_df.csv', index_col=0)
-        to_gbq(dc, 'bq_retail.raw_stg_dim_customer', project_id='my-dw-demos-01', if_exists='fail')
+        backend.write_table(dc, 'bq_retail.raw_stg_dim_customer', if_exists=if_exists)
         print('Customer data loaded successfully.')
 
         try:
             dp = pd.read_csv('01 Retail/products_df.csv', index_col=0)
-            to_gbq(dp, 'bq_retail.raw_stg_dim_product', project_id='my-dw-demos-01', if_exists='fail')
+            backend.write_table(dp, 'bq_retail.raw_stg_dim_product', if_exists=if_exists)
             print ('Products data loaded successfully.')
 
             try:
-                dt = pd.read_csv('01 Retail/transactions_df.csv', index_col=0)
-                to_gbq(dt, 'bq_retail.raw_stg_fact_transaction', project_id='my-dw-demos-01', if_exists='fail')
+                dt = pd.read_csv('01 Retail/transactions_df.csv', index_col=0, parse_dates=RAW_TIMESTAMP_COLUMNS)
+                backend.write_table(dt, 'bq_retail.raw_stg_fact_transaction', if_exists=if_exists)
                 print('Transactions data loaded successfully.')
 
             except Exception as error:
                 print(f'Error with loading transactions data {error}')
+                raise
 
         except Exception as error:
             print(f'Error with loading products data {error}')
+            raise
 
     except Exception as error:
         print(f'Error with loading customer data {error}')
-
-
-try:
-    dim_product = '''
-    CREATE TABLE IF NOT EXISTS bq_retail.dim_product (
-    product_key STRING DEFAULT GENERATE_UUID(),
-    product_id STRING,
-    product_name STRING,
-    category STRING,
-    price FLOAT64
-    )'''
-    query_job = client.query(dim_product)
-    query_job.result()
-
-    dim_country = '''
-    CREATE TABLE IF NOT EXISTS bq_retail.dim_country (
-    country_key STRING DEFAULT GENERATE_UUID(),
-    country STRING
-    )'''
-    query_job = client.query(dim_country)
-    query_job.result()
-
-    dim_city = '''
-    CREATE TABLE IF NOT EXISTS bq_retail.dim_city (
-    city_key STRING DEFAULT GENERATE_UUID(),
-    city STRING,
-    country STRING,
-    country_key STRING
-    )'''
-    query_job = client.query(dim_city)
-    query_job.result()
-
-    dim_customer = '''
-    CREATE TABLE IF NOT EXISTS bq_retail.dim_customer (
-    customer_key STRING DEFAULT GENERATE_UUID(),
-    customer_id STRING,
-    first_name STRING,
-    last_name STRING,
-    email STRING,
-    phone_number STRING,
-    address STRING,
-    age INT64,
-    gender STRING,
-    city_key STRING
-    )'''
-    query_job = client.query(dim_customer)
-    query_job.result()
-
-    dim_date = '''
-    CREATE TABLE IF NOT EXISTS bq_retail.dim_date (
-    date_key STRING DEFAULT GENERATE_UUID(),
-    transaction_date DATETIME,
-    is_weekend BOOLEAN,
-    month INT64,
-    year INT64,
-    quarter INT64,
-    half_year INT64
-    )'''
-    query_job = client.query(dim_date)
-    query_job.result()
-
-    fact_transaction = '''
-    CREATE TABLE IF NOT EXISTS bq_retail.fact_transaction (
-    transaction_key STRING DEFAULT GENERATE_UUID(),
-    transaction_id STRING,
-    quantity INT64, 
-    transaction_price FLOAT64,
-    sales FLOAT64,
-    product_key STRING,
-    customer_key STRING,
-    date_key STRING
-    )'''
-    query_job = client.query(fact_transaction)
-    query_job.result()
-
-except Exception as error:
-    print(error)
+        raise
+
+
+TABLE_SCHEMAS = {
+    'bq_retail.dim_product': [
+        ('product_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('product_id', 'STRING'),
+        ('product_name', 'STRING'),
+        ('category', 'STRING'),
+        ('price', 'FLOAT64'),
+    ],
+    'bq_retail.dim_country': [
+        ('country_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('country', 'STRING'),
+    ],
+    'bq_retail.dim_city': [
+        ('city_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('city', 'STRING'),
+        ('country', 'STRING'),
+        ('country_key', 'STRING'),
+    ],
+    'bq_retail.dim_customer': [
+        ('customer_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('customer_id', 'STRING'),
+        ('first_name', 'STRING'),
+        ('last_name', 'STRING'),
+        ('email', 'STRING'),
+        ('phone_number', 'STRING'),
+        ('address', 'STRING'),
+        ('age', 'INT64'),
+        ('gender', 'STRING'),
+        ('city_key', 'STRING'),
+    ],
+    'bq_retail.dim_date': [
+        ('date_key', 'INT64'),
+        ('transaction_date', 'DATE'),
+        ('is_weekend', 'BOOLEAN'),
+        ('month', 'INT64'),
+        ('year', 'INT64'),
+        ('quarter', 'INT64'),
+        ('half_year', 'INT64'),
+    ],
+    'bq_retail.fact_transaction': [
+        ('transaction_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('transaction_id', 'STRING'),
+        ('transaction_date', 'DATE'),
+        ('quantity', 'INT64'),
+        ('transaction_price', 'FLOAT64'),
+        ('sales', 'FLOAT64'),
+        ('product_key', 'STRING'),
+        ('customer_key', 'STRING'),
+        ('date_key', 'INT64'),
+    ],
+}
+# Physical layout of the fact table: one partition per day and clustering on the dim keys, so BI
+# queries and reloads only scan the days and keys they filter on. transaction_date is kept on the
+# fact as the partitioning column.
+TABLE_LAYOUTS = {
+    'bq_retail.fact_transaction': {'partition_by': 'transaction_date', 'cluster_by': ['customer_key', 'product_key']},
+}
+schemas = SchemaManager(backend, TABLE_SCHEMAS, TABLE_LAYOUTS)
 
 
 def load_dim_product():
     try:
-        dp = read_gbq('bq_retail.raw_stg_dim_product', 'my-dw-demos-01')
+        schemas.ensure('bq_retail.dim_product')
+
+        dp = backend.read_table('bq_retail.raw_stg_dim_product',
+                                ['ProductID', 'ProductName', 'Category', 'Price'])
         product = dp[['ProductID', 'ProductName', 'Category', 'Price']].copy()
+        product_ids = sampled_product_ids()
+        if product_ids is not None:
+            product = product[product['ProductID'].isin(product_ids)]
         product = product.rename(columns={'ProductID': 'product_id', 'ProductName': 'product_name',
                                           'Category': 'category', 'Price': 'price'})
-        product = product.drop_duplicates(subset=['product_id', 'product_name'], keep='first')
+        seen = target_fingerprint_set(backend, 'bq_retail.dim_product', product, ['product_id', 'product_name'])
+        product = dedup_rows(product, ['product_id', 'product_name'], seen)
+        if KEY_MODE == 'fingerprint':
+            product['product_key'] = fingerprint_keys(product, ['product_id'])
 
-        to_gbq(product, 'bq_retail.dim_product', project_id='my-dw-demos-01', if_exists='fail')
+        backend.write_table(product, 'bq_retail.dim_product', if_exists='append')
+        seen.save()
+        index_dimension(backend, 'bq_retail.dim_product', product, ['product_id'], ['product_key', 'price'])
 
         print('Product data loaded successfully.')
 
     except Exception as error:
         print(f'Loading failed for dim_product table: {error}')
+        raise
 
 
 def load_dim_country():
     try:
-        dc = read_gbq('bq_retail.raw_stg_dim_customer', 'my-dw-demos-01')
-        country = dc[['Country']].copy()
+        schemas.ensure('bq_retail.dim_country')
+
+        dc = backend.read_table('bq_retail.raw_stg_dim_customer', ['CustomerID', 'Country'])
+        country = dc.loc[sample_mask(dc['CustomerID']), ['Country']].copy()
         country = country.rename(columns={'Country': 'country'})
-        country = country.drop_duplicates()
+        seen = target_fingerprint_set(backend, 'bq_retail.dim_country', country, ['country'])
+        country = dedup_rows(country, ['country'], seen)
+        if KEY_MODE == 'fingerprint':
+            country['country_key'] = fingerprint_keys(country, ['country'])
 
-        to_gbq(country, 'bq_retail.dim_country', project_id='my-dw-demos-01', if_exists='append')
+        backend.write_table(country, 'bq_retail.dim_country', if_exists='append')
+        seen.save()
 
         print('Data loaded successfully to dim_country table.')
 
     except Exception as error:
         print(f'Loading failed for dim_country table: {error}')
+        raise
 
 
 def load_dim_city():
     try:
-        dcc = read_gbq('bq_retail.raw_stg_dim_customer', 'my-dw-demos-01')
-        city = dcc[['City', 'Country']].copy()
-        city = city.rename(columns={'City': 'city'})
-        city = city.drop_duplicates(subset=['city', 'Country'], keep='first')
+        schemas.ensure('bq_retail.dim_city')
+
+        dcc = backend.read_table('bq_retail.raw_stg_dim_customer', ['CustomerID', 'City', 'Country'])
+        city = dcc.loc[sample_mask(dcc['CustomerID']), ['City', 'Country']].copy()
+        city = city.rename(columns={'City': 'city', 'Country': 'country'})
+        seen = target_fingerprint_set(backend, 'bq_retail.dim_city', city, ['city', 'country'])
+        city = dedup_rows(city, ['city', 'country'], seen)
+        if KEY_MODE == 'fingerprint':
+            city['city_key'] = fingerprint_keys(city, ['city', 'country'])
+            city['country_key'] = fingerprint_keys(city, ['country'])
 
-        to_gbq(city, 'bq_retail.dim_city', project_id='my-dw-demos-01', if_exists='append')
+        backend.write_table(city, 'bq_retail.dim_city', if_exists='append')
+        seen.save()
 
         print('Data loaded successfully to dim_city table.')
 
+        # With fingerprint keys country_key is already set, so the update below is not needed.
+        if KEY_MODE == 'fingerprint':
+            return
+
         # A window function is not used here as usual because the table is identified by 2 attributes
         # whereas a WF will partition by only one attribute.
         try:
-            update_dim_city = '''
+            countries = guard_join_sql(backend, 'bq_retail.dim_country', ['country'], 'bq_retail.raw_stg_dim_customer',
+                                       ['l.Country'])
+            update_dim_city = f'''
             UPDATE bq_retail.dim_city cc SET country_key = j.country_key FROM (
                 SELECT DISTINCT r.City, r.Country, c.country_key
                 FROM bq_retail.raw_stg_dim_customer r
-                JOIN bq_retail.dim_country c ON r.Country = c.country 
+                JOIN {countries} c ON r.Country = c.country 
             ) j
             WHERE cc.city = j.City and cc.country = j.Country
             '''
-            query_job = client.query(update_dim_city)
-            query_job.result()
+            backend.query(update_dim_city)
 
             print('dim_city updated successfully with country_key.')
 
         except Exception as error:
             print(f'Loading failed for dim_city table: {error}')
+            raise
 
     except Exception as error:
         print(f'Update failed for dim_city table: {error}')
+        raise
 
 
 def load_dim_customer():
     try:
-        dcs = read_gbq('bq_retail.raw_stg_dim_customer', 'my-dw-demos-01')
+        schemas.ensure('bq_retail.dim_customer')
+
+        dcs = backend.read_table('bq_retail.raw_stg_dim_customer',
+                                 ['CustomerID', 'FirstName', 'LastName', 'Email', 'Phone', 'Address', 'Age',
+                                  'Gender', 'City', 'Country'])
+        dcs = dcs[sample_mask(dcs['CustomerID'])]
         customer = dcs[['CustomerID', 'FirstName', 'LastName', 'Email', 'Phone', 'Address', 'Age', 'Gender']].copy()
         customer = customer.rename(
             columns={'CustomerID': 'customer_id', 'FirstName': 'first_name', 'LastName': 'last_name',
                      'Email': 'email', 'Phone': 'phone_number', 'Address': 'address', 'Age': 'age', 'Gender': 'gender'})
-        customer = customer.drop_duplicates(subset=['customer_id', 'first_name', 'last_name'], keep='first')
+        if KEY_MODE == 'fingerprint':
+            customer['customer_key'] = fingerprint_keys(customer, ['customer_id'])
+            customer['city_key'] = fingerprint_keys(dcs, ['City', 'Country'])
+        seen = target_fingerprint_set(backend, 'bq_retail.dim_customer', customer,
+                                      ['customer_id', 'first_name', 'last_name'])
+        customer = dedup_rows(customer, ['customer_id', 'first_name', 'last_name'], seen)
 
-        to_gbq(customer, 'bq_retail.dim_customer', project_id='my-dw-demos-01', if_exists='append')
+        backend.write_table(customer, 'bq_retail.dim_customer', if_exists='append')
+        seen.save()
+        index_dimension(backend, 'bq_retail.dim_customer', customer, ['customer_id'], ['customer_key'])
 
         print('Customer data loaded successfully.')
 
+        # With fingerprint keys city_key is already set, so the update below is not needed.
+        if KEY_MODE == 'fingerprint':
+            return
+
+        # Cities are only unique within a country, so dim_city is joined on both.
         try:
-            update_dim_customer = '''
+            cities = guard_join_sql(backend, 'bq_retail.dim_city', ['city', 'country'],
+                                    'bq_retail.raw_stg_dim_customer', ['l.City', 'l.Country'])
+            update_dim_customer = f'''
             UPDATE bq_retail.dim_customer cc SET city_key = j.city_key FROM (
                 SELECT * EXCEPT(row_num) FROM (
                     SELECT *, ROW_NUMBER() OVER(PARTITION BY CustomerID) AS row_num
                     FROM bq_retail.raw_stg_dim_customer r
-                    JOIN bq_retail.dim_city c ON r.City = c.city
+                    JOIN {cities} c ON r.City = c.city AND r.Country = c.country
                 ) WHERE row_num = 1
             ) AS j
             WHERE cc.customer_id = j.CustomerID
             '''
-            query_job = client.query(update_dim_customer)
-            query_job.result()
+            backend.query(update_dim_customer)
 
             print('dim_customer updated successfully with city_key.')
 
         except Exception as error:
             print(f'Update failed for dim_customer table: {error}')
+            raise
 
     except Exception as error:
         print(f'Loading failed for dim_customer table: {error}')
+        raise
 
 
 def load_dim_date():
     try:
-        dt = read_gbq('bq_retail.raw_stg_fact_transaction', 'my-dw-demos-01')
-        date = dt[['Timestamp']].copy()
-        date['Timestamp'] = pd.to_datetime(date['Timestamp'])
-        date['is_weekend'] = date['Timestamp'].dt.weekday >= 5
-        date['month'] = date['Timestamp'].dt.month
-        date['year'] = date['Timestamp'].dt.year
-        date['quarter'] = date['Timestamp'].dt.quarter
-        date['half_year'] = ((date['month']-1) // 6) + 1
-        date = date.rename(columns={'Timestamp': 'transaction_date'})
-        date = date.drop_duplicates(subset=['transaction_date'], keep='first')
+        schemas.ensure('bq_retail.dim_date')
+
+        bounds = backend.query('SELECT MIN(Timestamp) AS first_ts, MAX(Timestamp) AS last_ts '
+                               'FROM bq_retail.raw_stg_fact_transaction')
+        first, last = pd.to_datetime(bounds['first_ts'].iloc[0]), pd.to_datetime(bounds['last_ts'].iloc[0])
+        if pd.isna(first):
+            print('No transactions, dim_date left as it is.')
+            return
 
-        to_gbq(date, 'bq_retail.dim_date', project_id='my-dw-demos-01', if_exists='append')
+        # Only the days not in dim_date yet are added, so the calendar grows a year at a time.
+        date = build_calendar(first, last, 'transaction_date')
+        existing = backend.query('SELECT date_key FROM bq_retail.dim_date')
+        date = date[~date['date_key'].isin(existing['date_key'] if len(existing) else [])]
 
-        print('Date data loaded successfully.')
+        backend.write_table(date, 'bq_retail.dim_date', if_exists='append')
+
+        print(f'Date data loaded successfully ({len(date)} days).')
 
     except Exception as error:
         print(f'Loading failed for dim_date table: {error}')
+        raise
 
 
 def load_fact_transaction():
     try:
-        df = read_gbq('bq_retail.raw_stg_fact_transaction', 'my-dw-demos-01')
-        fact = df[['TransactionID', 'CustomerID', 'ProductID', 'Timestamp', 'Quantity']].copy()
+        schemas.ensure('bq_retail.fact_transaction')
+
+        # In incremental mode only transactions after the last loaded one are read.
+        df = backend.read_table('bq_retail.raw_stg_fact_transaction',
+                                ['TransactionID', 'CustomerID', 'ProductID', 'Timestamp', 'Quantity'],
+                                filters=watermark_filters('bq_retail.fact_transaction', 'Timestamp', 'TransactionID'))
+        fact = df[['TransactionID', 'CustomerID', 'ProductID', 'Timestamp', 'Quantity']]
+        fact = fact[sample_mask(fact['CustomerID'])].copy()
 
         fact['Timestamp'] = pd.to_datetime(fact['Timestamp'])
         fact = fact.rename(columns={'CustomerID': 'customer_id', 'ProductID': 'product_id',
                                     'Timestamp': 'transaction_date',})
-
-        dc = read_gbq('bq_retail.dim_customer', 'my-dw-demos-01')
-        dp = read_gbq('bq_retail.dim_product', 'my-dw-demos-01')
-        dt = read_gbq('bq_retail.dim_date', 'my-dw-demos-01')
-
-        merged_fact = (fact
-                       .merge(dc, on='customer_id', how='left')
-                       .merge(dp, on='product_id', how='left')
-                       .merge(dt, on='transaction_date', how='left')
-                       )
-
-        final_fact = merged_fact[['TransactionID', 'customer_key', 'product_key', 'date_key', 'Quantity', 'price']].copy()
+        fact['date_key'] = date_keys(fact['transaction_date'])
+
+        if KEY_MODE == 'fingerprint':
+            # Keys come straight from the natural keys.
+            fact['customer_key'] = fingerprint_keys(fact, ['customer_id'])
+            fact['product_key'] = fingerprint_keys(fact, ['product_id'])
+            fact = fact.join(lookup_keys(backend, 'bq_retail.dim_product', fact, ['product_id'], ['price']))
+
+        else:
+            # Keys are looked up in the dims' key indexes instead of merging the full dim frames.
+            fact = (fact
+                    .join(lookup_keys(backend, 'bq_retail.dim_customer', fact, ['customer_id'], ['customer_key']))
+                    .join(lookup_keys(backend, 'bq_retail.dim_product', fact, ['product_id'], ['product_key', 'price']))
+                    )
+
+        final_fact = fact[['TransactionID', 'transaction_date', 'customer_key', 'product_key', 'date_key', 'Quantity',
+                           'price']].copy()
         final_fact['sales'] = final_fact['Quantity'] * final_fact['price']
+        final_fact['transaction_date'] = final_fact['transaction_date'].dt.date
 
         final_fact = final_fact.rename(columns={'TransactionID': 'transaction_id','Quantity': 'quantity',
                                                 'price': 'transaction_price'})
         final_fact = final_fact.drop_duplicates(subset=['transaction_id'], keep='first')
 
-        to_gbq(final_fact, 'bq_retail.fact_transaction', project_id='my-dw-demos-01', if_exists='append')
+        # A full load rewrites the partitions it covers; an incremental batch is added to them.
+        backend.write_partitions(final_fact, 'bq_retail.fact_transaction', 'transaction_date',
+                                 if_exists='replace' if LOAD_MODE == 'full' else 'append')
+        save_watermark('bq_retail.fact_transaction', df, 'Timestamp', 'TransactionID')
 
         print('Fact data loaded successfully.')
 
     except Exception as error:
         print(f'Error with loading fact_transaction table: {error}')
-
-
-load_raw_staging()
-
-load_dim_product()
-
-load_dim_country()
-
-load_dim_city()
-
-load_dim_customer()
-
-load_dim_date()
-
-load_fact_transaction()
\ No newline at end of file
+        raise
+
+
+# load_dim_product, load_dim_country and load_dim_date are independent and run concurrently.
+STAGES = [
+    {'name': 'load_raw_staging', 'func': load_raw_staging, 'inputs': [],
+     'outputs': ['bq_retail.raw_stg_dim_customer', 'bq_retail.raw_stg_dim_product',
+                 'bq_retail.raw_stg_fact_transaction']},
+    {'name': 'load_dim_product', 'func': load_dim_product,
+     'inputs': ['bq_retail.raw_stg_dim_product', 'bq_retail.raw_stg_fact_transaction'],
+     'outputs': ['bq_retail.dim_product']},
+    {'name': 'load_dim_country', 'func': load_dim_country, 'inputs': ['bq_retail.raw_stg_dim_customer'],
+     'outputs': ['bq_retail.dim_country']},
+    {'name': 'load_dim_city', 'func': load_dim_city,
+     'inputs': ['bq_retail.raw_stg_dim_customer', 'bq_retail.dim_country'], 'outputs': ['bq_retail.dim_city']},
+    {'name': 'load_dim_customer', 'func': load_dim_customer,
+     'inputs': ['bq_retail.raw_stg_dim_customer', 'bq_retail.dim_city'], 'outputs': ['bq_retail.dim_customer']},
+    {'name': 'load_dim_date', 'func': load_dim_date, 'inputs': ['bq_retail.raw_stg_fact_transaction'],
+     'outputs': ['bq_retail.dim_date']},
+    {'name': 'load_fact_transaction', 'func': load_fact_transaction,
+     'inputs': ['bq_retail.raw_stg_fact_transaction', 'bq_retail.dim_customer', 'bq_retail.dim_product',
+                'bq_retail.dim_date'],
+     'outputs': ['bq_retail.fact_transaction']},
+]
+
+if __name__ == '__main__':
+    if DRY_RUN:
+        estimate_pipeline_cost(STAGES)
+    else:
+        run_stages(STAGES)
+        print_job_report()
\ No newline at end of file
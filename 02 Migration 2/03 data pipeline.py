@@ -1,37 +1,253 @@
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import sys
+import threading
 import pandas as pd
-from google.cloud import bigquery
-from pandas_gbq import read_gbq
-from pandas_gbq import to_gbq
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from time import time
 
-client = bigquery.Client()
+# Shared by the Migration 1 and 2 pipelines, see pipeline_common.py in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline_common import (
+    DRY_RUN, LOAD_MODE, LOCAL_BUCKET_DIR, STAGE_WORKERS, TRACE_RUN_ID, SchemaManager, build_calendar,
+    create_backend, current_span, date_keys, dedup_rows, estimate_pipeline_cost, fingerprint_keys, guard_join,
+    guard_join_sql, print_job_report, sample_sql, save_watermark, schedule_stages, target_fingerprint_set,
+    watermark_filters, write_large_table,
+)
+
+backend = create_backend('my-dw-project-01', ['bigdata_api'])
+
+
+SNAPSHOT_DIR = 'snapshots'
+_snapshot_lock = threading.Lock()
+
+
+# Local snapshot of a staging table, shared by all load stages. The table is downloaded once
+# and kept as an uncompressed Feather file that every stage memory maps, instead of each stage
+# pulling the whole table from BigQuery again. Statements that change staging bump the version of
+# the columns they touch, and only those columns are refetched (matched on row_id) on the next read.
+def _snapshot_paths(table_name):
+    name = table_name.replace('.', '__')
+    return os.path.join(SNAPSHOT_DIR, f'{name}.feather'), os.path.join(SNAPSHOT_DIR, f'{name}.json')
+
+
+def _load_snapshot_manifest(table_name):
+    _, manifest_path = _snapshot_paths(table_name)
+    if not os.path.exists(manifest_path):
+        return {'versions': {}, 'snapshot': None}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _save_snapshot_manifest(table_name, manifest):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    _, manifest_path = _snapshot_paths(table_name)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def _write_snapshot(table_name, table):
+    data_path, _ = _snapshot_paths(table_name)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    # Uncompressed so that the file can be memory mapped and read without decoding.
+    feather.write_feather(table, data_path + '.tmp', compression='uncompressed')
+    os.replace(data_path + '.tmp', data_path)
+
+
+def mark_snapshot_stale(table_name, columns=None):
+    """Records a change to table_name. columns=None means the whole table was replaced."""
+    if DRY_RUN:
+        return
+    with _snapshot_lock:
+        manifest = _load_snapshot_manifest(table_name)
+        if columns is None:
+            data_path, _ = _snapshot_paths(table_name)
+            if os.path.exists(data_path):
+                os.remove(data_path)
+            manifest = {'versions': {}, 'snapshot': None}
+        else:
+            for col in columns:
+                manifest['versions'][col] = manifest['versions'].get(col, 0) + 1
+        _save_snapshot_manifest(table_name, manifest)
+
+
+def _refresh_snapshot_columns(table_name, columns):
+    data_path, _ = _snapshot_paths(table_name)
+    with pa.memory_map(data_path) as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    # Only the changed columns (plus the row identifier) are downloaded again.
+    changed = backend.read_table(table_name, ['row_id'] + columns)
+    changed = changed.set_index('row_id').reindex(table.column('row_id').to_pandas())
+
+    for col in columns:
+        if col in table.column_names:
+            table = table.drop([col])
+        table = table.append_column(col, pa.array(changed[col], from_pandas=True))
+
+    _write_snapshot(table_name, table)
+
+
+def read_snapshot(table_name, columns=None, filters=None):
+    """Returns table_name as a DataFrame, served from the local snapshot where it is up to date."""
+    if DRY_RUN:
+        # The dry-run backend returns an empty table, which must not replace the snapshot.
+        return backend.read_table(table_name, columns)
+    data_path, _ = _snapshot_paths(table_name)
+
+    # Stages reading concurrently share one download or refresh.
+    with _snapshot_lock:
+        manifest = _load_snapshot_manifest(table_name)
+        if manifest['snapshot'] is None or not os.path.exists(data_path):
+            df = backend.read_table(table_name)
+            _write_snapshot(table_name, pa.Table.from_pandas(df, preserve_index=False))
+            manifest['snapshot'] = dict(manifest['versions'])
+            _save_snapshot_manifest(table_name, manifest)
+            print(f'Snapshot of {table_name} created with {len(df)} rows.')
+        else:
+            stale = [col for col, version in manifest['versions'].items()
+                     if manifest['snapshot'].get(col) != version]
+            if stale:
+                _refresh_snapshot_columns(table_name, stale)
+                manifest['snapshot'] = dict(manifest['versions'])
+                _save_snapshot_manifest(table_name, manifest)
+                print(f'Snapshot of {table_name} refreshed for columns {stale}.')
+
+    with pa.memory_map(data_path) as source:
+        table = pa.ipc.open_file(source).read_all()
+        expression = pq.filters_to_expression(filters) if filters else None
+        return ds.dataset(table).to_table(columns=columns, filter=expression).to_pandas()
+
+
+KEY_MODE = os.environ.get('KEY_MODE', 'uuid')
+
+
+# Nested JSON flattening. Nested columns are flattened in Arrow, in one columnar pass per column,
+# rather than building a pandas object per row or per line item. A list column becomes one row per
+# element with the parent columns repeated alongside it, as DataFrame.explode does. A struct column
+# is replaced by one column per leaf field, named as pd.json_normalize names them (fields of a
+# nested struct get dotted names).
+def explode_list(table, column):
+    values = table.column(column).combine_chunks()
+    parents = pc.list_parent_indices(values).cast(pa.int64())
+    elements = pc.list_flatten(values)
+
+    # Empty and null lists keep their parent row, with a null element.
+    empty = pc.indices_nonzero(pc.equal(pc.fill_null(pc.list_value_length(values), 0), 0)).cast(pa.int64())
+    if len(empty):
+        parents = pa.concat_arrays([parents, empty])
+        elements = pa.concat_arrays([elements, pa.nulls(len(empty), elements.type)])
+        order = pc.sort_indices(parents)
+        parents, elements = parents.take(order), elements.take(order)
+
+    table = table.remove_column(table.schema.get_field_index(column)).take(parents)
+    return table.append_column(column, elements)
+
+
+def _struct_leaves(array, prefix=''):
+    leaves = []
+    struct_type = array.type
+    for position, child in enumerate(array.flatten()):
+        field = struct_type.field(position)
+        if pa.types.is_struct(field.type):
+            leaves += _struct_leaves(child, f'{prefix}{field.name}.')
+        else:
+            leaves.append((f'{prefix}{field.name}', child))
+    return leaves
+
+
+def flatten_nested(table, columns):
+    """Flattens each of the given list and/or struct columns of an Arrow table."""
+    for column in columns:
+        column_type = table.schema.field(column).type
+        if pa.types.is_list(column_type) or pa.types.is_large_list(column_type):
+            table = explode_list(table, column)
+        if pa.types.is_struct(table.schema.field(column).type):
+            struct = table.column(column)
+            table = table.remove_column(table.schema.get_field_index(column))
+            for name, child in _struct_leaves(struct):
+                table = table.append_column(name, child)
+    return table
+
+
+INGEST_MODE = os.environ.get('INGEST_MODE', 'warehouse')
+INGEST_CHUNK_ROWS = 100_000
+
+
+# Streaming ingest (INGEST_MODE=stream). The NDJSON source is read from local disk, or from the local
+# bucket stand-in for a gs:// URI, INGEST_CHUNK_ROWS lines at a time. Each chunk is flattened and
+# appended to the clean table, so no raw table is written or read back and memory use stays at one
+# chunk whatever the file size.
+def stream_ndjson(uri, clean, table_name):
+    path = os.path.join(LOCAL_BUCKET_DIR, uri[len('gs://'):]) if uri.startswith('gs://') else uri
+    if_exists = 'fail'
+
+    # Values keep their JSON types, as they do in the raw table.
+    with pd.read_json(path, lines=True, chunksize=INGEST_CHUNK_ROWS, dtype=False, convert_dates=False) as reader:
+        for chunk in reader:
+            clean_chunk = clean(pa.Table.from_pandas(chunk, preserve_index=False))
+            backend.write_table(clean_chunk, table_name, if_exists=if_exists)
+            if_exists = 'append'
+
+
+# Flattening nested JSON objects. Each takes the raw Arrow table (or chunk) and returns the clean rows.
+def clean_product(raw_prod):
+    return flatten_nested(raw_prod, ['rating']).to_pandas()
+
+
+def clean_sales(raw_sales):
+    # One row per line item, with productId and quantity alongside the sale columns.
+    clean = flatten_nested(raw_sales, ['products']).to_pandas()
+    clean['date'] = pd.to_datetime(clean['date']).dt.date
+    clean['month'] = pd.to_datetime(clean['date']).dt.month
+    clean['year'] = pd.to_datetime(clean['date']).dt.year
+    return clean
+
+
+def clean_user(raw_user):
+    raw_user = flatten_nested(raw_user, ['address', 'name']).to_pandas()
+    return raw_user.rename(columns={'geolocation.lat': 'geolocation_lat', 'geolocation.long': 'geolocation_long'})
+
+
+PRODUCT_SOURCE = 'gs://my-dw-bucket-02/bq_source_data_04.json'
+SALES_SOURCE = 'gs://my-dw-bucket-02/bq_source_data_05.json'
+USER_SOURCE = 'gs://my-dw-bucket-02/bq_source_data_06.json'
+
 
 # Fetching raw data blobs from a GCS bucket into BigQuery tables
 # and restructuring them so they can be joined together into one raw staging table.
 def extract_product():
+    uri = PRODUCT_SOURCE
+
+    if INGEST_MODE == 'stream':
+        try:
+            stream_ndjson(uri, clean_product, 'bigdata_api.prod_data_clean')
+            print('Product data streamed and processed successfully.')
+        except Exception as error:
+            print(f'Error with streaming product data {error}')
+            raise
+        return
+
     try:
-        uri = 'gs://my-dw-bucket-02/bq_source_data_04.json'
         destination_table = 'bigdata_api.prod_data_raw'
 
-        job_config = bigquery.LoadJobConfig(
-            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON, autodetect=True
-        )
-
-        load_job = client.load_table_from_uri(uri, destination_table, job_config=job_config)
-        load_job.result()
+        backend.load_from_file(uri, destination_table, 'NEWLINE_DELIMITED_JSON', if_exists='append')
 
         print(f'Raw product data loaded successfully.')
 
         try:
-            dp = read_gbq('bigdata_api.prod_data_raw', 'my-dw-project-01')
-            raw_prod = dp.copy()
+            raw_prod = backend.read_table('bigdata_api.prod_data_raw', as_arrow=True)
+            clean_prod = clean_product(raw_prod)
 
-            # Flattening nested JSON objects.
-            clean_prod = raw_prod.join(pd.json_normalize(raw_prod['rating']))
-            clean_prod = clean_prod.drop(columns=['rating'])
-
-            to_gbq(clean_prod, 'bigdata_api.prod_data_clean', project_id='my-dw-project-01',
-                   if_exists='fail')
+            backend.write_table(clean_prod, 'bigdata_api.prod_data_clean', if_exists='fail')
 
             print('Product data processed successfully.')
 
@@ -45,33 +261,29 @@ def extract_product():
 
 
 def extract_sales():
+    uri = SALES_SOURCE
+
+    if INGEST_MODE == 'stream':
+        try:
+            stream_ndjson(uri, clean_sales, 'bigdata_api.sales_data_clean')
+            print('Sales data streamed and processed successfully.')
+        except Exception as error:
+            print(f'Error with streaming sales data {error}')
+            raise
+        return
+
     try:
-        uri = 'gs://my-dw-bucket-02/bq_source_data_05.json'
         destination_table = 'bigdata_api.sales_data_raw'
 
-        job_config = bigquery.LoadJobConfig(
-            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON, autodetect=True
-        )
-
-        load_job = client.load_table_from_uri(uri, destination_table, job_config=job_config)
-        load_job.result()
+        backend.load_from_file(uri, destination_table, 'NEWLINE_DELIMITED_JSON', if_exists='append')
 
         print(f'Raw sales data loaded successfully.')
 
         try:
-            ds = read_gbq('bigdata_api.sales_data_raw', 'my-dw-project-01')
-            raw_sales = ds.copy()
-
-            raw_sales_explode = raw_sales.explode('products')
-            products_expanded = raw_sales_explode['products'].apply(pd.Series)
-            # Concat is used here as an alternative to join()
-            clean_sales = pd.concat([raw_sales_explode, products_expanded], axis=1)
-            clean_sales = clean_sales.drop(columns=['products'])
-            clean_sales['date'] = pd.to_datetime(clean_sales['date']).dt.date
-            clean_sales['month'] = pd.to_datetime(clean_sales['date']).dt.month
-            clean_sales['year'] = pd.to_datetime(clean_sales['date']).dt.year
-            to_gbq(clean_sales, 'bigdata_api.sales_data_clean', project_id='my-dw-project-01',
-                   if_exists='fail')
+            raw_sales = backend.read_table('bigdata_api.sales_data_raw', as_arrow=True)
+            clean = clean_sales(raw_sales)
+
+            backend.write_table(clean, 'bigdata_api.sales_data_clean', if_exists='fail')
 
             print('Sales data processed successfully.')
 
@@ -85,33 +297,29 @@ def extract_sales():
 
 
 def extract_user():
+    uri = USER_SOURCE
+
+    if INGEST_MODE == 'stream':
+        try:
+            stream_ndjson(uri, clean_user, 'bigdata_api.user_data_clean')
+            print('User data streamed and processed successfully.')
+        except Exception as error:
+            print(f'Error with streaming user data {error}')
+            raise
+        return
+
     try:
-        uri = 'gs://my-dw-bucket-02/bq_source_data_06.json'
         destination_table = 'bigdata_api.user_data_raw'
 
-        job_config = bigquery.LoadJobConfig(
-            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON, autodetect=True
-        )
-
-        load_job = client.load_table_from_uri(uri, destination_table, job_config=job_config)
-        load_job.result()
+        backend.load_from_file(uri, destination_table, 'NEWLINE_DELIMITED_JSON', if_exists='append')
 
         print(f'Raw user data loaded successfully.')
 
         try:
-            du = read_gbq('bigdata_api.user_data_raw', 'my-dw-project-01')
-            raw_user = du.copy()
-
-            raw_user = raw_user.join(pd.json_normalize(raw_user['address']))
-            raw_user = raw_user.rename(columns={'geolocation.lat': 'geolocation_lat'})
-            raw_user = raw_user.rename(columns={'geolocation.long': 'geolocation_long'})
-            raw_user = raw_user.drop(columns=['address'])
+            raw_user = backend.read_table('bigdata_api.user_data_raw', as_arrow=True)
+            clean = clean_user(raw_user)
 
-            raw_user = raw_user.join(pd.json_normalize(raw_user['name']))
-            clean_user = raw_user.drop(columns=['name'])
-
-            to_gbq(clean_user, 'bigdata_api.user_data_clean', project_id='my-dw-project-01',
-                   if_exists='fail')
+            backend.write_table(clean, 'bigdata_api.user_data_clean', if_exists='fail')
 
             print('User data processed successfully.')
 
@@ -124,21 +332,28 @@ def extract_user():
         raise
 
 
-# Creating a combined staging table from all 3 cleaned data sources.
+# Creating a combined staging table from all 3 cleaned data sources. Staging only keeps the rows of
+# sampled customers (sample_sql), and every dim and fact is loaded from staging, so each sampled fact
+# finds its keys.
 def create_combo_staging():
     try:
-        create_combined_stg_table = '''
+        # Sales are the grain of staging, so products and users must each have one row per id.
+        products = guard_join_sql(backend, 'bigdata_api.prod_data_clean', ['id'], 'bigdata_api.sales_data_clean',
+                                  ['l.`productId`'])
+        users = guard_join_sql(backend, 'bigdata_api.user_data_clean', ['id'], 'bigdata_api.sales_data_clean',
+                               ['l.`userId`'])
+        create_combined_stg_table = f'''
         CREATE TABLE bigdata_api.stg_table_initial AS
         SELECT a.id as product_id, title, description, category, price, image, rate, count, b.id as sales_id, quantity, 
         date, month, year, c.id as customer_id, firstname, lastname, email, phone, username, password, city, 
         street, number, zipcode, geolocation_lat, geolocation_long
-        FROM bigdata_api.prod_data_clean AS a
+        FROM {products} AS a
         LEFT JOIN bigdata_api.sales_data_clean AS b on a.id = b.`productId`
-        FULL OUTER JOIN bigdata_api.user_data_clean AS c on b.`userId` = c.id
+        FULL OUTER JOIN {users} AS c on b.`userId` = c.id
+        WHERE {sample_sql('c.id')}
         '''
 
-        query_job = client.query(create_combined_stg_table)
-        query_job.result()
+        backend.ddl(create_combined_stg_table)
 
         print('Initial staging table created successfully.')
 
@@ -147,196 +362,263 @@ def create_combo_staging():
         raise
 
 
+STRING_DTYPE = pd.StringDtype('pyarrow')
+TYPE_FILLS = {'Int64': 0, 'Float64': 0.0, 'string': 'NA', 'category': 'NA', 'datetime64': None}
+MASK = '***Masked***'
+
+
+# Column coercion. Every column is cast straight to a nullable extension dtype: Int64 and Float64 for
+# numbers, pyarrow-backed strings for text, categoricals for low-cardinality text and datetime64 for
+# dates, so no column passes through object dtype. Values that do not parse as the column's type are
+# coerced to null and counted per column, then nulls are filled with the type's default (dates are
+# left as NaT).
+def coerce_columns(df, schema):
+    coerced = {}
+    null_report = {}
+    for col, dtype in schema.items():
+        values = df[col]
+        if dtype in ('Int64', 'Float64'):
+            converted = pd.to_numeric(values, errors='coerce').astype(dtype)
+        elif dtype == 'datetime64':
+            converted = pd.to_datetime(values, errors='coerce')
+        else:
+            converted = values.astype(STRING_DTYPE)
+            if dtype == 'category':
+                converted = converted.astype('category')
+        null_report[col] = int(converted.isna().sum() - values.isna().sum())
+
+        fill = TYPE_FILLS[dtype]
+        if fill is not None:
+            if dtype == 'category' and fill not in converted.cat.categories:
+                converted = converted.cat.add_categories([fill])
+            converted = converted.fillna(fill)
+        coerced[col] = converted
+    return df.assign(**coerced), null_report
+
+
+STAGING_SCHEMA = {
+    'product_id': 'Int64',
+    'title': 'string',
+    'description': 'string',
+    'category': 'category',
+    'price': 'Float64',
+    'image': 'string',
+    'rate': 'Float64',
+    'count': 'Int64',
+    'sales_id': 'Int64',
+    'quantity': 'Int64',
+    'date': 'datetime64',
+    'month': 'Int64',
+    'year': 'Int64',
+    'customer_id': 'Int64',
+    'firstname': 'string',
+    'lastname': 'string',
+    'email': 'string',
+    'phone': 'string',
+    'username': 'string',
+    'password': 'string',
+    'city': 'category',
+    'street': 'string',
+    'number': 'Int64',
+    'zipcode': 'string',
+    'geolocation_lat': 'Float64',
+    'geolocation_long': 'Float64'
+}
+TRANSFORM_PARTITIONS = int(os.environ.get('TRANSFORM_PARTITIONS', '1'))
+TRANSFORM_WORKERS = os.cpu_count() or 1
+
+
+def transform_partition(source_table):
+    """Coerces, cleans, masks and de-duplicates a slice of stg_table_initial. Touches no warehouse state."""
+    # Assigning the pre-determined data types and default fills. Any values not
+    # matching the assigned data type are flagged as null before the fill.
+    source_table, null_report = coerce_columns(source_table, STAGING_SCHEMA)
+
+    # Capitalizing the values in certain columns
+    source_table['firstname'] = source_table['firstname'].str.title()
+    source_table['lastname'] = source_table['lastname'].str.title()
+    source_table['street'] = source_table['street'].str.title()
+
+    source_table = source_table.rename(columns={'title': 'product_name',
+                                                'rate': 'rating', 'firstname': 'first_name',
+                                                'lastname': 'last_name', 'geolocation_lat': 'latitude',
+                                                'geolocation_long': 'longitude', 'date': 'sale_date'})
+
+    # Masking certain data fields in accordance with data governance requirements
+    source_table['password'] = pd.Series(MASK, index=source_table.index, dtype=STRING_DTYPE)
+    source_table['phone'] = pd.Series(MASK, index=source_table.index, dtype=STRING_DTYPE)
+
+    return dedup_rows(source_table), null_report
+
+
+def _finish_partition(source_table, first_row_id):
+    # Row identifier used to patch changed columns into the local staging snapshot.
+    source_table['row_id'] = pd.RangeIndex(first_row_id, first_row_id + len(source_table))
+    source_table['date_key'] = date_keys(source_table['sale_date'])
+
+    if KEY_MODE == 'fingerprint':
+        source_table['product_key'] = fingerprint_keys(source_table, ['product_id', 'product_name'])
+        source_table['customer_key'] = fingerprint_keys(source_table, ['customer_id', 'first_name', 'last_name'])
+        # Only rows with an actual sale get a sale_key, as with the sale_key update on staging.
+        source_table['sale_key'] = fingerprint_keys(source_table, ['sales_id', 'customer_key']).where(
+            source_table['sales_id'] > 0)
+
+    # Categoricals are only an in-memory format; the staging columns stay STRING.
+    category_cols = [col for col, dtype in STAGING_SCHEMA.items() if dtype == 'category']
+    source_table[category_cols] = source_table[category_cols].astype(STRING_DTYPE)
+    return source_table
+
+
+def _report_nulls(null_report):
+    for col, count in null_report.items():
+        if count:
+            print(f'{count} values in {col} could not be read as {STAGING_SCHEMA[col]} and were set to null.')
+
+
+# Partitioned execution (TRANSFORM_PARTITIONS > 1). stg_table_initial is split by a hash of sales_id
+# and customer_id, so exact duplicate rows always land in the same partition and de-duplication
+# stays exact. The hash is computed once, in a copy of staging clustered on the partition number, so
+# each partition read only scans its own blocks rather than hashing the whole table again, and
+# partitions are read the same way the single-pass transform reads the table. The parent reads one
+# partition at a time and hands it to a process pool, keeping at most one partition per worker in
+# flight, and appends each result to stg_table_final as it completes. Peak memory follows the
+# partition size and the transform runs on every core.
+def _partition_staging_sql(partitions):
+    return f'''
+    CREATE OR REPLACE TABLE bigdata_api.stg_table_partitioned CLUSTER BY transform_partition AS
+    SELECT *, ABS(MOD(FARM_FINGERPRINT(CONCAT(CAST(IFNULL(sales_id, -1) AS STRING), '|',
+                                              CAST(IFNULL(customer_id, -1) AS STRING))), {partitions}))
+              AS transform_partition
+    FROM bigdata_api.stg_table_initial
+    '''
+
+
+def _read_partition(partition):
+    """One partition of staging, read as the single-pass transform reads the whole table."""
+    df = backend.read_table('bigdata_api.stg_table_partitioned', filters=[('transform_partition', '=', partition)])
+    return df.drop(columns='transform_partition')
+
+
+def transform_partitioned(partitions=TRANSFORM_PARTITIONS, max_workers=TRANSFORM_WORKERS):
+    rows = 0
+    chunks = 0
+    null_report = dict.fromkeys(STAGING_SCHEMA, 0)
+
+    def write_chunk(future):
+        nonlocal rows, chunks
+        chunk, chunk_nulls = future.result()
+        chunk = _finish_partition(chunk, rows)
+        write_large_table(backend, chunk, 'bigdata_api.stg_table_final', if_exists='fail' if chunks == 0 else 'append')
+        rows += len(chunk)
+        chunks += 1
+        for col, count in chunk_nulls.items():
+            null_report[col] += count
+
+    backend.ddl(_partition_staging_sql(partitions))
+    # Forked workers inherit the loaded script; a spawned worker would re-import it and reconnect to the warehouse.
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        pending = set()
+        for partition in range(partitions):
+            pending.add(executor.submit(transform_partition, _read_partition(partition)))
+            while len(pending) >= max_workers:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    write_chunk(future)
+        for future in pending:
+            write_chunk(future)
+    backend.ddl('DROP TABLE IF EXISTS bigdata_api.stg_table_partitioned')
+
+    _report_nulls(null_report)
+    return rows
+
+
 def el_transform():
     try:
-        ds = read_gbq('bigdata_api.stg_table_initial', 'my-dw-project-01')
-        source_table = ds.copy()
-
-        # Setting column data types.
-        schema = {
-            'product_id': 'Int64',
-            'title': 'string',
-            'description': 'string',
-            'category': 'string',
-            'price': 'float',
-            'image': 'string',
-            'rate': 'float',
-            'count': 'Int64',
-            'sales_id': 'Int64',
-            'quantity': 'Int64',
-            'date': 'datetime64',
-            'month': 'Int64',
-            'year': 'Int64',
-            'customer_id': 'Int64',
-            'firstname': 'string',
-            'lastname': 'string',
-            'email': 'string',
-            'phone': 'string',
-            'username': 'string',
-            'password': 'string',
-            'city': 'string',
-            'street': 'string',
-            'number': 'Int64',
-            'zipcode': 'string',
-            'geolocation_lat': 'float',
-            'geolocation_long': 'float'
-        }
-
-        # Assigning the pre-determined data types. Any values not
-        # matching the assigned data type will be flagged as NaN/NaT.
-        for col, dtype in schema.items():
-            if dtype == 'Int64':
-                source_table[col] = pd.to_numeric(source_table[col], errors="coerce").astype('Int64')
-            elif dtype == 'float':
-                source_table[col] = pd.to_numeric(source_table[col], errors="coerce").astype('float64')
-            elif dtype == 'datetime64':
-                source_table[col] = pd.to_datetime(source_table[col], errors="coerce")
-
-        # Replacing NaN/NaT with None.
-        source_table = source_table.where(pd.notna(source_table), None)
-
-        # Applying default fills by data type groups
-        str_cols = source_table.select_dtypes(include='object').columns
-        num_cols = source_table.select_dtypes(include='number').columns
-        bool_cols = source_table.select_dtypes(include='bool').columns
-
-        source_table[str_cols] = source_table[str_cols].fillna('NA')
-        source_table[num_cols] = source_table[num_cols].fillna(0)
-        source_table[bool_cols] = source_table[bool_cols].fillna(False)
-
-        # Capitalizing the values in certain columns
-        source_table['firstname'] = source_table['firstname'].str.title()
-        source_table['lastname'] = source_table['lastname'].str.title()
-        source_table['street'] = source_table['street'].str.title()
-
-        source_table = source_table.rename(columns={'title': 'product_name',
-                                                    'rate': 'rating', 'firstname': 'first_name',
-                                                    'lastname': 'last_name', 'geolocation_lat': 'latitude',
-                                                    'geolocation_long': 'longitude', 'date': 'sale_date'})
-
-        # Masking certain data fields in accordance with data governance requirements
-        source_table['password'] = '***Masked***'
-        source_table['phone'] = '***Masked***'
-
-        source_table = source_table.drop_duplicates()
-
-        to_gbq(source_table, 'bigdata_api.stg_table_final',
-               project_id='my-dw-project-01', if_exists='fail')
-
-        print(f'Extraction to final staging table completed. {len(source_table)} rows loaded.')
-
-        # Addition of surrogate key columns to the staging table
-        try:
-            update_staging = '''
-            ALTER TABLE bigdata_api.stg_table_final
-            ADD COLUMN product_key STRING,
-            ADD COLUMN customer_key STRING,
-            ADD COLUMN date_key STRING,
-            ADD COLUMN sale_key STRING
-            '''
-
-            query_job = client.query(update_staging)
-            query_job.result()
+        if TRANSFORM_PARTITIONS > 1:
+            rows = transform_partitioned()
+        else:
+            ds = backend.read_table('bigdata_api.stg_table_initial')
+            source_table, null_report = transform_partition(ds.copy())
+            _report_nulls(null_report)
+            source_table = _finish_partition(source_table, 0)
 
-            print('Surrogate key columns added to staging.')
+            write_large_table(backend, source_table, 'bigdata_api.stg_table_final', if_exists='fail')
+            rows = len(source_table)
+        mark_snapshot_stale('bigdata_api.stg_table_final')
 
-        except Exception as error:
-            print(f'Error with creating surrogate key columns: {error}')
-            raise
+        print(f'Extraction to final staging table completed. {rows} rows loaded.')
 
     except Exception as error:
         print(f'Extraction to final staging table failed: {error}')
         raise
 
 
-# Creating the dimension and fact tables
-def create_tables():
-    try:
-        create_dim_product = '''
-        CREATE TABLE IF NOT EXISTS bigdata_api.dim_product (
-        product_key STRING DEFAULT GENERATE_UUID(),
-        product_id INT64,
-        product_name STRING,
-        description STRING,
-        category STRING,
-        image STRING,
-        rating FLOAT64
-        )'''
-
-        query_job = client.query(create_dim_product)
-        query_job.result()
-
-        create_dim_city = '''
-        CREATE TABLE IF NOT EXISTS bigdata_api.dim_city (
-        city_key STRING DEFAULT GENERATE_UUID(),
-        city STRING
-        )'''
-
-        query_job = client.query(create_dim_city)
-        query_job.result()
-
-        create_dim_customer = '''
-        CREATE TABLE IF NOT EXISTS bigdata_api.dim_customer (
-        customer_key STRING DEFAULT GENERATE_UUID(),
-        customer_id INT,
-        first_name STRING,
-        last_name STRING,
-        email STRING,
-        username STRING,
-        password STRING,
-        phone STRING,
-        street STRING,
-        number INT64,
-        zipcode STRING,
-        latitude FLOAT64,
-        longitude FLOAT64,
-        city_key STRING
-        )'''
-
-        query_job = client.query(create_dim_customer)
-        query_job.result()
-
-        create_dim_date = '''
-        CREATE TABLE IF NOT EXISTS bigdata_api.dim_date (
-        date_key STRING DEFAULT GENERATE_UUID(),
-        sale_date DATE,
-        month INT64,
-        year INT64
-        )'''
-
-        query_job = client.query(create_dim_date)
-        query_job.result()
-
-        create_fact_sale = '''
-        CREATE TABLE IF NOT EXISTS bigdata_api.fact_sale (
-        sale_key STRING DEFAULT GENERATE_UUID(),
-        sales_id INT64,
-        customer_key STRING,
-        date_key STRING
-        )'''
-
-        query_job = client.query(create_fact_sale)
-        query_job.result()
-
-        create_fact_sale_product = '''
-        CREATE TABLE IF NOT EXISTS bigdata_api.fact_sale_product (
-        product_sale_key STRING DEFAULT GENERATE_UUID(),
-        sale_key STRING,
-        product_key STRING,
-        price FLOAT64,
-        quantity INT64,
-        total_sale FLOAT64,
-        stock INT64
-        )'''
-
-        query_job = client.query(create_fact_sale_product)
-        query_job.result()
-
-        print('All target tables created successfully.')
-
-    except Exception as error:
-        print(f'Error with table creation: {error}')
-        raise
+# Dimension and fact tables, created on first use by schemas.ensure().
+TABLE_SCHEMAS = {
+    'bigdata_api.dim_product': [
+        ('product_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('product_id', 'INT64'),
+        ('product_name', 'STRING'),
+        ('description', 'STRING'),
+        ('category', 'STRING'),
+        ('image', 'STRING'),
+        ('rating', 'FLOAT64'),
+    ],
+    'bigdata_api.dim_city': [
+        ('city_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('city', 'STRING'),
+    ],
+    'bigdata_api.dim_customer': [
+        ('customer_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('customer_id', 'INT'),
+        ('first_name', 'STRING'),
+        ('last_name', 'STRING'),
+        ('email', 'STRING'),
+        ('username', 'STRING'),
+        ('password', 'STRING'),
+        ('phone', 'STRING'),
+        ('street', 'STRING'),
+        ('number', 'INT64'),
+        ('zipcode', 'STRING'),
+        ('latitude', 'FLOAT64'),
+        ('longitude', 'FLOAT64'),
+        ('city_key', 'STRING'),
+    ],
+    'bigdata_api.dim_date': [
+        ('date_key', 'INT64'),
+        ('sale_date', 'DATE'),
+        ('is_weekend', 'BOOL'),
+        ('month', 'INT64'),
+        ('year', 'INT64'),
+        ('quarter', 'INT64'),
+        ('half_year', 'INT64'),
+    ],
+    'bigdata_api.fact_sale': [
+        ('sale_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('sales_id', 'INT64'),
+        ('customer_key', 'STRING'),
+        ('date_key', 'INT64'),
+        ('sale_date', 'DATE'),
+    ],
+    'bigdata_api.fact_sale_product': [
+        ('product_sale_key', 'STRING DEFAULT GENERATE_UUID()'),
+        ('sale_key', 'STRING'),
+        ('product_key', 'STRING'),
+        ('price', 'FLOAT64'),
+        ('quantity', 'INT64'),
+        ('total_sale', 'FLOAT64'),
+        ('stock', 'INT64'),
+        ('sale_date', 'DATE'),
+    ],
+}
+# Physical layout of the fact tables: one partition per sale_date and clustering on the dim keys, so
+# BI queries and reloads only scan the days and keys they filter on. sale_date is kept on both facts
+# as the partitioning column.
+TABLE_LAYOUTS = {
+    'bigdata_api.fact_sale': {'partition_by': 'sale_date', 'cluster_by': ['customer_key']},
+    'bigdata_api.fact_sale_product': {'partition_by': 'sale_date', 'cluster_by': ['product_key', 'sale_key']},
+}
+schemas = SchemaManager(backend, TABLE_SCHEMAS, TABLE_LAYOUTS)
 
 
 # Loading the target tables.
@@ -344,13 +626,19 @@ def load_dim_product():
     table_name = 'dim_product'
 
     try:
-        dp = read_gbq('bigdata_api.stg_table_final', 'my-dw-project-01')
-        product = dp[['product_id', 'product_name', 'description', 'category', 'image', 'rating']].copy()
-        product = product.drop_duplicates(subset=['product_id', 'product_name'], keep='first')
+        schemas.ensure('bigdata_api.dim_product')
+
+        key_columns = ['product_key'] if KEY_MODE == 'fingerprint' else []
+        product = read_snapshot('bigdata_api.stg_table_final',
+                                ['product_id', 'product_name', 'description', 'category', 'image', 'rating']
+                                + key_columns)
+        seen = target_fingerprint_set(backend, 'bigdata_api.dim_product', product, ['product_id', 'product_name'])
+        product = dedup_rows(product, ['product_id', 'product_name'], seen)
 
         t1 = time()
-        to_gbq(product, 'bigdata_api.dim_product', project_id='my-dw-project-01', if_exists='append')
+        backend.write_table(product, 'bigdata_api.dim_product', if_exists='append')
         t2 = time()
+        seen.save()
 
         load_time = t2-t1
 
@@ -365,14 +653,26 @@ def load_dim_customer():
     table_name = 'dim_customer'
 
     try:
-        dc = read_gbq('bigdata_api.stg_table_final', 'my-dw-project-01')
-        customer = dc[['customer_id', 'email', 'username', 'password', 'phone', 'first_name', 'last_name',
-                   'street', 'number', 'zipcode', 'latitude', 'longitude']].copy()
-        customer = customer.drop_duplicates(subset=['customer_id', 'first_name', 'last_name'], keep='first')
+        schemas.ensure('bigdata_api.dim_customer')
+
+        key_columns = ['customer_key', 'city', 'sale_date'] if KEY_MODE == 'fingerprint' else []
+        customer = read_snapshot('bigdata_api.stg_table_final',
+                                 ['customer_id', 'email', 'username', 'password', 'phone', 'first_name',
+                                  'last_name', 'street', 'number', 'zipcode', 'latitude', 'longitude']
+                                 + key_columns)
+        if KEY_MODE == 'fingerprint':
+            # city_key follows the customer's earliest sale, as in the dim_customer update.
+            customer = customer.sort_values('sale_date', kind='stable')
+            customer['city_key'] = fingerprint_keys(customer, ['city'])
+            customer = customer.drop(columns=['city', 'sale_date'])
+        seen = target_fingerprint_set(backend, 'bigdata_api.dim_customer', customer,
+                                      ['customer_id', 'first_name', 'last_name'])
+        customer = dedup_rows(customer, ['customer_id', 'first_name', 'last_name'], seen)
 
         t1 = time()
-        to_gbq(customer, 'bigdata_api.dim_customer', project_id='my-dw-project-01', if_exists='append')
+        backend.write_table(customer, 'bigdata_api.dim_customer', if_exists='append')
         t2 = time()
+        seen.save()
 
         load_time = t2 - t1
 
@@ -387,13 +687,22 @@ def load_dim_date():
     table_name = 'dim_date'
 
     try:
-        dt = read_gbq('bigdata_api.stg_table_final', 'my-dw-project-01')
-        date = dt[['sale_date', 'month', 'year']].copy()
-        date = date.drop_duplicates(subset=['sale_date'], keep='first')
+        schemas.ensure('bigdata_api.dim_date')
+
+        sale_dates = read_snapshot('bigdata_api.stg_table_final', ['sale_date'])['sale_date'].dropna()
+        if sale_dates.empty:
+            print(f'No sales, {table_name} left as it is.')
+            return
+
+        # Only the days not in dim_date yet are kept, so the calendar grows a year at a time.
+        date = build_calendar(pd.Timestamp(sale_dates.min()), pd.Timestamp(sale_dates.max()), 'sale_date')
+        seen = target_fingerprint_set(backend, 'bigdata_api.dim_date', date, ['date_key'])
+        date = dedup_rows(date, ['date_key'], seen)
 
         t1 = time()
-        to_gbq(date, 'bigdata_api.dim_date', project_id='my-dw-project-01', if_exists='append')
+        backend.write_table(date, 'bigdata_api.dim_date', if_exists='append')
         t2 = time()
+        seen.save()
 
         load_time = t2 - t1
 
@@ -406,82 +715,71 @@ def load_dim_date():
 
 # Filling surrogate key columns with the actual surrogate keys.
 def upload_surrogate_keys():
-    try:
-        product_key = '''
-        UPDATE bigdata_api.stg_table_final AS s SET product_key = p.product_key 
-        FROM bigdata_api.dim_product AS p WHERE s.product_id = p.product_id AND
-        s.product_name = p.product_name'''
-        query_job = client.query(product_key)
-        query_job.result()
-
-        print('product_key update on staging: check.')
+    schemas.ensure('bigdata_api.dim_city', 'bigdata_api.dim_customer')
 
+    # With fingerprint keys, staging and dim_customer are already keyed,
+    # so only dim_city is left to load.
+    if KEY_MODE == 'fingerprint':
         try:
-            customer_key = '''
-            UPDATE bigdata_api.stg_table_final AS s SET customer_key = u.customer_key 
-            FROM bigdata_api.dim_customer AS u WHERE s.customer_id = u.customer_id AND
-            s.first_name = u.first_name AND s.last_name = u.last_name'''
-            query_job = client.query(customer_key)
-            query_job.result()
-
-            print('customer_key update on staging: check.')
-
-            try:
-                date_key = '''
-                UPDATE bigdata_api.stg_table_final AS s SET date_key = d.date_key 
-                FROM bigdata_api.dim_date AS d WHERE s.sale_date = d.sale_date'''
-                query_job = client.query(date_key)
-                query_job.result()
-
-                print('date_key update on staging: check.')
-
-                # Fetching surrogate keys from dim_city and loading to dim_customer.
-                try:
-                    load_dim_city = '''
-                    INSERT INTO bigdata_api.dim_city (city)
-                    SELECT DISTINCT city FROM bigdata_api.stg_table_final'''
-                    query_job = client.query(load_dim_city)
-                    query_job.result()
-
-                    print('dim_city loaded.')
-
-                    # Using a window function to filter the source table for unique records (BQ restriction)
-                    # before running the cross-table update (WHERE u.customer_id = j.customer_id)
-                    try:
-                        update_dim_customer = '''
-                        UPDATE bigdata_api.dim_customer AS u SET city_key = j.city_key
-                        FROM (
-                            SELECT * EXCEPT(rank) FROM (
-                                SELECT *, ROW_NUMBER() OVER(PARTITION BY customer_id ORDER BY sale_date) AS rank
-                                FROM bigdata_api.stg_table_final AS s
-                                JOIN bigdata_api.dim_city AS c ON s.city = c.city
-                                ) WHERE rank = 1
-                            ) AS j
-                        WHERE u.customer_id = j.customer_id
-                        '''
-                        query_job = client.query(update_dim_customer)
-                        query_job.result()
-
-                        print('dim_customer updated with city_keys.')
-
-                    except Exception as error:
-                        print(f'Error with dim_customer update: {error}')
-                        raise
-
-                except Exception as error:
-                    print(f'Error with dim_city loading: {error}')
-                    raise
-
-            except Exception as error:
-                print(f'Error with date_key update: {error}')
-                raise
+            city = read_snapshot('bigdata_api.stg_table_final', ['city'])
+            seen = target_fingerprint_set(backend, 'bigdata_api.dim_city', city, ['city'])
+            city = dedup_rows(city, ['city'], seen)
+            city['city_key'] = fingerprint_keys(city, ['city'])
+            backend.write_table(city, 'bigdata_api.dim_city', if_exists='append')
+            seen.save()
+
+            print('dim_city loaded.')
 
         except Exception as error:
-            print(f'Error with customer_key update: {error}')
+            print(f'Error with dim_city loading: {error}')
             raise
 
+        return
+
+    # Staging is keyed in one pass: the cities missing from dim_city are added and its keys copied
+    # to dim_customer, then staging is replaced by a keyed copy of itself, built with a single join
+    # against every dim. CREATE OR REPLACE swaps the table atomically, so staging is never missing,
+    # it is rewritten once, and the whole script is one round trip.
+    # The window function keeps one source row per customer (a BQ restriction on cross-table
+    # updates). Cities and keys left by an earlier run of this stage are kept or replaced, not added
+    # again, so that it can be resumed on its own.
+    try:
+        keyed = 'product_key' in (backend.table_schema('bigdata_api.stg_table_final') or {})
+        staging_columns = 's.* EXCEPT(product_key, customer_key)' if keyed else 's.*'
+        products = guard_join_sql(backend, 'bigdata_api.dim_product', ['product_id', 'product_name'],
+                                  'bigdata_api.stg_table_final', ['l.product_id', 'l.product_name'])
+        customers = guard_join_sql(backend, 'bigdata_api.dim_customer', ['customer_id', 'first_name', 'last_name'],
+                                   'bigdata_api.stg_table_final', ['l.customer_id', 'l.first_name', 'l.last_name'])
+        resolve_keys = f'''
+        INSERT INTO bigdata_api.dim_city (city)
+        SELECT DISTINCT city FROM bigdata_api.stg_table_final AS s
+        WHERE NOT EXISTS (SELECT 1 FROM bigdata_api.dim_city AS c WHERE c.city IS NOT DISTINCT FROM s.city);
+
+        UPDATE bigdata_api.dim_customer AS u SET city_key = j.city_key
+        FROM (
+            SELECT * EXCEPT(rank) FROM (
+                SELECT *, ROW_NUMBER() OVER(PARTITION BY customer_id ORDER BY sale_date) AS rank
+                FROM bigdata_api.stg_table_final AS s
+                JOIN bigdata_api.dim_city AS c ON s.city = c.city
+                ) WHERE rank = 1
+            ) AS j
+        WHERE u.customer_id = j.customer_id;
+
+        CREATE OR REPLACE TABLE bigdata_api.stg_table_final AS
+        SELECT {staging_columns}, p.product_key, u.customer_key
+        FROM bigdata_api.stg_table_final AS s
+        LEFT JOIN {products} AS p ON s.product_id = p.product_id AND s.product_name = p.product_name
+        LEFT JOIN {customers} AS u ON s.customer_id = u.customer_id AND
+        s.first_name = u.first_name AND s.last_name = u.last_name
+        '''
+        backend.ddl(resolve_keys)
+        # The keyed copy keeps every staging row and its row_id, so only the key columns are read again.
+        mark_snapshot_stale('bigdata_api.stg_table_final', ['product_key', 'customer_key'])
+
+        print('dim_city loaded, dim_customer updated with city_keys and staging keyed.')
+
     except Exception as error:
-        print(f'Error with product_key update: {error}')
+        print(f'Error with surrogate key resolution: {error}')
         raise
 
 
@@ -489,18 +787,27 @@ def load_fact_sale():
     table_name = 'fact_sale'
 
     try:
-        df = read_gbq('bigdata_api.stg_table_final', 'my-dw-project-01')
-        fact = df[['sales_id', 'customer_key', 'date_key']].copy()
+        schemas.ensure('bigdata_api.fact_sale')
 
-        fact = fact.drop_duplicates(subset=['sales_id', 'customer_key'], keep='first')
+        # In order to ensure unique sales data on this fact table, as required,
+        # all rows where a sale is not associated with any product are filtered out on read.
+        # In incremental mode only sales after the last loaded one are read.
+        key_columns = ['sale_key'] if KEY_MODE == 'fingerprint' else []
+        fact = read_snapshot('bigdata_api.stg_table_final',
+                             ['sales_id', 'customer_key', 'date_key', 'sale_date'] + key_columns,
+                             filters=watermark_filters('bigdata_api.fact_sale', 'sale_date', 'sales_id',
+                                                       [('sales_id', '>', 0)]))
 
-        # Finally, in order to ensure unique sales data on this fact table, as required,
-        # all rows where a sale is not associated with any product should be removed.
-        fact = fact[fact['sales_id'] > 0]
+        fact = fact.drop_duplicates(subset=['sales_id', 'customer_key'], keep='first')
+        batch = fact[['sale_date', 'sales_id']]
+        fact['sale_date'] = pd.to_datetime(fact['sale_date']).dt.date
 
+        # A full load rewrites the partitions it covers; an incremental batch is added to them.
         t1 = time()
-        to_gbq(fact, 'bigdata_api.fact_sale', project_id='my-dw-project-01', if_exists='append')
+        backend.write_partitions(fact, 'bigdata_api.fact_sale', 'sale_date',
+                                 if_exists='replace' if LOAD_MODE == 'full' else 'append')
         t2 = time()
+        save_watermark('bigdata_api.fact_sale', batch, 'sale_date', 'sales_id')
 
         load_time = t2 - t1
 
@@ -514,31 +821,37 @@ def load_fact_sale():
 def load_fact_sale_product():
     table_name = 'fact_sale_product'
 
-    # First, load fact table's surrogate key to staging, this way all surrogate keys
-    # are complete in staging.
     try:
-        sale_key = '''
-        UPDATE bigdata_api.stg_table_final AS s SET sale_key = f.sale_key 
-        FROM bigdata_api.fact_sale AS f WHERE s.sales_id = f.sales_id AND
-        s.customer_key = f.customer_key'''
-        query_job = client.query(sale_key)
-        query_job.result()
-
-        print('sale_key updated successfully on fact_sale.')
-
-        # Then load all required data from staging to fact_product_sales
+        schemas.ensure('bigdata_api.fact_sale_product')
+
+        # Sale keys are taken from fact_sale by (sales_id, customer_key). Fingerprint sale_keys are
+        # already on staging.
+        key_columns = ['sale_key'] if KEY_MODE == 'fingerprint' else ['customer_key']
+        fact = read_snapshot('bigdata_api.stg_table_final',
+                             ['product_key', 'price', 'quantity', 'count', 'sale_date', 'sales_id'] + key_columns,
+                             filters=watermark_filters('bigdata_api.fact_sale_product', 'sale_date', 'sales_id'))
+        if KEY_MODE != 'fingerprint':
+            sale_keys = backend.read_table('bigdata_api.fact_sale', ['sales_id', 'customer_key', 'sale_key'])
+            sale_keys = guard_join('bigdata_api.fact_sale', sale_keys, ['sales_id', 'customer_key'], fact)
+            fact = fact.merge(sale_keys, how='left', on=['sales_id', 'customer_key'], validate='many_to_one')
+        fact = fact[['sale_key', 'product_key', 'price', 'quantity', 'count', 'sale_date', 'sales_id']]
+
+        # Then load all required data to fact_product_sales
         try:
-            df = read_gbq('bigdata_api.stg_table_final', 'my-dw-project-01')
-            fact = df[['sale_key', 'product_key', 'price', 'quantity', 'count']].copy()
             fact = fact.rename(columns={'count': 'stock'})
             fact['total_sale'] = fact['price'] * fact['quantity']
 
             # All rows where a sale_key is blank should be removed.
             fact = fact[fact['sale_key'].notna()]
+            batch = fact[['sale_date', 'sales_id']]
+            fact = fact.drop(columns=['sales_id'])
+            fact['sale_date'] = pd.to_datetime(fact['sale_date']).dt.date
 
             t1 = time()
-            to_gbq(fact, 'bigdata_api.fact_sale_product', project_id='my-dw-project-01', if_exists='append')
+            backend.write_partitions(fact, 'bigdata_api.fact_sale_product', 'sale_date',
+                                     if_exists='replace' if LOAD_MODE == 'full' else 'append')
             t2 = time()
+            save_watermark('bigdata_api.fact_sale_product', batch, 'sale_date', 'sales_id')
 
             load_time = t2 - t1
 
@@ -549,22 +862,123 @@ def load_fact_sale_product():
             raise
 
     except Exception as error:
-        print(f'Error with sale_key update: {error}')
+        print(f'Error with sale_key lookup: {error}')
         raise
 
 
-extract_product()
-extract_sales()
-extract_user()
-
-create_combo_staging()
-el_transform()
-create_tables()
-
-load_dim_product()
-load_dim_customer()
-load_dim_date()
-upload_surrogate_keys()
-
-load_fact_sale()
-load_fact_sale_product()
\ No newline at end of file
+CHECKPOINT_MODE = os.environ.get('CHECKPOINT_MODE', 'resume')
+RUN_MANIFEST_FILE = 'run_manifest.json'
+_manifest_lock = threading.Lock()
+
+
+# Run manifest, used when CHECKPOINT_MODE is 'resume'. Each completed stage is recorded with its
+# input fingerprint and the row count of each output table. The fingerprint covers the stage
+# function's source, the version of every source blob the stage reads, and when each stage it
+# depends on last completed, so a stage that reruns makes everything downstream of it stale. A
+# rerun skips every stage whose fingerprint still matches and whose outputs still hold the recorded
+# rows, and resumes at the first failed or stale stage. Tables a stage builds from scratch
+# ('rebuilds') are dropped before it runs again, so its 'fail' writes and raw loads start clean.
+def _load_run_manifest():
+    if not os.path.exists(RUN_MANIFEST_FILE):
+        return {}
+    with open(RUN_MANIFEST_FILE) as f:
+        return json.load(f)
+
+
+def _save_run_manifest(manifest):
+    with open(RUN_MANIFEST_FILE + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(RUN_MANIFEST_FILE + '.tmp', RUN_MANIFEST_FILE)
+
+
+def stage_fingerprint(stage, dependencies, manifest):
+    inputs = {
+        'code': hashlib.sha256(inspect.getsource(stage['func']).encode()).hexdigest(),
+        'sources': {source: backend.source_version(source) for source in stage.get('sources', [])},
+        'upstream': {name: manifest.get(name, {}).get('completed_at') for name in sorted(dependencies)},
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def _output_rows(stage):
+    return {table: backend.row_count(table) for table in stage['outputs']}
+
+
+# Runs the stages on the shared scheduler, skipping up-to-date stages as recorded in the run manifest.
+def run_stages(stages, max_workers=STAGE_WORKERS):
+    if CHECKPOINT_MODE != 'resume':
+        return schedule_stages(stages, lambda stage, dependencies: stage['func'](), max_workers)
+    manifest = _load_run_manifest()
+
+    def run_stage(stage, dependencies):
+        name = stage['name']
+        with _manifest_lock:
+            fingerprint = stage_fingerprint(stage, dependencies, manifest)
+            entry = manifest.get(name)
+        if entry and entry['fingerprint'] == fingerprint and entry['rows'] == _output_rows(stage):
+            current_span().attributes['resumed'] = True
+            print(f'Stage {name} is up to date and was not run again.')
+            return
+
+        # The old record goes before the stage runs, so a failure part way leaves it stale.
+        with _manifest_lock:
+            manifest.pop(name, None)
+            _save_run_manifest(manifest)
+        for table in stage.get('rebuilds', []):
+            backend.ddl(f'DROP TABLE IF EXISTS {table}')
+            mark_snapshot_stale(table)
+
+        stage['func']()
+
+        rows = _output_rows(stage)
+        with _manifest_lock:
+            manifest[name] = {'fingerprint': fingerprint, 'rows': rows, 'run_id': TRACE_RUN_ID,
+                              'completed_at': time()}
+            _save_run_manifest(manifest)
+
+    return schedule_stages(stages, run_stage, max_workers)
+
+
+# The three extracts are independent and run concurrently, as do the three dim loads. sources are the
+# blobs a stage reads, and rebuilds the tables it creates from scratch (see the run manifest above).
+STAGES = [
+    {'name': 'extract_product', 'func': extract_product, 'inputs': [], 'sources': [PRODUCT_SOURCE],
+     'outputs': ['bigdata_api.prod_data_raw', 'bigdata_api.prod_data_clean'],
+     'rebuilds': ['bigdata_api.prod_data_raw', 'bigdata_api.prod_data_clean']},
+    {'name': 'extract_sales', 'func': extract_sales, 'inputs': [], 'sources': [SALES_SOURCE],
+     'outputs': ['bigdata_api.sales_data_raw', 'bigdata_api.sales_data_clean'],
+     'rebuilds': ['bigdata_api.sales_data_raw', 'bigdata_api.sales_data_clean']},
+    {'name': 'extract_user', 'func': extract_user, 'inputs': [], 'sources': [USER_SOURCE],
+     'outputs': ['bigdata_api.user_data_raw', 'bigdata_api.user_data_clean'],
+     'rebuilds': ['bigdata_api.user_data_raw', 'bigdata_api.user_data_clean']},
+    {'name': 'create_combo_staging', 'func': create_combo_staging,
+     'inputs': ['bigdata_api.prod_data_clean', 'bigdata_api.sales_data_clean', 'bigdata_api.user_data_clean'],
+     'outputs': ['bigdata_api.stg_table_initial'], 'rebuilds': ['bigdata_api.stg_table_initial']},
+    {'name': 'el_transform', 'func': el_transform, 'inputs': ['bigdata_api.stg_table_initial'],
+     'outputs': ['bigdata_api.stg_table_final'], 'rebuilds': ['bigdata_api.stg_table_final']},
+    {'name': 'load_dim_product', 'func': load_dim_product, 'inputs': ['bigdata_api.stg_table_final'],
+     'outputs': ['bigdata_api.dim_product']},
+    {'name': 'load_dim_customer', 'func': load_dim_customer, 'inputs': ['bigdata_api.stg_table_final'],
+     'outputs': ['bigdata_api.dim_customer']},
+    {'name': 'load_dim_date', 'func': load_dim_date, 'inputs': ['bigdata_api.stg_table_final'],
+     'outputs': ['bigdata_api.dim_date']},
+    {'name': 'upload_surrogate_keys', 'func': upload_surrogate_keys,
+     'inputs': ['bigdata_api.dim_product', 'bigdata_api.dim_customer'],
+     'outputs': ['bigdata_api.stg_table_final', 'bigdata_api.dim_city', 'bigdata_api.dim_customer']},
+    {'name': 'load_fact_sale', 'func': load_fact_sale,
+     'inputs': ['bigdata_api.stg_table_final', 'bigdata_api.dim_date'], 'outputs': ['bigdata_api.fact_sale']},
+    {'name': 'load_fact_sale_product', 'func': load_fact_sale_product,
+     'inputs': ['bigdata_api.stg_table_final', 'bigdata_api.fact_sale'],
+     'outputs': ['bigdata_api.fact_sale_product']},
+]
+
+if __name__ == '__main__':
+    if DRY_RUN:
+        estimate_pipeline_cost(STAGES)
+    else:
+        stage_status = run_stages(STAGES)
+        print_job_report()
+
+        # Errors are called out rather than absorbed, as in the stages themselves.
+        if any(state != 'done' for state in stage_status.values()):
+            raise RuntimeError(f'Pipeline did not complete: {stage_status}')
\ No newline at end of file
@@ -0,0 +1,190 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+CHUNK_ROWS = 1_000_000
+FIRST_NAMES = np.array(['john', 'mary', 'ahmed', 'li', 'olga', 'kemi', 'carlos', 'anna', 'david', 'yuki'])
+LAST_NAMES = np.array(['smith', 'okafor', 'garcia', 'chen', 'ivanova', 'muller', 'khan', 'silva', 'brown', 'sato'])
+COUNTRIES = np.array(['USA', 'UK', 'Germany', 'Nigeria', 'Japan'])
+CITIES = np.array([['New York', 'Chicago'], ['London', 'Leeds'], ['Berlin', 'Hamburg'], ['Lagos', 'Abuja'],
+                   ['Tokyo', 'Osaka']])
+CATEGORIES = np.array(['electronics', 'jewelery', "men's clothing", "women's clothing", 'books'])
+STREETS = np.array(['main street', 'high street', 'park avenue', 'church road', 'station road'])
+
+
+# Synthetic retail data in the shapes the pipelines read. Migration 1 takes three CSV extracts
+# (customers, products and transactions, each with a leading index column) and Migration 2 takes
+# three NDJSON blobs (products with a nested rating, sales with a products[] array, users with nested
+# name and address.geolocation objects). rows is the number of transactions / sale line items,
+# from 10k up to 100M; customers and products scale with it. Files are written in chunks, so memory
+# use does not grow with the scale, and a fixed seed gives the same files on every run.
+def entity_counts(rows):
+    return {'customers': max(rows // 10, 100), 'products': max(rows // 100, 50), 'sales': max(rows // 3, 1)}
+
+
+def _chunks(total):
+    for start in range(0, total, CHUNK_ROWS):
+        yield start, min(start + CHUNK_ROWS, total)
+
+
+def _write_csv(frames, path):
+    with open(path, 'w', newline='') as f:
+        for position, frame in enumerate(frames):
+            frame.to_csv(f, header=position == 0)
+
+
+def _write_ndjson(frames, path):
+    with open(path, 'w') as f:
+        for frame in frames:
+            # Each chunk is newline-terminated already, so chunks follow one another without blank lines.
+            chunk = frame.to_json(orient='records', lines=True)
+            f.write(chunk if chunk.endswith('\n') else chunk + '\n')
+
+
+def _customers(rng, counts):
+    for start, end in _chunks(counts['customers']):
+        ids = np.arange(start + 1, end + 1)
+        country = rng.integers(0, len(COUNTRIES), len(ids))
+        yield pd.DataFrame({
+            'CustomerID': ids,
+            'FirstName': FIRST_NAMES[rng.integers(0, len(FIRST_NAMES), len(ids))],
+            'LastName': LAST_NAMES[rng.integers(0, len(LAST_NAMES), len(ids))],
+            'Email': [f'customer{i}@example.com' for i in ids],
+            'Phone': rng.integers(10 ** 9, 10 ** 10, len(ids)).astype(str),
+            'Address': STREETS[rng.integers(0, len(STREETS), len(ids))],
+            'City': CITIES[country, rng.integers(0, CITIES.shape[1], len(ids))],
+            'Country': COUNTRIES[country],
+            'Age': rng.integers(18, 80, len(ids)),
+            'Gender': np.where(rng.random(len(ids)) < 0.5, 'Male', 'Female'),
+        }, index=ids - 1)
+
+
+def _products(rng, counts):
+    for start, end in _chunks(counts['products']):
+        ids = np.arange(start + 1, end + 1)
+        yield pd.DataFrame({
+            'ProductID': ids,
+            'ProductName': [f'Product {i}' for i in ids],
+            'Category': CATEGORIES[rng.integers(0, len(CATEGORIES), len(ids))],
+            'Price': rng.uniform(1, 500, len(ids)).round(2),
+        }, index=ids - 1)
+
+
+def _transactions(rng, rows, counts):
+    start_time = np.datetime64('2023-01-01T00:00:00')
+    for start, end in _chunks(rows):
+        ids = np.arange(start + 1, end + 1)
+        seconds = np.sort(rng.integers(0, 365 * 24 * 3600, len(ids)))
+        yield pd.DataFrame({
+            'TransactionID': ids,
+            'CustomerID': rng.integers(1, counts['customers'] + 1, len(ids)),
+            'ProductID': rng.integers(1, counts['products'] + 1, len(ids)),
+            'Timestamp': (start_time + seconds.astype('timedelta64[s]')).astype(str),
+            'Quantity': rng.integers(1, 10, len(ids)),
+        }, index=ids - 1)
+
+
+def generate_migration_1(rows, out_dir, seed=0):
+    """Writes customers_df.csv, products_df.csv and transactions_df.csv to out_dir/01 Retail."""
+    rng = np.random.default_rng(seed)
+    counts = entity_counts(rows)
+    retail_dir = os.path.join(out_dir, '01 Retail')
+    os.makedirs(retail_dir, exist_ok=True)
+
+    _write_csv(_customers(rng, counts), os.path.join(retail_dir, 'customers_df.csv'))
+    _write_csv(_products(rng, counts), os.path.join(retail_dir, 'products_df.csv'))
+    _write_csv(_transactions(rng, rows, counts), os.path.join(retail_dir, 'transactions_df.csv'))
+
+
+def _product_blobs(rng, counts):
+    for start, end in _chunks(counts['products']):
+        ids = np.arange(start + 1, end + 1)
+        rates = rng.uniform(1, 5, len(ids)).round(1)
+        stock = rng.integers(0, 1000, len(ids))
+        yield pd.DataFrame({
+            'id': ids,
+            'title': [f'Product {i}' for i in ids],
+            'price': rng.uniform(1, 500, len(ids)).round(2),
+            'description': [f'Description of product {i}' for i in ids],
+            'category': CATEGORIES[rng.integers(0, len(CATEGORIES), len(ids))],
+            'image': [f'https://example.com/img/{i}.jpg' for i in ids],
+            'rating': [{'rate': rate, 'count': int(count)} for rate, count in zip(rates, stock)],
+        })
+
+
+def _sales_blobs(rng, rows, counts):
+    # Line items are spread over sales so that the total number of products[] entries is rows.
+    sales = counts['sales']
+    lines_per_sale = np.full(sales, rows // sales)
+    lines_per_sale[:rows % sales] += 1
+    start_day = np.datetime64('2020-01-01')
+
+    for start, end in _chunks(sales):
+        ids = np.arange(start + 1, end + 1)
+        lines = lines_per_sale[start:end]
+        product_ids = rng.integers(1, counts['products'] + 1, lines.sum())
+        quantities = rng.integers(1, 10, lines.sum())
+        offsets = np.concatenate([[0], np.cumsum(lines)])
+        days = start_day + rng.integers(0, 365, len(ids)).astype('timedelta64[D]')
+        yield pd.DataFrame({
+            'id': ids,
+            'userId': rng.integers(1, counts['customers'] + 1, len(ids)),
+            'date': [f'{day}T00:00:00.000Z' for day in days.astype(str)],
+            'products': [[{'productId': int(p), 'quantity': int(q)}
+                          for p, q in zip(product_ids[start:end], quantities[start:end])]
+                         for start, end in zip(offsets[:-1], offsets[1:])],
+        })
+
+
+def _user_blobs(rng, counts):
+    for start, end in _chunks(counts['customers']):
+        ids = np.arange(start + 1, end + 1)
+        country = rng.integers(0, len(COUNTRIES), len(ids))
+        cities = CITIES[country, rng.integers(0, CITIES.shape[1], len(ids))]
+        first = FIRST_NAMES[rng.integers(0, len(FIRST_NAMES), len(ids))]
+        last = LAST_NAMES[rng.integers(0, len(LAST_NAMES), len(ids))]
+        lat = rng.uniform(-90, 90, len(ids)).round(4)
+        long = rng.uniform(-180, 180, len(ids)).round(4)
+        yield pd.DataFrame({
+            'id': ids,
+            'email': [f'user{i}@example.com' for i in ids],
+            'username': [f'user{i}' for i in ids],
+            'password': [f'pw{i}' for i in ids],
+            'name': [{'firstname': f, 'lastname': l} for f, l in zip(first, last)],
+            'phone': rng.integers(10 ** 9, 10 ** 10, len(ids)).astype(str),
+            'address': [{'city': city, 'street': street, 'number': int(number), 'zipcode': f'{zipcode:05d}',
+                         'geolocation': {'lat': str(la), 'long': str(lo)}}
+                        for city, street, number, zipcode, la, lo
+                        in zip(cities, STREETS[rng.integers(0, len(STREETS), len(ids))],
+                               rng.integers(1, 9999, len(ids)), rng.integers(0, 99999, len(ids)), lat, long)],
+        })
+
+
+def generate_migration_2(rows, out_dir, seed=0):
+    """Writes the three NDJSON blobs to out_dir/bucket/my-dw-bucket-02, where the DuckDB backend looks for gs://
+    sources."""
+    rng = np.random.default_rng(seed)
+    counts = entity_counts(rows)
+    bucket_dir = os.path.join(out_dir, 'bucket', 'my-dw-bucket-02')
+    os.makedirs(bucket_dir, exist_ok=True)
+
+    _write_ndjson(_product_blobs(rng, counts), os.path.join(bucket_dir, 'bq_source_data_04.json'))
+    _write_ndjson(_sales_blobs(rng, rows, counts), os.path.join(bucket_dir, 'bq_source_data_05.json'))
+    _write_ndjson(_user_blobs(rng, counts), os.path.join(bucket_dir, 'bq_source_data_06.json'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates synthetic retail data for both migrations.')
+    parser.add_argument('--rows', type=int, default=10_000, help='transactions / sale line items (10k to 100M)')
+    parser.add_argument('--out', default='.', help='directory to write the data to')
+    parser.add_argument('--migration', choices=['1', '2', 'all'], default='all')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.migration in ('1', 'all'):
+        generate_migration_1(args.rows, args.out, args.seed)
+    if args.migration in ('2', 'all'):
+        generate_migration_2(args.rows, args.out, args.seed)
+
+    print(f'Synthetic data for {args.rows} rows written to {args.out}.')
@@ -0,0 +1,146 @@
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import uuid
+from datetime import datetime, timezone
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+PIPELINES = {
+    'migration-1': ('1', os.path.join(ROOT, '01 Migration 1', '03 data pipeline.py')),
+    'migration-1-modified': ('1', os.path.join(ROOT, '01 Migration 1', '05 data pipeline (modified).py')),
+    'migration-2': ('2', os.path.join(ROOT, '02 Migration 2', '03 data pipeline.py')),
+}
+SCALES = [10_000, 100_000, 1_000_000, 10_000_000, 100_000_000]
+RESULTS_FILE = os.path.join(HERE, 'results.jsonl')
+WORK_DIR = os.path.join(HERE, 'work')
+
+
+def _load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that process pool workers can find the module's functions by name.
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux. It is the high-water mark of the whole process so far,
+    # so it is read as each stage ends and a stage's value is the peak up to and including that stage.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _stage_rows(backend, outputs):
+    rows = 0
+    for table in outputs:
+        try:
+            rows += int(backend.query(f'SELECT COUNT(*) AS n FROM {table}')['n'].iloc[0])
+        except Exception:
+            pass
+    return rows
+
+
+# One (pipeline, scale) run in a fresh interpreter, so peak RSS belongs to that run alone. The
+# data is generated into its own work directory, the pipeline runs there against the local
+# DuckDB backend, and each stage is timed in order. rows is the row count of the tables a stage
+# writes once it finishes.
+def run_worker(pipeline, rows, run_id, results_file, seed):
+    migration, script = PIPELINES[pipeline]
+    work_dir = os.path.join(WORK_DIR, run_id, f'{pipeline}-{rows}')
+    os.makedirs(work_dir, exist_ok=True)
+
+    generator = _load_module('data_generator', os.path.join(HERE, '02 data generator.py'))
+    t0 = perf_counter()
+    getattr(generator, f'generate_migration_{migration}')(rows, work_dir, seed)
+    generate_seconds = perf_counter() - t0
+    generate_rss_mb = _peak_rss_mb()
+
+    os.environ['PIPELINE_BACKEND'] = 'duckdb'
+    os.environ['DUCKDB_PATH'] = 'warehouse.duckdb'
+    os.chdir(work_dir)
+    module = _load_module('pipeline', script)
+    # Imported once the pipeline has put the repository root on sys.path, and after the settings above.
+    from pipeline_common import Span
+
+    records = [{'stage': 'generate_data', 'status': 'done', 'seconds': generate_seconds, 'rows': rows,
+                'peak_rss_mb': generate_rss_mb}]
+    for stage in module.STAGES:
+        t0 = perf_counter()
+        try:
+            with Span(stage['name'], 'stage'):
+                stage['func']()
+            status = 'done'
+        except Exception as e:
+            status = f'failed: {e}'
+        seconds = perf_counter() - t0
+        peak_rss_mb = _peak_rss_mb()
+        records.append({'stage': stage['name'], 'status': status, 'seconds': seconds,
+                        'rows': _stage_rows(module.backend, stage['outputs']), 'peak_rss_mb': peak_rss_mb})
+        if status != 'done':
+            break
+
+    recorded_at = datetime.now(timezone.utc).isoformat()
+    with open(results_file, 'a') as f:
+        for record in records:
+            record.update({'run_id': run_id, 'pipeline': pipeline, 'scale': rows, 'recorded_at': recorded_at,
+                           'rows_per_second': record['rows'] / record['seconds'] if record['seconds'] else None})
+            f.write(json.dumps(record) + '\n')
+
+
+def run_suite(pipelines, scales, run_id, results_file, seed):
+    for pipeline in pipelines:
+        for rows in scales:
+            print(f'{run_id}: {pipeline} at {rows} rows')
+            subprocess.run([sys.executable, __file__, '--worker', '--pipeline', pipeline, '--scales', str(rows),
+                            '--run-id', run_id, '--results', results_file, '--seed', str(seed)], check=False)
+
+
+def _read_results(results_file, run_id):
+    with open(results_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return {(r['pipeline'], r['scale'], r['stage']): r for r in records if r['run_id'] == run_id}
+
+
+def compare_runs(results_file, run_a, run_b):
+    """Prints seconds, rows/s and peak RSS per stage for two runs side by side."""
+    a, b = _read_results(results_file, run_a), _read_results(results_file, run_b)
+    print(f"{'pipeline':<22}{'scale':>12}  {'stage':<28}{'sec A':>10}{'sec B':>10}{'speedup':>9}"
+          f"{'rows/s B':>14}{'rss A MB':>10}{'rss B MB':>10}")
+    for key in sorted(set(a) | set(b), key=lambda k: (k[0], k[1])):
+        ra, rb = a.get(key, {}), b.get(key, {})
+        sec_a, sec_b = ra.get('seconds'), rb.get('seconds')
+        speedup = f'{sec_a / sec_b:.2f}x' if sec_a and sec_b else '-'
+        sec_a, sec_b = (float('nan') if sec is None else sec for sec in (sec_a, sec_b))
+        print(f"{key[0]:<22}{key[1]:>12}  {key[2]:<28}{sec_a:>10.2f}{sec_b:>10.2f}"
+              f"{speedup:>9}{rb.get('rows_per_second') or 0:>14.0f}"
+              f"{ra.get('peak_rss_mb') or 0:>10.0f}{rb.get('peak_rss_mb') or 0:>10.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times each pipeline stage at each data scale.')
+    parser.add_argument('--pipeline', action='append', choices=sorted(PIPELINES),
+                        help='pipeline to benchmark, repeatable (default: all)')
+    parser.add_argument('--scales', default=','.join(str(s) for s in SCALES[:3]),
+                        help='comma-separated row counts, e.g. 10000,1000000,100000000')
+    parser.add_argument('--run-id', default=None)
+    parser.add_argument('--results', default=RESULTS_FILE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', nargs=2, metavar=('RUN_A', 'RUN_B'))
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_runs(args.results, *args.compare)
+    elif args.worker:
+        run_worker(args.pipeline[0], int(args.scales), args.run_id, args.results, args.seed)
+    else:
+        run_id = args.run_id or datetime.now().strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+        run_suite(args.pipeline or sorted(PIPELINES), [int(s) for s in args.scales.split(',')],
+                  run_id, args.results, args.seed)
+        print(f'Results for run {run_id} appended to {args.results}.')
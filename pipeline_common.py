@@ -0,0 +1,1324 @@
+# Code shared by the Migration 1 and Migration 2 pipelines. The pipelines are standalone scripts in
+# folders whose names cannot be imported, so each script puts the repository root on sys.path and
+# imports what it uses from here. Settings are read from the environment once, on first import.
+import json
+import os
+import re
+import resource
+import tempfile
+import threading
+import uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from google.cloud import storage
+from pandas_gbq import to_gbq
+from time import perf_counter, time
+
+TRACE_FILE = os.environ.get('TRACE_FILE', 'trace.jsonl')
+TRACE_PROM_FILE = os.environ.get('TRACE_PROM_FILE', '')
+TRACE_RUN_ID = os.environ.get('TRACE_RUN_ID', uuid.uuid4().hex)
+JOB_STATS_FILE = os.environ.get('JOB_STATS_FILE', 'jobs.jsonl')
+DRY_RUN = os.environ.get('DRY_RUN', '0') == '1'
+USD_PER_TIB_BILLED = 6.25
+PARQUET_FILE_MB = int(os.environ.get('PARQUET_FILE_MB', '128'))
+PARQUET_COMPRESSION = 'zstd'
+LOAD_WORKERS = 8
+PIPELINE_BACKEND = os.environ.get('PIPELINE_BACKEND', 'bigquery')
+DUCKDB_PATH = os.environ.get('DUCKDB_PATH', 'warehouse.duckdb')
+LOCAL_BUCKET_DIR = os.environ.get('LOCAL_BUCKET_DIR', 'bucket')
+READ_STREAMS = 4
+WRITE_MODE = os.environ.get('WRITE_MODE', 'dataframe')
+JOIN_GUARD_MODE = os.environ.get('JOIN_GUARD_MODE', 'error')
+JOIN_GUARD_REPORT_KEYS = 10
+STAGE_WORKERS = 4
+LOAD_MODE = os.environ.get('LOAD_MODE', 'full')
+WATERMARK_FILE = 'watermarks.json'
+DEDUP_DIR = 'dedup'
+DEDUP_MODE = os.environ.get('DEDUP_MODE', 'exact')
+DEDUP_BITS = int(os.environ.get('DEDUP_BITS', '64'))
+DEDUP_ERROR_RATE = float(os.environ.get('DEDUP_ERROR_RATE', '0.001'))
+DEDUP_CAPACITY = int(os.environ.get('DEDUP_CAPACITY', '10000000'))
+FINGERPRINT_128 = np.dtype([('hi', '<u8'), ('lo', '<u8')])
+KEY_INDEX_DIR = 'key_index'
+SAMPLE_PERCENT = float(os.environ.get('SAMPLE_PERCENT', '100'))
+SAMPLE_BUCKETS = 10000
+# Knuth's multiplicative hash constant, reduced mod SAMPLE_BUCKETS so that id * multiplier cannot overflow.
+SAMPLE_MULTIPLIER = 2654435761 % SAMPLE_BUCKETS
+RAW_SAMPLE_ROWS = 1000
+RAW_INDEX_COLUMN = '_index'
+
+
+# Tracing. Every stage and every warehouse call runs inside a span, and each span is written to
+# TRACE_FILE as one JSON line when it ends. The line holds the span's duration, rows read and
+# written, the deep memory usage of the DataFrames it moved, the process peak RSS and its parent
+# span. Spans nest per thread, so a warehouse call records the stage that made it as its parent and
+# adds its rows and bytes to that stage's totals. With TRACE_PROM_FILE set, running totals per span
+# are also written in the Prometheus textfile format (for node_exporter's textfile collector).
+_trace_local = threading.local()
+_trace_lock = threading.Lock()
+_trace_totals = {}
+
+
+def _span_stack():
+    if not hasattr(_trace_local, 'stack'):
+        _trace_local.stack = []
+    return _trace_local.stack
+
+
+def current_span():
+    stack = _span_stack()
+    return stack[-1] if stack else None
+
+
+def in_current_span(func):
+    """Wraps func so that spans it opens on a pool thread nest under the caller's current span."""
+    parent = current_span()
+
+    def run(*args, **kwargs):
+        stack = _span_stack()
+        stack.append(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+    return run
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _write_prometheus_textfile():
+    lines = []
+    for metric, help_text, field in [
+        ('pipeline_span_calls_total', 'Spans completed.', 'calls'),
+        ('pipeline_span_errors_total', 'Spans that raised.', 'errors'),
+        ('pipeline_span_seconds_total', 'Wall time spent in spans.', 'seconds'),
+        ('pipeline_span_rows_in_total', 'Rows read within spans.', 'rows_in'),
+        ('pipeline_span_rows_out_total', 'Rows written within spans.', 'rows_out'),
+        ('pipeline_span_bytes_total', 'Deep memory usage of DataFrames moved within spans.', 'bytes'),
+    ]:
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+        lines += [f'{metric}{{kind="{kind}",span="{name}"}} {totals[field]}'
+                  for (kind, name), totals in sorted(_trace_totals.items())]
+    lines += ['# HELP pipeline_peak_rss_bytes Process peak resident set size.',
+              '# TYPE pipeline_peak_rss_bytes gauge', f'pipeline_peak_rss_bytes {_peak_rss_bytes()}']
+
+    # Written to a temporary file and renamed, so the collector never reads a partial file.
+    with open(TRACE_PROM_FILE + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(TRACE_PROM_FILE + '.tmp', TRACE_PROM_FILE)
+
+
+class Span:
+    def __init__(self, name, kind, **attributes):
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.span_id = uuid.uuid4().hex[:16]
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes = 0
+
+    def record(self, rows_in=0, rows_out=0, df=None, nbytes=0):
+        if df is not None:
+            nbytes += int(df.memory_usage(deep=True).sum())
+        with _trace_lock:
+            self.rows_in += rows_in
+            self.rows_out += rows_out
+            self.bytes += nbytes
+
+    def __enter__(self):
+        self.parent = current_span()
+        _span_stack().append(self)
+        self.started_at = time()
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = perf_counter() - self.t0
+        _span_stack().pop()
+        if self.parent is not None:
+            self.parent.record(self.rows_in, self.rows_out, nbytes=self.bytes)
+
+        event = {'run_id': TRACE_RUN_ID, 'span_id': self.span_id, 'name': self.name, 'kind': self.kind,
+                 'parent_id': self.parent.span_id if self.parent else None,
+                 'parent': self.parent.name if self.parent else None,
+                 'started_at': self.started_at, 'duration_s': round(duration, 6),
+                 'rows_in': self.rows_in, 'rows_out': self.rows_out, 'bytes': self.bytes,
+                 'peak_rss_bytes': _peak_rss_bytes(), 'status': 'error' if exc_type else 'ok',
+                 **self.attributes}
+        if exc_type:
+            event['error'] = str(exc)
+
+        with _trace_lock:
+            with open(TRACE_FILE, 'a') as f:
+                f.write(json.dumps(event, default=str) + '\n')
+            totals = _trace_totals.setdefault((self.kind, self.name), dict.fromkeys(
+                ['calls', 'errors', 'seconds', 'rows_in', 'rows_out', 'bytes'], 0))
+            totals['calls'] += 1
+            totals['errors'] += 1 if exc_type else 0
+            totals['seconds'] += duration
+            totals['rows_in'] += self.rows_in
+            totals['rows_out'] += self.rows_out
+            totals['bytes'] += self.bytes
+            if TRACE_PROM_FILE:
+                _write_prometheus_textfile()
+        return False
+
+
+# Warehouse job statistics. Every query, script and load job is recorded in JOB_STATS_FILE as one
+# JSON line, tagged with the stage that ran it: bytes processed and billed, slot time, cache hit,
+# and how long the job was queued and running. Scripts are recorded statement by statement. With
+# DRY_RUN=1 the pipeline runs nothing: estimate_pipeline_cost() walks the stages against a
+# DryRunBackend, which estimates what each statement would scan, and prints the totals per stage.
+# DuckDB reports synthetic statistics in the same shape, so all of this also runs offline.
+_job_totals = {}
+
+
+def current_stage():
+    span = current_span()
+    while span is not None and span.kind != 'stage':
+        span = span.parent
+    return span.name if span is not None else None
+
+
+def billed_bytes(processed):
+    """On-demand billing: rounded up to the MiB, with a 10 MiB minimum for any query that scans data."""
+    if not processed:
+        return 0
+    return max(-(-processed // 2 ** 20), 10) * 2 ** 20
+
+
+def record_job(stats, statement=''):
+    stage = current_stage()
+    event = {'run_id': TRACE_RUN_ID, 'stage': stage, 'dry_run': DRY_RUN,
+             'statement': ' '.join(statement.split())[:200], **stats}
+    with _trace_lock:
+        with open(JOB_STATS_FILE, 'a') as f:
+            f.write(json.dumps(event, default=str) + '\n')
+        totals = _job_totals.setdefault(stage, dict.fromkeys(
+            ['jobs', 'unestimated', 'bytes_processed', 'bytes_billed', 'slot_ms'], 0))
+        totals['jobs'] += 1
+        totals['unestimated'] += 1 if 'error' in stats else 0
+        for field in ['bytes_processed', 'bytes_billed', 'slot_ms']:
+            totals[field] += stats.get(field) or 0
+
+
+def print_job_report():
+    print(f"{'stage':<28}{'jobs':>6}{'GiB processed':>16}{'GiB billed':>13}{'slot s':>10}{'USD':>10}")
+    for stage, totals in _job_totals.items():
+        cost = totals['bytes_billed'] / 2 ** 40 * USD_PER_TIB_BILLED
+        print(f"{stage or '-':<28}{totals['jobs']:>6}{totals['bytes_processed'] / 2 ** 30:>16.3f}"
+              f"{totals['bytes_billed'] / 2 ** 30:>13.3f}{totals['slot_ms'] / 1000:>10.1f}{cost:>10.4f}"
+              + (f"  ({totals['unestimated']} statements could not be estimated)" if totals['unestimated'] else ''))
+
+
+def estimate_pipeline_cost(stages):
+    """Walks every stage in order against the dry-run backend and prints what each would scan."""
+    with Span('estimate_pipeline_cost', 'pipeline'):
+        for stage in stages:
+            with Span(stage['name'], 'stage'):
+                try:
+                    stage['func']()
+                except Exception as error:
+                    print(f'Estimate for {stage["name"]} is partial, the dry run stopped at: {error}')
+    print_job_report()
+
+
+# Parquet bulk writes. A frame is converted to Arrow with the target table's column types applied
+# explicitly, split into compressed Parquet files of about PARQUET_FILE_MB each (measured in memory,
+# before compression) and written to disk in parallel. write_table_bulk on each backend then loads
+# the files as parallel bulk loads and commits them to the target in one step.
+ARROW_TYPES = {
+    'STRING': pa.string(), 'VARCHAR': pa.string(),
+    'INT64': pa.int64(), 'INTEGER': pa.int64(), 'BIGINT': pa.int64(),
+    'FLOAT64': pa.float64(), 'FLOAT': pa.float64(), 'DOUBLE': pa.float64(),
+    'BOOL': pa.bool_(), 'BOOLEAN': pa.bool_(),
+    'DATE': pa.date32(), 'DATETIME': pa.timestamp('us'), 'TIMESTAMP': pa.timestamp('us'),
+}
+
+
+def _arrow_table(df, target_schema):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if target_schema is None:
+        return table
+    unknown = [name for name in table.column_names if name not in target_schema]
+    if unknown:
+        raise ValueError(f'Columns {unknown} are not in the target table.')
+    # Columns of a type without an Arrow mapping keep the type inferred from the frame.
+    return table.cast(pa.schema([(name, target_schema[name] or table.schema.field(name).type)
+                                 for name in table.column_names]))
+
+
+def write_parquet_files(table, directory):
+    row_bytes = table.nbytes / table.num_rows if table.num_rows else 1
+    file_rows = max(1, int(PARQUET_FILE_MB * 2 ** 20 / row_bytes))
+    paths = [os.path.join(directory, f'part-{part:05d}.parquet')
+             for part in range(max(1, -(-table.num_rows // file_rows)))]
+
+    def write_file(part):
+        pq.write_table(table.slice(part * file_rows, file_rows), paths[part], compression=PARQUET_COMPRESSION)
+
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+        list(executor.map(write_file, range(len(paths))))
+    return paths
+
+
+# Partition-scoped writes. The fact tables are partitioned by day (see TABLE_LAYOUTS) and a batch
+# only touches the partitions its rows fall in: one transaction deletes those partitions ('replace')
+# and inserts the batch. The days are listed as literals so that the warehouse prunes the delete to
+# them, and loading the same batch again replaces its rows instead of duplicating them.
+def partition_write_sql(table_name, columns, partition_column, partition_values, sources, if_exists='replace'):
+    """Script that writes the rows of sources (tables or subqueries) to the touched partitions of table_name."""
+    days = pd.to_datetime(pd.Series(partition_values)).dt.date
+    conditions = []
+    touched = sorted(days.dropna().unique())
+    if touched:
+        conditions.append(f'{partition_column} IN (' + ', '.join(f"DATE '{day}'" for day in touched) + ')')
+    if days.isna().any():
+        conditions.append(f'{partition_column} IS NULL')
+
+    column_list = ', '.join(columns)
+    statements = ['BEGIN TRANSACTION']
+    if if_exists == 'replace' and conditions:
+        statements.append(f'DELETE FROM {table_name} WHERE ' + ' OR '.join(conditions))
+    statements.append(f'INSERT INTO {table_name} ({column_list})\n'
+                      + '\nUNION ALL\n'.join(f'SELECT {column_list} FROM {source}' for source in sources))
+    statements.append('COMMIT TRANSACTION')
+    return ';\n'.join(statements)
+
+
+# Warehouse backends. Every stage talks to the warehouse through the same five calls: query, ddl,
+# read_table, write_table and load_from_file. BigQueryBackend is the production warehouse and
+# DuckDBBackend is an embedded stand-in (PIPELINE_BACKEND=duckdb) that runs every stage in-process,
+# for fast iteration and repeatable performance work without a cloud round trip. write_table_bulk
+# (with table_schema) is the Parquet alternative to write_table for the largest frames. estimate
+# prices a statement without running it, for DryRunBackend.
+#
+# read_table only reads the requested columns and pushes filters down to the storage layer, so each
+# stage moves only the data it uses. Filters follow the pyarrow form: a list of (column, op, value)
+# tuples that are ANDed together, or a list of such lists that are ORed together.
+def _sql_literal(value, quote_escape):
+    if isinstance(value, (list, tuple, set)):
+        return '(' + ', '.join(_sql_literal(v, quote_escape) for v in value) + ')'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", quote_escape) + "'"
+
+
+def _row_restriction(filters, quote_escape="\\'"):
+    if not filters:
+        return ''
+    if not isinstance(filters[0], list):
+        filters = [filters]
+    operators = {'=': '=', '==': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+                 'in': 'IN', 'not in': 'NOT IN'}
+    return ' OR '.join('(' + ' AND '.join(f'{col} {operators[op]} {_sql_literal(value, quote_escape)}'
+                                          for col, op, value in conjunction) + ')'
+                       for conjunction in filters)
+
+
+WRITE_DISPOSITIONS = {'fail': 'WRITE_EMPTY', 'append': 'WRITE_APPEND', 'replace': 'WRITE_TRUNCATE'}
+
+
+def _seconds_between(start, end):
+    return (end - start).total_seconds() if start and end else None
+
+
+def _bigquery_job_stats(job):
+    return {'job_id': job.job_id, 'job_type': job.job_type,
+            'bytes_processed': getattr(job, 'total_bytes_processed', None) or getattr(job, 'input_file_bytes', None),
+            'bytes_billed': getattr(job, 'total_bytes_billed', None), 'slot_ms': getattr(job, 'slot_millis', None),
+            'cache_hit': getattr(job, 'cache_hit', None), 'queued_s': _seconds_between(job.created, job.started),
+            'run_s': _seconds_between(job.started, job.ended)}
+
+
+class BigQueryBackend:
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.client = bigquery.Client()
+        self.read_client = bigquery_storage.BigQueryReadClient()
+        self.storage_client = storage.Client(project=project_id)
+
+    def _wait(self, job, statement=''):
+        """Waits for job and records its statistics, per statement for a multi-statement script."""
+        result = job.result()
+        children = list(self.client.list_jobs(parent_job=job.job_id)) if getattr(job, 'num_child_jobs', 0) else []
+        for child in children or [job]:
+            record_job(_bigquery_job_stats(child), getattr(child, 'query', None) or statement)
+        return result
+
+    def query(self, sql):
+        query_job = self.client.query(sql)
+        return self._wait(query_job, sql).to_dataframe()
+
+    def ddl(self, sql):
+        query_job = self.client.query(sql)
+        self._wait(query_job, sql)
+
+    def estimate(self, sql):
+        """Dry-runs each statement of sql and records the bytes it would process."""
+        for statement in sql.split(';'):
+            if not statement.strip() or re.match(r'\s*(BEGIN|COMMIT)\b', statement, flags=re.IGNORECASE):
+                continue
+            try:
+                job = self.client.query(statement, job_config=bigquery.QueryJobConfig(dry_run=True,
+                                                                                     use_query_cache=False))
+                processed = job.total_bytes_processed or 0
+                record_job({'job_type': 'query', 'bytes_processed': processed,
+                            'bytes_billed': billed_bytes(processed)}, statement)
+            except Exception as error:
+                # Typically a table that an earlier statement of this run would have created.
+                record_job({'job_type': 'query', 'error': str(error)[:200]}, statement)
+
+    def read_table(self, table_name, columns=None, filters=None, streams=READ_STREAMS, as_arrow=False):
+        """Reads the given columns of table_name over parallel Arrow streams and returns a DataFrame
+        (or the Arrow table itself with as_arrow=True)."""
+        dataset_id, table_id = table_name.split('.')
+        requested_session = bigquery_storage.types.ReadSession(
+            table=f'projects/{self.project_id}/datasets/{dataset_id}/tables/{table_id}',
+            data_format=bigquery_storage.types.DataFormat.ARROW,
+            read_options=bigquery_storage.types.ReadSession.TableReadOptions(
+                selected_fields=columns or [], row_restriction=_row_restriction(filters)
+            )
+        )
+        session = self.read_client.create_read_session(parent=f'projects/{self.project_id}',
+                                                        read_session=requested_session, max_stream_count=streams)
+        schema = pa.ipc.read_schema(pa.py_buffer(session.arrow_schema.serialized_schema))
+
+        def read_stream(stream):
+            reader = self.read_client.read_rows(stream.name)
+            return [page.to_arrow() for page in reader.rows(session).pages]
+
+        # Record batches are only turned into a DataFrame once every stream is read.
+        with ThreadPoolExecutor(max_workers=max(len(session.streams), 1)) as executor:
+            batches = [batch for stream_batches in executor.map(read_stream, session.streams)
+                       for batch in stream_batches]
+
+        table = pa.Table.from_batches(batches) if batches else schema.empty_table()
+        if columns:
+            table = table.select(columns)
+        return table if as_arrow else table.to_pandas()
+
+    def write_table(self, df, table_name, if_exists='fail'):
+        to_gbq(df, table_name, project_id=self.project_id, if_exists=if_exists)
+
+    def load_from_file(self, source, table_name, source_format, schema=None, drop_columns=(),
+                       if_exists='fail'):
+        """Loads a file (local path or gs:// URI) into table_name as a bulk load job."""
+        job_config = bigquery.LoadJobConfig(
+            source_format=source_format, autodetect=schema is None,
+            write_disposition=WRITE_DISPOSITIONS[if_exists]
+        )
+        if schema is not None:
+            job_config.schema = [bigquery.SchemaField(name, field_type) for name, field_type in schema]
+        if source_format == 'CSV':
+            job_config.skip_leading_rows = 1
+
+        if source.startswith('gs://'):
+            load_job = self.client.load_table_from_uri(source, table_name, job_config=job_config)
+        else:
+            with open(source, 'rb') as source_file:
+                load_job = self.client.load_table_from_file(source_file, table_name, job_config=job_config)
+        self._wait(load_job, f'LOAD {source} INTO {table_name}')
+
+        # Load jobs cannot skip columns, so unwanted ones are dropped right after (a metadata-only change).
+        for col in drop_columns:
+            self.ddl(f'ALTER TABLE {table_name} DROP COLUMN {col}')
+
+    def catalog(self, dataset):
+        """(table, column, data type) for every column of every table in dataset."""
+        columns = self.query(f'SELECT table_name, column_name, data_type FROM {dataset}.INFORMATION_SCHEMA.COLUMNS '
+                             'ORDER BY table_name, ordinal_position')
+        return list(columns.itertuples(index=False, name=None))
+
+    def table_schema(self, table_name):
+        """Column name to Arrow type for an existing table, or None if the table does not exist."""
+        try:
+            table = self.client.get_table(table_name)
+        except NotFound:
+            return None
+        return {field.name: ARROW_TYPES.get(field.field_type) for field in table.schema}
+
+    def row_count(self, table_name):
+        """Rows in table_name from the table metadata, or None if the table does not exist."""
+        try:
+            return self.client.get_table(table_name).num_rows
+        except NotFound:
+            return None
+
+    def source_version(self, source):
+        """Generation and MD5 of a gs:// blob (size and mtime for a local file), or None if it is missing."""
+        if not source.startswith('gs://'):
+            return f'{os.stat(source).st_size}-{os.stat(source).st_mtime_ns}' if os.path.exists(source) else None
+        bucket_name, blob_name = source[len('gs://'):].split('/', 1)
+        blob = self.storage_client.bucket(bucket_name).get_blob(blob_name)
+        return f'{blob.generation}-{blob.md5_hash}' if blob is not None else None
+
+    def write_table_bulk(self, df, table_name, if_exists='fail'):
+        """Writes df as Parquet files loaded in parallel into temporary tables. One copy job then
+        commits all of them to table_name, so the rows land all together or not at all."""
+        target_schema = self.table_schema(table_name)
+        if target_schema is not None and if_exists == 'fail':
+            raise ValueError(f'Table {table_name} already exists.')
+        table = _arrow_table(df, target_schema)
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_parquet_files(table, directory)
+            load_tables = [f'{table_name}_load_{uuid.uuid4().hex[:8]}_{part}' for part in range(len(paths))]
+            try:
+                with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+                    list(executor.map(lambda part: self.load_from_file(paths[part], load_tables[part], 'PARQUET',
+                                                                       if_exists='replace'),
+                                      range(len(paths))))
+
+                copy_config = bigquery.CopyJobConfig(write_disposition=WRITE_DISPOSITIONS[if_exists])
+                self._wait(self.client.copy_table(load_tables, table_name, job_config=copy_config),
+                           f'COPY INTO {table_name}')
+            finally:
+                for load_table in load_tables:
+                    self.client.delete_table(load_table, not_found_ok=True)
+
+    def write_partitions(self, df, table_name, partition_column, if_exists='replace'):
+        """Loads df as Parquet into temporary tables, then writes it to only the date partitions of
+        table_name it touches, in one transaction (see partition_write_sql)."""
+        table = _arrow_table(df, self.table_schema(table_name))
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_parquet_files(table, directory)
+            load_tables = [f'{table_name}_load_{uuid.uuid4().hex[:8]}_{part}' for part in range(len(paths))]
+            try:
+                with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+                    list(executor.map(lambda part: self.load_from_file(paths[part], load_tables[part], 'PARQUET',
+                                                                       if_exists='replace'),
+                                      range(len(paths))))
+
+                self.ddl(partition_write_sql(table_name, table.column_names, partition_column,
+                                             df[partition_column], load_tables, if_exists))
+            finally:
+                for load_table in load_tables:
+                    self.client.delete_table(load_table, not_found_ok=True)
+
+
+# BigQuery SQL constructs used by the pipelines and their DuckDB equivalents.
+DUCKDB_SQL_REWRITES = [
+    (r'`', '"'),
+    (r'\bGENERATE_UUID\(\)', 'CAST(gen_random_uuid() AS VARCHAR)'),
+    (r'\bFARM_FINGERPRINT\(', 'hash('),
+    (r'\*\s*EXCEPT\s*\(', '* EXCLUDE ('),
+    (r'\bSTRING\b', 'VARCHAR'),
+    (r'\bINT64\b', 'BIGINT'),
+    (r'\bFLOAT64\b', 'DOUBLE'),
+    (r'\bDATETIME\b', 'TIMESTAMP'),
+    # Table partitioning and clustering are BigQuery storage options with no DuckDB counterpart.
+    (r'\)\s*PARTITION BY\s+\w+', ')'),
+    (r'\s*\bCLUSTER BY\s+\w+(\s*,\s*\w+)*', ''),
+]
+DUCKDB_TYPES = {'INT64': 'BIGINT', 'FLOAT64': 'DOUBLE', 'BOOL': 'BOOLEAN', 'STRING': 'VARCHAR',
+                'TIMESTAMP': 'TIMESTAMP'}
+
+
+def to_duckdb_sql(sql):
+    """Rewrites a BigQuery statement or script for DuckDB."""
+    statements = []
+    for statement in sql.split(';'):
+        if not statement.strip():
+            continue
+        for pattern, replacement in DUCKDB_SQL_REWRITES:
+            statement = re.sub(pattern, replacement, statement, flags=re.IGNORECASE)
+
+        # DuckDB takes one action per ALTER TABLE.
+        alter = re.match(r'\s*ALTER TABLE\s+(\S+)\s+(.*)', statement, flags=re.IGNORECASE | re.DOTALL)
+        if alter:
+            actions = re.split(r',\s*(?=(?:ADD|DROP) COLUMN)', alter.group(2).strip(), flags=re.IGNORECASE)
+            statements.extend(f'ALTER TABLE {alter.group(1)} {action}' for action in actions)
+        else:
+            statements.append(statement)
+    return ';\n'.join(statements)
+
+
+class DuckDBBackend:
+    def __init__(self, database, datasets):
+        import duckdb
+
+        self.connection = duckdb.connect(database)
+        for dataset in datasets:
+            self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS {dataset}')
+
+    def _cursor(self):
+        # One cursor per call, so that stages running on different threads do not share a connection.
+        return self.connection.cursor()
+
+    def _table_exists(self, cursor, table_name):
+        dataset_id, table_id = table_name.split('.')
+        return cursor.execute('SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = ? '
+                              'AND table_name = ?', [dataset_id, table_id]).fetchone()[0] > 0
+
+    def _local_path(self, source):
+        # gs://bucket/blob is served from LOCAL_BUCKET_DIR/bucket/blob.
+        return os.path.join(LOCAL_BUCKET_DIR, source[len('gs://'):]) if source.startswith('gs://') else source
+
+    def _synthetic_bytes(self, cursor, sql):
+        # Stand-in for bytes processed: 8 bytes per value of every table the statement reads.
+        tables = {name.lower() for name in re.findall(r'\b(?:FROM|JOIN)\s+(\w+\.\w+)', sql, flags=re.IGNORECASE)}
+        sizes = cursor.execute("SELECT schema_name || '.' || table_name, estimated_size * column_count * 8 "
+                               'FROM duckdb_tables()').fetchall()
+        return sum(size for name, size in sizes if name.lower() in tables)
+
+    def _execute(self, cursor, sql):
+        processed = self._synthetic_bytes(cursor, sql)
+        t0 = perf_counter()
+        cursor.execute(to_duckdb_sql(sql))
+        run_s = perf_counter() - t0
+        record_job({'job_id': uuid.uuid4().hex, 'job_type': 'query', 'bytes_processed': processed,
+                    'bytes_billed': billed_bytes(processed), 'slot_ms': round(run_s * 1000), 'cache_hit': False,
+                    'queued_s': 0.0, 'run_s': run_s}, sql)
+
+    def query(self, sql):
+        cursor = self._cursor()
+        self._execute(cursor, sql)
+        return cursor.fetch_df() if cursor.description else pd.DataFrame()
+
+    def ddl(self, sql):
+        self._execute(self._cursor(), sql)
+
+    def estimate(self, sql):
+        processed = self._synthetic_bytes(self._cursor(), sql)
+        record_job({'job_type': 'query', 'bytes_processed': processed, 'bytes_billed': billed_bytes(processed)}, sql)
+
+    def read_table(self, table_name, columns=None, filters=None, streams=READ_STREAMS, as_arrow=False):
+        cursor = self._cursor()
+        select = ', '.join(f'"{col}"' for col in columns) if columns else '*'
+        restriction = _row_restriction(filters, quote_escape="''")
+        reader = cursor.execute(f'SELECT {select} FROM {table_name}'
+                                + (f' WHERE {restriction}' if restriction else '')).fetch_record_batch()
+        table = reader.read_all()
+        return table if as_arrow else table.to_pandas()
+
+    def _write_select(self, cursor, select, table_name, if_exists):
+        exists = self._table_exists(cursor, table_name)
+        if exists and if_exists == 'fail':
+            raise ValueError(f'Table {table_name} already exists.')
+        if exists and if_exists == 'replace':
+            cursor.execute(f'DROP TABLE {table_name}')
+            exists = False
+
+        if exists:
+            cursor.execute(f'INSERT INTO {table_name} BY NAME {select}')
+        else:
+            cursor.execute(f'CREATE TABLE {table_name} AS {select}')
+
+    def write_table(self, df, table_name, if_exists='fail'):
+        cursor = self._cursor()
+        cursor.register('source_frame', df)
+        self._write_select(cursor, 'SELECT * FROM source_frame', table_name, if_exists)
+        cursor.unregister('source_frame')
+
+    def load_from_file(self, source, table_name, source_format, schema=None, drop_columns=(),
+                       if_exists='fail'):
+        path = self._local_path(source).replace("'", "''")
+        if source_format == 'NEWLINE_DELIMITED_JSON':
+            reader = f"read_json_auto('{path}', format = 'newline_delimited')"
+        elif schema is not None:
+            columns = ', '.join(f"'{name}': '{DUCKDB_TYPES[field_type]}'" for name, field_type in schema)
+            reader = f"read_csv('{path}', header = true, columns = {{{columns}}})"
+        else:
+            reader = f"read_csv_auto('{path}', header = true)"
+
+        exclude = f' EXCLUDE ({", ".join(drop_columns)})' if drop_columns else ''
+        self._write_select(self._cursor(), f'SELECT *{exclude} FROM {reader}', table_name, if_exists)
+
+    def catalog(self, dataset):
+        return self._cursor().execute('SELECT table_name, column_name, data_type FROM information_schema.columns '
+                                      'WHERE table_schema = ? ORDER BY table_name, ordinal_position',
+                                      [dataset]).fetchall()
+
+    def table_schema(self, table_name):
+        dataset_id, table_id = table_name.split('.')
+        columns = self._cursor().execute('SELECT column_name, data_type FROM information_schema.columns '
+                                         'WHERE table_schema = ? AND table_name = ? ORDER BY ordinal_position',
+                                         [dataset_id, table_id]).fetchall()
+        return {name: ARROW_TYPES.get(data_type) for name, data_type in columns} or None
+
+    def row_count(self, table_name):
+        cursor = self._cursor()
+        if not self._table_exists(cursor, table_name):
+            return None
+        return cursor.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+
+    def source_version(self, source):
+        path = self._local_path(source)
+        return f'{os.stat(path).st_size}-{os.stat(path).st_mtime_ns}' if os.path.exists(path) else None
+
+    def write_table_bulk(self, df, table_name, if_exists='fail'):
+        # The Parquet files are read in parallel by DuckDB and committed in one transaction.
+        table = _arrow_table(df, self.table_schema(table_name))
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_parquet_files(table, directory)
+            files = ', '.join("'" + path.replace("'", "''") + "'" for path in paths)
+
+            cursor = self._cursor()
+            cursor.execute('BEGIN TRANSACTION')
+            try:
+                self._write_select(cursor, f'SELECT * FROM read_parquet([{files}])', table_name, if_exists)
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+
+    def write_partitions(self, df, table_name, partition_column, if_exists='replace'):
+        # DuckDB tables are not partitioned, but the same delete and insert keeps reloads idempotent.
+        cursor = self._cursor()
+        cursor.register('source_frame', df)
+        try:
+            self._execute(cursor, partition_write_sql(table_name, list(df.columns), partition_column,
+                                                      df[partition_column], ['source_frame'], if_exists))
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        finally:
+            cursor.unregister('source_frame')
+
+
+class DryRunBackend:
+    """Runs no statement that changes the warehouse. SELECT queries still run, since stages branch on
+    their results; every other statement and every table read is only estimated, reads return empty
+    tables, and writes and loads (free on BigQuery) are skipped."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def query(self, sql):
+        if re.match(r'\s*(SELECT|WITH)\b', sql, flags=re.IGNORECASE):
+            return self.backend.query(sql)
+        self.backend.estimate(sql)
+        return pd.DataFrame()
+
+    def ddl(self, sql):
+        self.backend.estimate(sql)
+
+    def read_table(self, table_name, columns=None, filters=None, as_arrow=False, **kwargs):
+        restriction = _row_restriction(filters)
+        self.backend.estimate(f'SELECT {", ".join(columns) if columns else "*"} FROM {table_name}'
+                              + (f' WHERE {restriction}' if restriction else ''))
+        schema = self.backend.table_schema(table_name) or {}
+        table = pa.schema([(name, schema.get(name) or pa.string()) for name in columns or schema]).empty_table()
+        return table if as_arrow else table.to_pandas()
+
+    def write_table(self, df, table_name, if_exists='fail'):
+        pass
+
+    def load_from_file(self, source, table_name, source_format, **kwargs):
+        pass
+
+    def write_table_bulk(self, df, table_name, if_exists='fail'):
+        pass
+
+    def write_partitions(self, df, table_name, partition_column, if_exists='replace'):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+class TracedBackend:
+    """Runs every warehouse call of the wrapped backend inside a span."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def query(self, sql):
+        with Span('query', 'warehouse', sql=' '.join(sql.split())[:200]) as span:
+            df = self.backend.query(sql)
+            span.record(rows_in=len(df), df=df)
+            return df
+
+    def ddl(self, sql):
+        with Span('ddl', 'warehouse', sql=' '.join(sql.split())[:200]):
+            self.backend.ddl(sql)
+
+    def read_table(self, table_name, columns=None, filters=None, **kwargs):
+        with Span('read_table', 'warehouse', table=table_name) as span:
+            df = self.backend.read_table(table_name, columns=columns, filters=filters, **kwargs)
+            if isinstance(df, pa.Table):
+                span.record(rows_in=df.num_rows, nbytes=df.nbytes)
+            else:
+                span.record(rows_in=len(df), df=df)
+            return df
+
+    def write_table(self, df, table_name, if_exists='fail'):
+        with Span('write_table', 'warehouse', table=table_name) as span:
+            self.backend.write_table(df, table_name, if_exists=if_exists)
+            span.record(rows_out=len(df), df=df)
+
+    def load_from_file(self, source, table_name, source_format, **kwargs):
+        with Span('load_from_file', 'warehouse', table=table_name, source=source):
+            self.backend.load_from_file(source, table_name, source_format, **kwargs)
+
+    def catalog(self, dataset):
+        with Span('catalog', 'warehouse', dataset=dataset) as span:
+            columns = self.backend.catalog(dataset)
+            span.record(rows_in=len(columns))
+            return columns
+
+    def write_table_bulk(self, df, table_name, if_exists='fail'):
+        with Span('write_table_bulk', 'warehouse', table=table_name) as span:
+            self.backend.write_table_bulk(df, table_name, if_exists=if_exists)
+            span.record(rows_out=len(df), df=df)
+
+    def write_partitions(self, df, table_name, partition_column, if_exists='replace'):
+        with Span('write_partitions', 'warehouse', table=table_name) as span:
+            self.backend.write_partitions(df, table_name, partition_column, if_exists=if_exists)
+            span.record(rows_out=len(df), df=df)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+def create_backend(project_id, datasets):
+    if PIPELINE_BACKEND == 'duckdb':
+        warehouse = DuckDBBackend(DUCKDB_PATH, datasets)
+    else:
+        warehouse = BigQueryBackend(project_id)
+    return TracedBackend(DryRunBackend(warehouse) if DRY_RUN else warehouse)
+
+
+def write_large_table(backend, df, table_name, if_exists='fail'):
+    """Writes the big fact and staging frames, as Parquet bulk loads when WRITE_MODE is 'parquet'."""
+    if WRITE_MODE == 'parquet':
+        backend.write_table_bulk(df, table_name, if_exists=if_exists)
+    else:
+        backend.write_table(df, table_name, if_exists=if_exists)
+
+
+# Target table schemas. Declared tables are created, or extended with missing columns, only when a
+# stage that writes them runs: ensure() diffs the declared columns against the warehouse catalog,
+# which is read once per dataset and cached, and sends whatever is missing as one DDL script. Type
+# differences on existing columns are reported but never altered. Tables already checked in this
+# run cost nothing. New tables are created with their layout (TABLE_LAYOUTS in each pipeline: date
+# partitioning and clustering); an existing table keeps the layout it was created with.
+TYPE_ALIASES = {'INT': 'INT64', 'INTEGER': 'INT64', 'BIGINT': 'INT64', 'VARCHAR': 'STRING', 'DOUBLE': 'FLOAT64',
+                'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL', 'TIMESTAMP': 'DATETIME'}
+
+
+def _normal_type(data_type):
+    data_type = data_type.upper()
+    return TYPE_ALIASES.get(data_type, data_type)
+
+
+class SchemaManager:
+    def __init__(self, backend, schemas, layouts=None):
+        self.backend = backend
+        self.schemas = schemas
+        self.layouts = layouts or {}
+        self._catalog = None
+        self._ensured = set()
+        self._lock = threading.Lock()
+
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = {}
+            for dataset in sorted({table_name.split('.')[0] for table_name in self.schemas}):
+                for table_id, column, data_type in self.backend.catalog(dataset):
+                    self._catalog.setdefault(f'{dataset}.{table_id}', {})[column] = data_type
+        return self._catalog
+
+    def ensure(self, *table_names):
+        with self._lock:
+            pending = [table_name for table_name in table_names if table_name not in self._ensured]
+            if not pending:
+                return
+            catalog = self.catalog()
+
+            statements = []
+            for table_name in pending:
+                declared = self.schemas[table_name]
+                actual = catalog.get(table_name)
+                if actual is None:
+                    columns = ',\n'.join(f'    {name} {definition}' for name, definition in declared)
+                    layout = self.layouts.get(table_name, {})
+                    options = ''
+                    if 'partition_by' in layout:
+                        options += f'\n    PARTITION BY {layout["partition_by"]}'
+                    if 'cluster_by' in layout:
+                        options += f'\n    CLUSTER BY {", ".join(layout["cluster_by"])}'
+                    statements.append(f'CREATE TABLE IF NOT EXISTS {table_name} (\n{columns}\n    ){options}')
+                    continue
+
+                missing = [(name, definition) for name, definition in declared if name not in actual]
+                if missing:
+                    statements.append(f'ALTER TABLE {table_name} '
+                                      + ', '.join(f'ADD COLUMN {name} {definition}' for name, definition in missing))
+                for name, definition in declared:
+                    if name in actual and _normal_type(actual[name]) != _normal_type(definition.split()[0]):
+                        print(f'{table_name}.{name} is {actual[name]} in the warehouse but declared as '
+                              f'{definition.split()[0]}.')
+
+            if statements:
+                self.backend.ddl(';\n'.join(statements))
+                print(f'Target tables created or updated: {", ".join(pending)}.')
+
+            for table_name in pending:
+                catalog[table_name] = {**{name: definition.split()[0] for name, definition in self.schemas[table_name]},
+                                       **catalog.get(table_name, {})}
+            self._ensured.update(pending)
+
+
+# Raw staging as bulk file loads. The CSV files are sent to the warehouse as they are, without being
+# parsed into DataFrames. Column types are inferred once from a small sample and the CSV index column
+# is dropped as part of the load. The files do not depend on each other and are loaded in parallel.
+def _infer_raw_schema(path, timestamp_columns=()):
+    sample = pd.read_csv(path, nrows=RAW_SAMPLE_ROWS)
+    schema = []
+    for position, (name, dtype) in enumerate(sample.dtypes.items()):
+        if name in timestamp_columns:
+            field_type = 'TIMESTAMP'
+        elif pd.api.types.is_bool_dtype(dtype):
+            field_type = 'BOOL'
+        elif pd.api.types.is_integer_dtype(dtype):
+            field_type = 'INT64'
+        elif pd.api.types.is_float_dtype(dtype):
+            field_type = 'FLOAT64'
+        else:
+            field_type = 'STRING'
+        schema.append((RAW_INDEX_COLUMN if position == 0 else name, field_type))
+    return schema
+
+
+def load_raw_staging_passthrough(backend, raw_files, timestamp_columns=(), if_exists='fail'):
+    """Loads each (label, CSV path, table name) of raw_files into its table."""
+    def load_file(raw_file):
+        label, path, table_name = raw_file
+        try:
+            backend.load_from_file(path, table_name, 'CSV', schema=_infer_raw_schema(path, timestamp_columns),
+                                   drop_columns=[RAW_INDEX_COLUMN], if_exists=if_exists)
+
+            print(f'{label} data loaded successfully.')
+
+        except Exception as error:
+            print(f'Error with loading {label.lower()} data {error}')
+            raise
+
+    with ThreadPoolExecutor(max_workers=len(raw_files)) as executor:
+        list(executor.map(in_current_span(load_file), raw_files))
+
+
+# Client-side surrogate keys, used when KEY_MODE is 'fingerprint'. Each natural key is hashed to a
+# 64-bit fingerprint in one vectorized pass, so dims and facts get the same key for the same natural
+# key without waiting for GENERATE_UUID() and reading the keys back. Keys are returned as strings
+# to stay compatible with the existing STRING key columns.
+def fingerprint_keys(df, columns):
+    hashed = pd.util.hash_pandas_object(df[columns].astype('string'), index=False)
+    keys = pd.Series(hashed.to_numpy().view('int64'), index=df.index)
+
+    # Collision check: every distinct natural key must map to a distinct fingerprint.
+    if keys.nunique() != len(df[columns].drop_duplicates()):
+        raise ValueError(f'Surrogate key collision on natural key {columns}')
+
+    return keys.astype('string')
+
+
+# On-disk natural key -> surrogate key index per dimension. Natural keys are kept as sorted 64-bit
+# fingerprints with one array per indexed column (surrogate key, price, ...), so that fact assembly
+# is a vectorized binary search over compact, memory mapped arrays instead of merging wide dim frames.
+def _key_index_path(dim_table, name):
+    return os.path.join(KEY_INDEX_DIR, dim_table, f'{name}.npy')
+
+
+def _natural_key_hashes(df, natural_columns):
+    return pd.util.hash_pandas_object(df[natural_columns].astype('string'), index=False).to_numpy()
+
+
+def _save_index_array(path, values):
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, values)
+    os.replace(path + '.tmp', path)
+
+
+def update_key_index(dim_table, df, natural_columns, columns, replace=False):
+    """Merges the rows of df into the key index of dim_table, replacing the entries of keys it already holds.
+    With replace, the index is rebuilt from df alone."""
+    if DRY_RUN:
+        return
+    # The index keeps one entry per natural key, so repeats are reported here rather than collapsed silently.
+    df = guard_join(dim_table, df, natural_columns)
+    os.makedirs(os.path.join(KEY_INDEX_DIR, dim_table), exist_ok=True)
+    if replace:
+        for name in os.listdir(os.path.join(KEY_INDEX_DIR, dim_table)):
+            os.remove(os.path.join(KEY_INDEX_DIR, dim_table, name))
+    hashes = _natural_key_hashes(df, natural_columns)
+    values = {}
+    for col in columns:
+        if pd.api.types.is_numeric_dtype(df[col]):
+            values[col] = df[col].to_numpy(dtype='float64', na_value=np.nan)
+        else:
+            values[col] = df[col].astype('string').fillna('').to_numpy().astype('U')
+
+    if not replace and os.path.exists(_key_index_path(dim_table, 'hash')):
+        hashes = np.concatenate([hashes, np.load(_key_index_path(dim_table, 'hash'))])
+        for col in columns:
+            values[col] = np.concatenate([values[col], np.load(_key_index_path(dim_table, col))])
+
+    # The incoming rows come first, and a stable sort keeps the first entry for each natural key, so a
+    # changed price or key replaces the indexed one.
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    first = np.ones(len(hashes), dtype=bool)
+    first[1:] = hashes[1:] != hashes[:-1]
+
+    _save_index_array(_key_index_path(dim_table, 'hash'), hashes[first])
+    for col in columns:
+        _save_index_array(_key_index_path(dim_table, col), values[col][order][first])
+
+
+def index_dimension(backend, dim_table, df, natural_columns, columns):
+    """Adds the rows just loaded to dim_table to its key index."""
+    if all(col in df.columns for col in columns):
+        update_key_index(dim_table, df, natural_columns, columns)
+    else:
+        # Keys generated by the warehouse have to be read back, only the indexed columns are read.
+        dim = backend.read_table(dim_table, natural_columns + columns)
+        update_key_index(dim_table, dim, natural_columns, columns, replace=True)
+
+
+def lookup_keys(backend, dim_table, df, natural_columns, columns):
+    """Returns the indexed columns of dim_table for each row of df, aligned to df's index."""
+    if not all(os.path.exists(_key_index_path(dim_table, name)) for name in ['hash'] + columns):
+        index_dimension(backend, dim_table, pd.DataFrame(), natural_columns, columns)
+
+    index_hashes = np.load(_key_index_path(dim_table, 'hash'), mmap_mode='r')
+    hashes = _natural_key_hashes(df, natural_columns)
+    positions = np.minimum(np.searchsorted(index_hashes, hashes), max(len(index_hashes) - 1, 0))
+    found = index_hashes[positions] == hashes if len(index_hashes) else np.zeros(len(hashes), dtype=bool)
+
+    result = pd.DataFrame(index=df.index)
+    for col in columns:
+        index_values = np.load(_key_index_path(dim_table, col), mmap_mode='r')
+        if index_values.dtype.kind == 'f':
+            result[col] = np.where(found, index_values[positions] if len(index_values) else np.nan, np.nan)
+        else:
+            matched = pd.Series(index_values[positions] if len(index_values) else '', index=df.index, dtype='string')
+            result[col] = matched.where(found & (matched != '').to_numpy())
+    return result
+
+
+# Fingerprint dedup. Rows are identified by a 64- or 128-bit hash of their key columns, computed in
+# one vectorized pass, so wide rows are compared as single integers. A FingerprintSet remembers the
+# fingerprints already loaded into a target table. It is either exact (a sorted array) or a Bloom
+# filter sized for DEDUP_CAPACITY rows at DEDUP_ERROR_RATE false positives; a false positive drops a
+# new row. The set is saved once the load succeeds, so chunked and incremental loads skip rows that
+# are already in the table. Sets persist across runs in incremental mode. The dim loads append in
+# either mode, so a set that was not restored is seeded from the rows already in the target table
+# (target_fingerprint_set), and a full load or a rerun adds only the rows the table is missing.
+def row_fingerprints(df, columns=None, bits=DEDUP_BITS):
+    frame = df if columns is None else df[columns]
+    first = pd.util.hash_pandas_object(frame, index=False).to_numpy()
+    if bits == 64:
+        return first
+    fingerprints = np.empty(len(frame), dtype=FINGERPRINT_128)
+    fingerprints['hi'] = first
+    fingerprints['lo'] = pd.util.hash_pandas_object(frame, index=False, hash_key='dedup-fp-128-key').to_numpy()
+    return fingerprints
+
+
+class FingerprintSet:
+    def __init__(self, table_name, mode=DEDUP_MODE, bits=DEDUP_BITS, error_rate=DEDUP_ERROR_RATE,
+                 capacity=DEDUP_CAPACITY):
+        self.path = os.path.join(DEDUP_DIR, table_name)
+        self.meta = {'mode': mode, 'bits': bits}
+        if mode == 'bloom':
+            size = int(np.ceil(-capacity * np.log(error_rate) / np.log(2) ** 2))
+            self.meta.update(size=size, hashes=max(1, round(size / capacity * np.log(2))))
+
+        saved_meta = None
+        if LOAD_MODE == 'incremental' and os.path.exists(self.path + '.json'):
+            with open(self.path + '.json') as f:
+                saved_meta = json.load(f)
+
+        # A set saved with other settings cannot be reused and is started again.
+        self.restored = saved_meta is not None and all(saved_meta.get(k) == v for k, v in self.meta.items())
+        if self.restored:
+            self.values = np.load(self.path + '.npy')
+        elif mode == 'bloom':
+            self.values = np.zeros((self.meta['size'] + 7) // 8, dtype=np.uint8)
+        else:
+            self.values = np.empty(0, dtype=np.uint64 if bits == 64 else FINGERPRINT_128)
+
+    def _bloom_positions(self, fingerprints):
+        # Double hashing: the i-th probe is h1 + i * h2 (mod size).
+        if self.meta['bits'] == 64:
+            h1, h2 = fingerprints, fingerprints * np.uint64(0x9E3779B97F4A7C15)
+        else:
+            h1, h2 = fingerprints['hi'], fingerprints['lo']
+        probes = np.arange(self.meta['hashes'], dtype=np.uint64)
+        return (h1[:, None] + probes[None, :] * (h2[:, None] | np.uint64(1))) % np.uint64(self.meta['size'])
+
+    def contains(self, fingerprints):
+        if self.meta['mode'] == 'bloom':
+            positions = self._bloom_positions(fingerprints)
+            bits = (self.values[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+            return bits.all(axis=1)
+
+        positions = np.searchsorted(self.values, fingerprints)
+        found = positions < len(self.values)
+        found[found] = self.values[positions[found]] == fingerprints[found]
+        return found
+
+    def add(self, fingerprints):
+        if self.meta['mode'] == 'bloom':
+            positions = self._bloom_positions(fingerprints).ravel()
+            np.bitwise_or.at(self.values, positions >> np.uint64(3),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        else:
+            self.values = np.unique(np.concatenate([self.values, fingerprints]))
+
+    def save(self):
+        if DRY_RUN:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        np.save(self.path + '.npy', self.values)
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.meta, f)
+
+
+def target_fingerprint_set(backend, table_name, batch, columns):
+    """The FingerprintSet for loading batch into table_name, deduplicated on columns. Unless a saved set
+    was restored, it holds the fingerprints of the rows already in the table."""
+    seen = FingerprintSet(table_name)
+    if not seen.restored and backend.row_count(table_name):
+        # Read back with the batch's dtypes, as the fingerprints of 1 and 1.0 differ.
+        existing = backend.read_table(table_name, columns).astype(batch[columns].dtypes.to_dict())
+        seen.add(np.unique(row_fingerprints(existing, columns, seen.meta['bits'])))
+    return seen
+
+
+def dedup_rows(df, columns=None, seen=None):
+    """Keeps the first row per fingerprint of columns, minus rows already in seen, and adds the kept ones to seen."""
+    fingerprints = row_fingerprints(df, columns, seen.meta['bits'] if seen is not None else DEDUP_BITS)
+    keep = np.zeros(len(df), dtype=bool)
+    keep[np.unique(fingerprints, return_index=True)[1]] = True
+    if seen is not None:
+        keep &= ~seen.contains(fingerprints)
+        seen.add(fingerprints[keep])
+    return df.take(np.flatnonzero(keep))
+
+
+# Join-cardinality guard. The dimension side of a join is checked for repeated keys before the
+# join runs, since every repeat multiplies the rows of the other side that match it, and that shows
+# up as a memory spike or a slow statement long before any error does. The repeated keys are
+# reported with the estimated output rows, and the load fails. Cutting the dimension side to one row
+# per key hides a modelling error rather than fixing it, so it is opt-in: JOIN_GUARD_MODE='dedup' does
+# that instead of failing, 'off' skips the checks, and any other value (the default 'error') fails.
+def _report_fanout(name, on, repeated, offending, rows_in, rows_out):
+    estimate = f', {rows_in} rows would become {rows_out}' if rows_in is not None else ''
+    message = (f'Join on {name} {on} fans out: {repeated} keys repeat{estimate}. Most repeated keys:\n'
+               f'{offending.to_string(index=False)}')
+    if JOIN_GUARD_MODE != 'dedup':
+        raise ValueError(message)
+    print(f'{message}\nOne row per key of {name} is kept.')
+
+
+def guard_join(name, right, on, left=None, left_on=None):
+    """Checks that right, the frame name is joined to on, has one row per key. Returns right, cut to
+    one row per key when JOIN_GUARD_MODE is 'dedup'. left (keyed by left_on) sizes the fan-out."""
+    if JOIN_GUARD_MODE == 'off' or right.empty:
+        return right
+    hashes = pd.util.hash_pandas_object(right[on].astype('string'), index=False).to_numpy()
+    keys, counts = np.unique(hashes, return_counts=True)
+    if len(keys) == len(hashes):
+        return right
+
+    offending = (right.loc[np.isin(hashes, keys[counts > 1]), on].value_counts().rename('n').reset_index()
+                 .head(JOIN_GUARD_REPORT_KEYS))
+    rows_in = rows_out = None
+    if left is not None:
+        left_hashes = pd.util.hash_pandas_object(left[left_on or on].astype('string'), index=False).to_numpy()
+        positions = np.minimum(np.searchsorted(keys, left_hashes), len(keys) - 1)
+        rows_in = len(left)
+        rows_out = int(np.where(keys[positions] == left_hashes, counts[positions], 1).sum())
+    _report_fanout(name, on, int((counts > 1).sum()), offending, rows_in, rows_out)
+    return right[~pd.Series(hashes).duplicated().to_numpy()]
+
+
+def guard_join_sql(backend, table, on, left_table=None, left_on=None):
+    """The warehouse form of guard_join. Returns what to join to in place of table: the table itself,
+    or a subquery with one row per key. left_on are left_table's key expressions, over alias l."""
+    if JOIN_GUARD_MODE == 'off' or DRY_RUN:
+        return table
+    keys = ', '.join(on)
+    offending = backend.query(f'SELECT {keys}, COUNT(*) AS n, COUNT(*) OVER () AS repeated FROM {table} '
+                              f'GROUP BY {keys} HAVING COUNT(*) > 1 ORDER BY n DESC LIMIT {JOIN_GUARD_REPORT_KEYS}')
+    if offending.empty:
+        return table
+
+    rows_in = rows_out = None
+    if left_table is not None:
+        matches = ' AND '.join(f'r.{column} = {expression}' for column, expression in zip(on, left_on))
+        estimate = backend.query(f'SELECT COUNT(*) AS rows_in, SUM(COALESCE(r.n, 1)) AS rows_out '
+                                 f'FROM {left_table} AS l LEFT JOIN (SELECT {keys}, COUNT(*) AS n '
+                                 f'FROM {table} GROUP BY {keys}) AS r ON {matches}')
+        rows_in, rows_out = (int(estimate[column].fillna(0).iloc[0]) for column in ['rows_in', 'rows_out'])
+    _report_fanout(table, on, int(offending['repeated'].iloc[0]), offending.drop(columns='repeated'),
+                   rows_in, rows_out)
+    return (f'(SELECT * EXCEPT(_join_row) FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY {keys}) AS _join_row '
+            f'FROM {table}) WHERE _join_row = 1)')
+
+
+# Stage scheduler. Each stage declares the tables it reads (inputs) and writes (outputs). A stage
+# waits for every earlier-declared stage it conflicts with on a table (read after write, write after
+# read, write after write), so independent stages run concurrently on a thread pool, as they mostly
+# wait on warehouse calls. A failed stage skips every stage that depends on it. Each stage runs in
+# a span under the run's span, by calling run_stage(stage, dependencies) (dependencies are the names
+# of the stages it waits for), which lets a pipeline wrap its stages, e.g. to resume a failed run.
+def stage_dependencies(stages):
+    depends_on = {}
+    for position, stage in enumerate(stages):
+        reads, writes = set(stage['inputs']), set(stage['outputs'])
+        depends_on[stage['name']] = {
+            earlier['name'] for earlier in stages[:position]
+            if set(earlier['outputs']) & (reads | writes) or set(earlier['inputs']) & writes
+        }
+    return depends_on
+
+
+def schedule_stages(stages, run_stage, max_workers=STAGE_WORKERS):
+    depends_on = stage_dependencies(stages)
+    by_name = {stage['name']: stage for stage in stages}
+    status = {}
+    running = {}
+
+    def traced_stage(name):
+        with Span(name, 'stage'):
+            run_stage(by_name[name], depends_on[name])
+
+    with Span('run_stages', 'pipeline'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        traced_stage = in_current_span(traced_stage)
+        while len(status) < len(stages):
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for name, dependencies in depends_on.items():
+                    if name in status or name in running.values():
+                        continue
+                    if any(status.get(dependency) in ('failed', 'skipped') for dependency in dependencies):
+                        status[name] = 'skipped'
+                        print(f'Stage {name} skipped because an upstream stage did not complete.')
+                        scheduled = True
+                    elif all(status.get(dependency) == 'done' for dependency in dependencies):
+                        running[executor.submit(traced_stage, name)] = name
+                        scheduled = True
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    status[name] = 'done'
+                except Exception as error:
+                    status[name] = 'failed'
+                    print(f'Stage {name} failed: {error}')
+
+    return status
+
+
+def run_stages(stages, max_workers=STAGE_WORKERS):
+    return schedule_stages(stages, lambda stage, dependencies: stage['func'](), max_workers)
+
+
+# Sampling, used when SAMPLE_PERCENT is below 100. A customer is in the sample when a multiplicative
+# hash of its id (id * 2654435761 mod SAMPLE_BUCKETS) falls in the lowest SAMPLE_PERCENT of the
+# buckets. The hash is plain integer arithmetic, so pandas and the warehouse pick the same customers,
+# and every run picks the same ones.
+def _sample_threshold():
+    return round(SAMPLE_PERCENT / 100 * SAMPLE_BUCKETS)
+
+
+def sample_mask(ids):
+    """True for each id in the sample, aligned to ids' index. Everything is in it when not sampling."""
+    ids = pd.Series(ids)
+    if SAMPLE_PERCENT >= 100:
+        return pd.Series(True, index=ids.index)
+    ids = pd.to_numeric(ids, errors='coerce').astype('Int64')
+    return ((ids.abs() * SAMPLE_MULTIPLIER) % SAMPLE_BUCKETS < _sample_threshold()).fillna(False).astype(bool)
+
+
+def sample_sql(column):
+    """The same test as sample_mask, as a SQL condition on column."""
+    if SAMPLE_PERCENT >= 100:
+        return 'TRUE'
+    return f'MOD(ABS({column}) * {SAMPLE_MULTIPLIER}, {SAMPLE_BUCKETS}) < {_sample_threshold()}'
+
+
+# High-water marks for incremental fact loads, used when LOAD_MODE is 'incremental'. The last
+# loaded (time, id) pair is kept per fact table and the next run only reads the rows after it.
+def _load_watermarks():
+    if not os.path.exists(WATERMARK_FILE):
+        return {}
+    with open(WATERMARK_FILE) as f:
+        return json.load(f)
+
+
+def save_watermark(table_name, df, time_column, id_column):
+    # A dry run loads nothing, so the watermark stays where the last real load left it.
+    if DRY_RUN or df.empty:
+        return
+    last = df.sort_values([time_column, id_column]).iloc[-1]
+    watermarks = _load_watermarks()
+    last_id = last[id_column]
+    watermarks[table_name] = {'time': str(last[time_column]),
+                              'id': last_id.item() if hasattr(last_id, 'item') else last_id}
+    with open(WATERMARK_FILE + '.tmp', 'w') as f:
+        json.dump(watermarks, f)
+    os.replace(WATERMARK_FILE + '.tmp', WATERMARK_FILE)
+
+
+def watermark_filters(table_name, time_column, id_column, base_filters=()):
+    """Read filters for the rows after the table's watermark, ANDed with base_filters."""
+    base_filters = list(base_filters)
+    watermark = _load_watermarks().get(table_name) if LOAD_MODE == 'incremental' else None
+    if watermark is None:
+        return [base_filters] if base_filters else None
+    last_time = pd.Timestamp(watermark['time'])
+    return [base_filters + [(time_column, '>', last_time)],
+            base_filters + [(time_column, '=', last_time), (id_column, '>', watermark['id'])]]
+
+
+def watermark_sql(table_name, time_column, id_column):
+    """The SQL condition for the rows after the table's watermark, TRUE when there is none."""
+    return _row_restriction(watermark_filters(table_name, time_column, id_column)) or 'TRUE'
+
+
+# Calendar dimension. Every day is keyed by its integer YYYYMMDD value, so facts get their date_key
+# arithmetically from their own timestamps, with no lookup. The calendar is generated for whole
+# years in one vectorized pass rather than derived from the distinct source timestamps.
+def date_keys(values):
+    """Returns the YYYYMMDD date key of each timestamp in values, aligned to values' index."""
+    dates = pd.to_datetime(pd.Series(values))
+    return (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype('Int64')
+
+
+def build_calendar(first, last, date_column):
+    """Returns one row per day of the years first to last, with the day itself in date_column."""
+    days = pd.date_range(f'{first.year}-01-01', f'{last.year}-12-31', freq='D')
+    return pd.DataFrame({
+        'date_key': (days.year * 10000 + days.month * 100 + days.day).astype('int64'),
+        date_column: days.date,
+        'is_weekend': days.weekday >= 5,
+        'month': days.month.astype('int64'),
+        'year': days.year.astype('int64'),
+        'quarter': days.quarter.astype('int64'),
+        'half_year': ((days.month - 1) // 6 + 1).astype('int64'),
+    })
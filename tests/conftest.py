@@ -0,0 +1,53 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = {
+    'migration-1': os.path.join(ROOT, '01 Migration 1', '03 data pipeline.py'),
+    'migration-1-modified': os.path.join(ROOT, '01 Migration 1', '05 data pipeline (modified).py'),
+    'migration-2': os.path.join(ROOT, '02 Migration 2', '03 data pipeline.py'),
+}
+
+# pipeline_common reads its settings once, on first import, so the embedded backend is chosen first.
+os.environ['PIPELINE_BACKEND'] = 'duckdb'
+os.environ['DUCKDB_PATH'] = 'warehouse.duckdb'
+sys.path.insert(0, ROOT)
+
+
+def _load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that process pool workers can find the module's functions by name.
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Runs the test in its own directory, which holds the warehouse and the generated data."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def generator():
+    return _load_module('data_generator', os.path.join(ROOT, '03 Benchmarks', '02 data generator.py'))
+
+
+@pytest.fixture
+def load_pipeline(workdir):
+    """Loads a pipeline script by its benchmark name, against a fresh DuckDB warehouse in workdir."""
+    def load(name):
+        return _load_module('pipeline', SCRIPTS[name])
+    return load
+
+
+@pytest.fixture
+def backend(workdir):
+    """A DuckDB warehouse in workdir, with an empty test_data dataset."""
+    from pipeline_common import create_backend
+    return create_backend('test-project', ['test_data'])
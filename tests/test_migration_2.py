@@ -0,0 +1,185 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import pipeline_common
+
+DIMS = ['dim_product', 'dim_customer', 'dim_city', 'dim_date']
+
+
+def _dim_rows(pipeline):
+    return {dim: pipeline.backend.row_count(f'bigdata_api.{dim}') for dim in DIMS}
+
+
+@pytest.mark.parametrize('key_mode', ['uuid', 'fingerprint'])
+def test_rerun_after_source_change_keeps_dim_rows(key_mode, monkeypatch, capsys, generator, load_pipeline):
+    monkeypatch.setenv('KEY_MODE', key_mode)
+    generator.generate_migration_2(3000, '.', 0)
+    pipeline = load_pipeline('migration-2')
+    assert set(pipeline.run_stages(pipeline.STAGES).values()) == {'done'}
+    first = _dim_rows(pipeline)
+    assert first == {'dim_product': 51, 'dim_customer': 300, 'dim_city': 10, 'dim_date': 366}
+
+    # A new version of the sales blob makes every stage downstream of it stale, so the dims are loaded
+    # again on resume.
+    with open(os.path.join('bucket', 'my-dw-bucket-02', 'bq_source_data_05.json'), 'a') as f:
+        f.write('\n')
+    capsys.readouterr()
+    assert set(pipeline.run_stages(pipeline.STAGES).values()) == {'done'}
+    output = capsys.readouterr().out
+    for stage in ['load_dim_product', 'load_dim_customer', 'load_dim_date', 'upload_surrogate_keys']:
+        assert f'Stage {stage} is up to date' not in output
+    assert _dim_rows(pipeline) == first
+
+
+def test_incremental_rerun_adds_nothing(monkeypatch, generator, load_pipeline):
+    monkeypatch.setattr(pipeline_common, 'LOAD_MODE', 'incremental')
+    generator.generate_migration_2(3000, '.', 0)
+    pipeline = load_pipeline('migration-2')
+    tables = DIMS + ['fact_sale', 'fact_sale_product']
+    assert set(pipeline.run_stages(pipeline.STAGES).values()) == {'done'}
+    first = {table: pipeline.backend.row_count(f'bigdata_api.{table}') for table in tables}
+
+    # The sales blob is touched so that every stage downstream of it loads again, from the same rows.
+    with open(os.path.join('bucket', 'my-dw-bucket-02', 'bq_source_data_05.json'), 'a') as f:
+        f.write('\n')
+    assert set(pipeline.run_stages(pipeline.STAGES).values()) == {'done'}
+    assert {table: pipeline.backend.row_count(f'bigdata_api.{table}') for table in tables} == first
+
+
+def test_partitioned_transform_matches_single_pass(monkeypatch, generator, load_pipeline):
+    generator.generate_migration_2(3000, '.', 0)
+    pipeline = load_pipeline('migration-2')
+    staging = [stage for stage in pipeline.STAGES if stage['name'] != 'el_transform'][:4]
+    assert set(pipeline.run_stages(staging).values()) == {'done'}
+
+    finals = []
+    for partitions in [1, 4]:
+        monkeypatch.setattr(pipeline, 'TRANSFORM_PARTITIONS', partitions)
+        pipeline.backend.ddl('DROP TABLE IF EXISTS bigdata_api.stg_table_final')
+        pipeline.el_transform()
+        final = pipeline.backend.read_table('bigdata_api.stg_table_final').drop(columns='row_id')
+        finals.append(final.sort_values(list(final.columns)).reset_index(drop=True))
+    assert len(finals[0]) > 0
+    pd.testing.assert_frame_equal(finals[0], finals[1])
+    assert pipeline.backend.row_count('bigdata_api.stg_table_partitioned') is None
+
+
+def test_read_snapshot_refreshes_only_the_changed_columns(monkeypatch, load_pipeline):
+    pipeline = load_pipeline('migration-2')
+    staging = pd.DataFrame({'row_id': [0, 1, 2], 'name': ['a', 'b', 'c'], 'key': ['x', 'y', 'z']})
+    pipeline.backend.write_table(staging, 'bigdata_api.stg_test', if_exists='fail')
+    assert pipeline.read_snapshot('bigdata_api.stg_test', ['key'])['key'].tolist() == ['x', 'y', 'z']
+
+    reads = []
+    read_table = pipeline.backend.read_table
+
+    def recording_read_table(table_name, columns=None, **kwargs):
+        reads.append(columns)
+        return read_table(table_name, columns, **kwargs)
+
+    monkeypatch.setattr(pipeline.backend, 'read_table', recording_read_table)
+    pipeline.backend.ddl("UPDATE bigdata_api.stg_test SET key = CONCAT(key, '2') WHERE row_id > 0")
+    pipeline.mark_snapshot_stale('bigdata_api.stg_test', ['key'])
+
+    snapshot = pipeline.read_snapshot('bigdata_api.stg_test')
+    assert reads == [['row_id', 'key']]
+    assert snapshot.set_index('row_id').to_dict() == {'name': {0: 'a', 1: 'b', 2: 'c'},
+                                                      'key': {0: 'x', 1: 'y2', 2: 'z2'}}
+    # Once refreshed, the snapshot is served without going back to the warehouse.
+    pipeline.read_snapshot('bigdata_api.stg_test', ['key'])
+    assert len(reads) == 1
+
+
+def test_coerce_columns_reports_unreadable_values(capsys, load_pipeline):
+    pipeline = load_pipeline('migration-2')
+    schema = {'id': 'Int64', 'price': 'Float64', 'name': 'string', 'city': 'category', 'day': 'datetime64'}
+    df = pd.DataFrame({'id': ['1', 'x', None], 'price': [1.5, 'cheap', None], 'name': ['a', None, 'c'],
+                       'city': ['Leeds', 'Leeds', None], 'day': ['2024-01-02', 'not a day', None]})
+    coerced, null_report = pipeline.coerce_columns(df, schema)
+
+    # Only values that were present but could not be read count, the missing ones were null already.
+    assert null_report == {'id': 1, 'price': 1, 'name': 0, 'city': 0, 'day': 1}
+    assert [str(dtype) for dtype in coerced.dtypes[:4]] == ['Int64', 'Float64', 'string', 'category']
+    assert pd.api.types.is_datetime64_dtype(coerced['day'])
+    assert coerced['id'].tolist() == [1, 0, 0]
+    assert coerced['price'].tolist() == [1.5, 0.0, 0.0]
+    assert coerced['name'].tolist() == ['a', 'NA', 'c']
+    assert coerced['city'].tolist() == ['Leeds', 'Leeds', 'NA']
+    assert coerced['day'].iloc[0] == pd.Timestamp('2024-01-02') and coerced['day'].iloc[1:].isna().all()
+
+    capsys.readouterr()
+    pipeline._report_nulls({'quantity': 2, 'date': 0})
+    assert capsys.readouterr().out == '2 values in quantity could not be read as Int64 and were set to null.\n'
+
+
+def _read_blob(name):
+    # As stream_ndjson reads it: values keep their JSON types.
+    chunk = pd.read_json(os.path.join('bucket', 'my-dw-bucket-02', name), lines=True, dtype=False,
+                         convert_dates=False)
+    return chunk, pa.Table.from_pandas(chunk, preserve_index=False)
+
+
+def test_stream_ndjson_appends_every_chunk(monkeypatch, generator, load_pipeline):
+    generator.generate_migration_2(3000, '.', 0)
+    pipeline = load_pipeline('migration-2')
+    chunk, raw = _read_blob('bq_source_data_05.json')
+    monkeypatch.setattr(pipeline, 'INGEST_CHUNK_ROWS', 40)
+
+    writes = []
+    write_table = pipeline.backend.write_table
+
+    def recording_write_table(df, table_name, if_exists='fail'):
+        writes.append(if_exists)
+        write_table(df, table_name, if_exists=if_exists)
+
+    monkeypatch.setattr(pipeline.backend, 'write_table', recording_write_table)
+    pipeline.stream_ndjson(pipeline.SALES_SOURCE, pipeline.clean_sales, 'bigdata_api.sales_data_clean')
+
+    # The first chunk creates the table and every later one is appended to it.
+    assert writes == ['fail'] + ['append'] * (-(-len(chunk) // 40) - 1)
+    columns = ['id', 'userId', 'productId', 'quantity']
+    streamed = pipeline.backend.read_table('bigdata_api.sales_data_clean', columns)
+    expected = pipeline.clean_sales(raw)[columns]
+    assert len(writes) > 1 and len(streamed) == len(expected) == 3000
+    assert streamed.sort_values(columns).to_numpy().tolist() == expected.sort_values(columns).to_numpy().tolist()
+
+
+def test_explode_list_keeps_empty_and_null_lists(load_pipeline):
+    pipeline = load_pipeline('migration-2')
+    table = pa.table({'id': [1, 2, 3, 4], 'items': [[10, 11], [], None, [12]]})
+    exploded = pipeline.explode_list(table, 'items')
+    assert exploded.column_names == ['id', 'items']
+    assert exploded.column('id').to_pylist() == [1, 1, 2, 3, 4]
+    assert exploded.column('items').to_pylist() == [10, 11, None, None, 12]
+
+
+def test_clean_sales_matches_pandas_on_the_sales_blob(generator, load_pipeline):
+    generator.generate_migration_2(3000, '.', 0)
+    pipeline = load_pipeline('migration-2')
+    chunk, raw = _read_blob('bq_source_data_05.json')
+
+    clean = pipeline.clean_sales(raw)
+    expected = pd.json_normalize(chunk.to_dict('records'), 'products', ['id', 'userId', 'date'])
+    assert len(clean) == 3000
+    assert sorted(clean.columns) == sorted(['id', 'userId', 'date', 'productId', 'quantity', 'month', 'year'])
+    for column in ['id', 'userId', 'productId', 'quantity']:
+        assert clean[column].tolist() == expected[column].tolist()
+    assert clean['date'].astype(str).tolist() == expected['date'].str[:10].tolist()
+
+
+def test_clean_user_matches_pandas_on_the_user_blob(generator, load_pipeline):
+    generator.generate_migration_2(3000, '.', 0)
+    pipeline = load_pipeline('migration-2')
+    chunk, raw = _read_blob('bq_source_data_06.json')
+
+    clean = pipeline.clean_user(raw)
+    expected = pd.json_normalize(chunk.to_dict('records'))
+    assert len(clean) == len(chunk)
+    for column, expected_column in [('firstname', 'name.firstname'), ('lastname', 'name.lastname'),
+                                    ('city', 'address.city'), ('zipcode', 'address.zipcode'),
+                                    ('geolocation_lat', 'address.geolocation.lat'),
+                                    ('geolocation_long', 'address.geolocation.long')]:
+        assert clean[column].tolist() == expected[expected_column].tolist()
@@ -0,0 +1,346 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import pipeline_common
+from pipeline_common import (
+    FingerprintSet, SchemaManager, _arrow_table, build_calendar, date_keys, dedup_rows, fingerprint_keys,
+    guard_join, guard_join_sql, lookup_keys, partition_write_sql, run_stages, sample_mask, sample_sql,
+    save_watermark, stage_dependencies, target_fingerprint_set, to_duckdb_sql, update_key_index, watermark_filters,
+    write_parquet_files,
+)
+
+
+def test_fingerprint_keys_are_stable():
+    dim = pd.DataFrame({'customer_id': [1, 2, 3]})
+    fact = pd.DataFrame({'customer_id': ['3', '1', '1', '2']}, index=[10, 11, 12, 13])
+    keys = fingerprint_keys(dim, ['customer_id'])
+
+    # A fact gets its dim's key whatever the dtype and order it carries the natural key in.
+    assert fingerprint_keys(fact, ['customer_id']).tolist() == keys[[2, 0, 0, 1]].tolist()
+    assert fingerprint_keys(fact, ['customer_id']).index.tolist() == [10, 11, 12, 13]
+    assert fingerprint_keys(dim, ['customer_id']).equals(keys)
+
+
+def test_fingerprint_keys_tell_composite_keys_apart():
+    # The same characters split differently across the key columns are different natural keys.
+    df = pd.DataFrame({'first_name': ['ab', 'a', 'b', 'ab'], 'last_name': ['c', 'bc', 'ac', 'c']})
+    keys = fingerprint_keys(df, ['first_name', 'last_name'])
+    assert keys.nunique() == 3
+    assert keys[0] == keys[3]
+
+
+def test_fingerprint_keys_raise_on_collision(monkeypatch):
+    df = pd.DataFrame({'city': ['London', 'Leeds']})
+    monkeypatch.setattr(pipeline_common.pd.util, 'hash_pandas_object',
+                        lambda frame, index: pd.Series(0, index=frame.index, dtype='uint64'))
+    with pytest.raises(ValueError, match='collision'):
+        fingerprint_keys(df, ['city'])
+
+
+def test_key_index_takes_the_incoming_rows(backend):
+    update_key_index('ds.dim', pd.DataFrame({'id': [1, 2], 'key': ['a', 'b'], 'price': [1.0, 2.0]}), ['id'],
+                     ['key', 'price'])
+    # A changed price for an indexed key replaces the indexed one, and a new key is added.
+    update_key_index('ds.dim', pd.DataFrame({'id': [2, 3], 'key': ['b', 'c'], 'price': [2.5, 3.0]}), ['id'],
+                     ['key', 'price'])
+
+    fact = pd.DataFrame({'id': ['3', '1', '2', '4']}, index=[10, 11, 12, 13])
+    keys = lookup_keys(backend, 'ds.dim', fact, ['id'], ['key', 'price'])
+    assert keys.index.tolist() == [10, 11, 12, 13]
+    assert keys['key'].tolist()[:3] == ['c', 'a', 'b'] and pd.isna(keys['key'].iloc[3])
+    assert keys['price'].tolist()[:3] == [3.0, 1.0, 2.5] and pd.isna(keys['price'].iloc[3])
+
+
+@pytest.mark.parametrize('mode', ['exact', 'bloom'])
+@pytest.mark.parametrize('bits', [64, 128])
+def test_fingerprint_set_round_trip(mode, bits, monkeypatch, workdir):
+    monkeypatch.setattr(pipeline_common, 'LOAD_MODE', 'incremental')
+    settings = {'mode': mode, 'bits': bits, 'error_rate': 0.001, 'capacity': 10_000}
+
+    seen = FingerprintSet('test_data.dim_test', **settings)
+    assert not seen.restored
+    first = pd.DataFrame({'id': [1, 2, 2, 3], 'name': ['a', 'b', 'b', 'c']})
+    assert dedup_rows(first, ['id', 'name'], seen)['id'].tolist() == [1, 2, 3]
+    seen.save()
+
+    # The saved set is picked up by the next load, which keeps only the rows it has not seen.
+    seen = FingerprintSet('test_data.dim_test', **settings)
+    assert seen.restored
+    second = pd.DataFrame({'id': [3, 4, 1, 5], 'name': ['c', 'd', 'z', 'e']})
+    assert dedup_rows(second, ['id', 'name'], seen)['id'].tolist() == [4, 1, 5]
+
+    # A set saved with other settings is not reused, and a full load does not restore one.
+    assert not FingerprintSet('test_data.dim_test', **{**settings, 'bits': 192 - bits}).restored
+    monkeypatch.setattr(pipeline_common, 'LOAD_MODE', 'full')
+    assert not FingerprintSet('test_data.dim_test', **settings).restored
+
+
+def test_dedup_rows_keeps_first_row_per_key():
+    df = pd.DataFrame({'id': [1, 1, 2, 1], 'name': ['a', 'a', 'b', 'c'], 'seq': [0, 1, 2, 3]}, index=[5, 6, 7, 8])
+    assert dedup_rows(df, ['id', 'name'])['seq'].tolist() == [0, 2, 3]
+    assert dedup_rows(df, ['id'])['seq'].tolist() == [0, 2]
+    assert dedup_rows(df)['seq'].tolist() == [0, 1, 2, 3]
+    assert dedup_rows(df, ['id']).index.tolist() == [5, 7]
+
+
+def test_target_fingerprint_set_is_seeded_from_the_table(backend):
+    backend.write_table(pd.DataFrame({'id': [1, 2], 'name': ['a', 'b']}), 'test_data.dim_test', if_exists='fail')
+
+    # The batch carries id as floats; the rows read back are cast to match before they are hashed.
+    batch = pd.DataFrame({'id': [2.0, 3.0, 1.0], 'name': ['b', 'c', 'z']})
+    seen = target_fingerprint_set(backend, 'test_data.dim_test', batch, ['id', 'name'])
+    assert dedup_rows(batch, ['id', 'name'], seen)['id'].tolist() == [3.0, 1.0]
+
+
+def test_arrow_table_applies_the_target_types():
+    df = pd.DataFrame({'id': [1, 2], 'price': [1, 2], 'day': pd.to_datetime(['2024-01-01', '2024-01-02']),
+                       'note': ['a', None]})
+    table = _arrow_table(df, {'id': pa.int64(), 'price': pa.float64(), 'day': pa.date32(), 'note': None})
+    assert table.schema.types[:3] == [pa.int64(), pa.float64(), pa.date32()]
+    # A column without an Arrow mapping keeps the type inferred from the frame.
+    assert table.schema.field('note').type == pa.Table.from_pandas(df[['note']]).schema.field('note').type
+    assert table.column('price').to_pylist() == [1.0, 2.0]
+
+    assert _arrow_table(df, None).schema.field('price').type == pa.int64()
+    with pytest.raises(ValueError, match=r"\['note'\]"):
+        _arrow_table(df, {'id': pa.int64(), 'price': pa.float64(), 'day': pa.date32()})
+
+
+def test_write_parquet_files_splits_by_size(monkeypatch, tmp_path):
+    table = pa.table({'id': list(range(1000)), 'name': [f'name {i}' for i in range(1000)]})
+    # About a quarter of the table in memory per file.
+    monkeypatch.setattr(pipeline_common, 'PARQUET_FILE_MB', table.nbytes / 4 / 2 ** 20)
+    paths = write_parquet_files(table, str(tmp_path))
+    assert [os.path.basename(path) for path in paths] == [f'part-{part:05d}.parquet' for part in range(4)]
+    assert pa.concat_tables(pq.read_table(path) for path in paths).equals(table)
+
+    (tmp_path / 'empty').mkdir()
+    empty = write_parquet_files(table.slice(0, 0), str(tmp_path / 'empty'))
+    assert len(empty) == 1 and pq.read_table(empty[0]).num_rows == 0
+
+
+def test_write_table_bulk_round_trip(monkeypatch, backend):
+    backend.ddl('CREATE TABLE test_data.sales (id INT64, amount FLOAT64, day DATE)')
+    df = pd.DataFrame({'id': range(500), 'amount': range(500), 'day': pd.Timestamp('2024-03-01')})
+    monkeypatch.setattr(pipeline_common, 'PARQUET_FILE_MB', 0.001)
+    backend.write_table_bulk(df, 'test_data.sales', if_exists='append')
+    backend.write_table_bulk(df.head(10), 'test_data.sales', if_exists='replace')
+
+    result = backend.query('SELECT id, amount, day FROM test_data.sales ORDER BY id')
+    assert result['id'].tolist() == list(range(10))
+    assert result['amount'].tolist() == [float(i) for i in range(10)]
+    assert set(pd.to_datetime(result['day'])) == {pd.Timestamp('2024-03-01')}
+
+
+def test_sample_mask_matches_sample_sql(monkeypatch, backend):
+    ids = pd.Series([*range(-50, 2000), 10 ** 9 + 7, None], dtype='Int64')
+    backend.write_table(pd.DataFrame({'id': ids}), 'test_data.ids', if_exists='fail')
+    assert sample_mask(ids).all() and sample_sql('id') == 'TRUE'
+
+    monkeypatch.setattr(pipeline_common, 'SAMPLE_PERCENT', 10)
+    mask = sample_mask(ids)
+    assert 0.05 < mask.mean() < 0.15 and not mask.iloc[-1]
+    sampled = backend.query(f"SELECT id FROM test_data.ids WHERE {sample_sql('id')} ORDER BY id")
+    assert sampled['id'].tolist() == sorted(ids[mask].tolist())
+    # Ids given as strings are sampled the same way.
+    assert sample_mask(ids.astype('string')).tolist() == mask.tolist()
+
+
+def test_save_watermark_skips_dry_runs(monkeypatch, workdir):
+    monkeypatch.setattr(pipeline_common, 'LOAD_MODE', 'incremental')
+    batch = pd.DataFrame({'ts': pd.to_datetime(['2024-01-02', '2024-01-01', '2024-01-02']), 'id': [5, 9, 7]})
+    monkeypatch.setattr(pipeline_common, 'DRY_RUN', True)
+    save_watermark('ds.fact', batch, 'ts', 'id')
+    assert not os.path.exists(pipeline_common.WATERMARK_FILE)
+    assert watermark_filters('ds.fact', 'ts', 'id') is None
+
+    monkeypatch.setattr(pipeline_common, 'DRY_RUN', False)
+    save_watermark('ds.fact', batch, 'ts', 'id')
+    assert watermark_filters('ds.fact', 'ts', 'id') == [[('ts', '>', pd.Timestamp('2024-01-02'))],
+                                                        [('ts', '=', pd.Timestamp('2024-01-02')), ('id', '>', 7)]]
+
+
+def _stub_stage(name, inputs, outputs, log, fail=False):
+    def func():
+        log.append(name)
+        if fail:
+            raise RuntimeError(f'{name} broke')
+    return {'name': name, 'func': func, 'inputs': inputs, 'outputs': outputs}
+
+
+def test_run_stages_follows_dependencies_and_skips_after_failures(workdir):
+    log = []
+    stages = [
+        _stub_stage('raw', [], ['ds.raw'], log),
+        _stub_stage('dim', ['ds.raw'], ['ds.dim'], log),
+        _stub_stage('calendar', [], ['ds.calendar'], log),
+        _stub_stage('fact', ['ds.raw', 'ds.dim', 'ds.calendar'], ['ds.fact'], log, fail=True),
+        _stub_stage('report', ['ds.fact'], ['ds.report'], log),
+        _stub_stage('cleanup', [], ['ds.raw'], log),
+    ]
+    assert stage_dependencies(stages) == {
+        'raw': set(), 'dim': {'raw'}, 'calendar': set(), 'fact': {'raw', 'dim', 'calendar'},
+        'report': {'fact'}, 'cleanup': {'raw', 'dim', 'fact'},
+    }
+
+    # fact fails, so report and cleanup, which wait for it, never run.
+    status = run_stages(stages)
+    assert status == {'raw': 'done', 'dim': 'done', 'calendar': 'done', 'fact': 'failed', 'report': 'skipped',
+                      'cleanup': 'skipped'}
+    assert log.index('raw') < log.index('dim') < log.index('fact')
+    assert log.index('calendar') < log.index('fact')
+    assert 'report' not in log and 'cleanup' not in log
+
+
+def _record_calls(monkeypatch, backend, methods):
+    calls = []
+    for method in methods:
+        def recorded(*args, method=method, original=getattr(backend, method)):
+            calls.append(method)
+            return original(*args)
+        monkeypatch.setattr(backend, method, recorded)
+    return calls
+
+
+def test_schema_manager_creates_tables_lazily_and_adds_columns(monkeypatch, capsys, backend):
+    backend.ddl('CREATE TABLE test_data.drift (id BIGINT, amount VARCHAR)')
+    schemas = SchemaManager(backend, {
+        'test_data.dim': [('key', 'STRING DEFAULT GENERATE_UUID()'), ('id', 'INT64'), ('name', 'STRING')],
+        'test_data.fact': [('id', 'INT64'), ('day', 'DATE')],
+        'test_data.drift': [('id', 'INT64'), ('amount', 'FLOAT64'), ('note', 'STRING')],
+    }, {'test_data.fact': {'partition_by': 'day', 'cluster_by': ['id']}})
+    calls = _record_calls(monkeypatch, backend, ['catalog', 'ddl'])
+
+    # Nothing is created until a table is asked for, and then only that table.
+    schemas.ensure('test_data.dim')
+    assert backend.row_count('test_data.dim') == 0 and backend.row_count('test_data.fact') is None
+    assert calls == ['catalog', 'ddl']
+
+    # The catalog is read once, and a table already ensured costs no warehouse call.
+    schemas.ensure('test_data.fact')
+    schemas.ensure('test_data.dim', 'test_data.fact')
+    assert calls == ['catalog', 'ddl', 'ddl']
+    assert backend.table_schema('test_data.fact').keys() == {'id', 'day'}
+    backend.ddl("INSERT INTO test_data.dim (id, name) VALUES (1, 'a')")
+    assert backend.query('SELECT key FROM test_data.dim')['key'].notna().all()
+
+    # A declared column the table lacks is added; a type that differs is only reported.
+    capsys.readouterr()
+    schemas.ensure('test_data.drift')
+    assert list(backend.table_schema('test_data.drift')) == ['id', 'amount', 'note']
+    assert 'test_data.drift.amount is VARCHAR in the warehouse but declared as FLOAT64.' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT FARM_FINGERPRINT(CONCAT(a, b)) FROM t', 'SELECT hash(CONCAT(a, b)) FROM t'),
+    ('CREATE OR REPLACE TABLE ds.t AS SELECT 1', 'CREATE OR REPLACE TABLE ds.t AS SELECT 1'),
+    ('SELECT `userId` FROM t', 'SELECT "userId" FROM t'),
+    ('SELECT * EXCEPT(a, b) FROM t', 'SELECT * EXCLUDE (a, b) FROM t'),
+    ('SELECT * except (a) FROM t', 'SELECT * EXCLUDE (a) FROM t'),
+    ('ALTER TABLE ds.t ADD COLUMN k STRING DEFAULT GENERATE_UUID()',
+     'ALTER TABLE ds.t ADD COLUMN k VARCHAR DEFAULT CAST(gen_random_uuid() AS VARCHAR)'),
+    ('SELECT CAST(a AS STRING), CAST(b AS INT64), CAST(c AS FLOAT64), CAST(d AS DATETIME) FROM t',
+     'SELECT CAST(a AS VARCHAR), CAST(b AS BIGINT), CAST(c AS DOUBLE), CAST(d AS TIMESTAMP) FROM t'),
+    # Identifiers that merely contain a type name are left alone.
+    ('SELECT stringify, int64_count FROM t', 'SELECT stringify, int64_count FROM t'),
+    ('CREATE TABLE ds.t (\n    day DATE\n    ) PARTITION BY day CLUSTER BY a, b',
+     'CREATE TABLE ds.t (\n    day DATE\n    )'),
+    ('CREATE OR REPLACE TABLE ds.t CLUSTER BY p AS SELECT 1', 'CREATE OR REPLACE TABLE ds.t AS SELECT 1'),
+    ('ALTER TABLE ds.t ADD COLUMN a STRING, ADD COLUMN b INT64, DROP COLUMN c',
+     'ALTER TABLE ds.t ADD COLUMN a VARCHAR;\nALTER TABLE ds.t ADD COLUMN b BIGINT;\nALTER TABLE ds.t DROP COLUMN c'),
+    ('BEGIN TRANSACTION;DELETE FROM t;COMMIT TRANSACTION;', 'BEGIN TRANSACTION;\nDELETE FROM t;\nCOMMIT TRANSACTION'),
+])
+def test_to_duckdb_sql(sql, expected):
+    assert to_duckdb_sql(sql) == expected
+
+
+def test_date_keys():
+    values = pd.Series(pd.to_datetime(['2024-02-29 23:59:59', None, '2023-01-01 00:00:00']), index=[7, 8, 9])
+    keys = date_keys(values)
+    assert keys.index.tolist() == [7, 8, 9]
+    assert keys.tolist() == [20240229, pd.NA, 20230101]
+    assert date_keys(['2023-12-31T10:00:00']).tolist() == [20231231]
+
+
+def test_build_calendar_covers_whole_years():
+    calendar = build_calendar(pd.Timestamp('2023-06-15'), pd.Timestamp('2024-02-01'), 'sale_date')
+    assert len(calendar) == 365 + 366
+    assert calendar['date_key'].is_unique
+    assert calendar['date_key'].tolist() == date_keys(calendar['sale_date']).tolist()
+
+    day = calendar.set_index('date_key').loc[20240706]
+    assert (day['is_weekend'], day['month'], day['year'], day['quarter'], day['half_year']) == (True, 7, 2024, 3, 2)
+    day = calendar.set_index('date_key').loc[20230103]
+    assert (day['is_weekend'], day['quarter'], day['half_year']) == (False, 1, 1)
+
+
+def test_partition_write_sql_scopes_the_delete_to_the_batch():
+    days = pd.Series(pd.to_datetime(['2024-01-02', '2024-01-01', '2024-01-02', None]))
+    script = partition_write_sql('ds.fact', ['id', 'day'], 'day', days, ['ds.batch_a', 'ds.batch_b'])
+    assert script.split(';\n') == [
+        'BEGIN TRANSACTION',
+        "DELETE FROM ds.fact WHERE day IN (DATE '2024-01-01', DATE '2024-01-02') OR day IS NULL",
+        'INSERT INTO ds.fact (id, day)\nSELECT id, day FROM ds.batch_a\nUNION ALL\nSELECT id, day FROM ds.batch_b',
+        'COMMIT TRANSACTION',
+    ]
+    assert 'DELETE' not in partition_write_sql('ds.fact', ['id', 'day'], 'day', days, ['ds.batch_a'],
+                                               if_exists='append')
+
+
+def test_partition_write_sql_replaces_only_the_touched_partitions(backend):
+    backend.ddl('CREATE TABLE test_data.fact (id INT64, day DATE)')
+    backend.ddl('CREATE TABLE test_data.batch (id INT64, day DATE)')
+    backend.ddl("INSERT INTO test_data.fact VALUES (1, DATE '2024-01-01'), (2, DATE '2024-01-02')")
+    backend.ddl("INSERT INTO test_data.batch VALUES (3, DATE '2024-01-02'), (4, DATE '2024-01-03')")
+    batch_days = backend.query('SELECT DISTINCT day FROM test_data.batch')['day']
+
+    # Loading the same batch twice replaces its rows; the untouched day is left as it was.
+    for _ in range(2):
+        backend.ddl(partition_write_sql('test_data.fact', ['id', 'day'], 'day', batch_days, ['test_data.batch']))
+    assert backend.query('SELECT id FROM test_data.fact ORDER BY id')['id'].tolist() == [1, 3, 4]
+
+    backend.ddl(partition_write_sql('test_data.fact', ['id', 'day'], 'day', batch_days, ['test_data.batch'],
+                                    if_exists='append'))
+    assert backend.query('SELECT id FROM test_data.fact ORDER BY id')['id'].tolist() == [1, 3, 3, 4, 4]
+
+
+def test_guard_join_passes_unique_keys():
+    right = pd.DataFrame({'id': [1, 2, 3], 'name': ['a', 'b', 'c']})
+    assert guard_join('dim', right, ['id']) is right
+
+
+def test_guard_join_fails_on_fan_out_by_default():
+    right = pd.DataFrame({'id': [1, 2, 2, 3, 3, 3], 'name': list('abcdef')})
+    left = pd.DataFrame({'id': [2, 3, 4]})
+    with pytest.raises(ValueError, match='2 keys repeat, 3 rows would become 6'):
+        guard_join('dim', right, ['id'], left)
+
+
+def test_guard_join_dedup_and_off(monkeypatch, capsys):
+    right = pd.DataFrame({'id': [1, 2, 2], 'name': ['a', 'b', 'c']})
+    monkeypatch.setattr(pipeline_common, 'JOIN_GUARD_MODE', 'dedup')
+    assert guard_join('dim', right, ['id'])['name'].tolist() == ['a', 'b']
+    assert 'One row per key of dim is kept.' in capsys.readouterr().out
+
+    monkeypatch.setattr(pipeline_common, 'JOIN_GUARD_MODE', 'off')
+    assert guard_join('dim', right, ['id']) is right
+
+
+def test_guard_join_sql(monkeypatch, backend):
+    backend.ddl("CREATE TABLE test_data.dim AS SELECT * FROM (VALUES (1, 'a'), (2, 'b'), (2, 'c')) AS t(id, name)")
+    backend.ddl('CREATE TABLE test_data.fact AS SELECT * FROM (VALUES (1), (2), (2)) AS t(dim_id)')
+    backend.ddl("CREATE TABLE test_data.unique_dim AS SELECT * FROM (VALUES (1, 'a')) AS t(id, name)")
+    assert guard_join_sql(backend, 'test_data.unique_dim', ['id']) == 'test_data.unique_dim'
+
+    with pytest.raises(ValueError, match='1 keys repeat, 3 rows would become 5'):
+        guard_join_sql(backend, 'test_data.dim', ['id'], 'test_data.fact', ['l.dim_id'])
+
+    monkeypatch.setattr(pipeline_common, 'JOIN_GUARD_MODE', 'dedup')
+    dim = guard_join_sql(backend, 'test_data.dim', ['id'], 'test_data.fact', ['l.dim_id'])
+    joined = backend.query(f'SELECT f.dim_id, d.name FROM test_data.fact AS f JOIN {dim} AS d ON f.dim_id = d.id')
+    assert len(joined) == 3
+    assert backend.query(f'SELECT * FROM {dim}').columns.tolist() == ['id', 'name']